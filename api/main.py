@@ -20,10 +20,12 @@ from functools import wraps
 from flasgger import Swagger
 from logging.handlers import TimedRotatingFileHandler
 from flask import (Flask, request, send_from_directory, make_response,
-                   render_template, abort, url_for, current_app)
+                   render_template, abort, url_for, current_app,
+                   stream_with_context)
 
-from scripts import (db_queries, users, info_page,
-                     file_manager, backgroundExtract)
+from scripts import (db, db_queries, users, info_page,
+                     file_manager, backgroundExtract, response_cache,
+                     stream_formats, jobs)
 from scripts.chip_extract import (creodiasCARDchips, rawChipExtractor,
                                   chipS2Extractor, rawChipBatchExtract,
                                   rawS1ChipBatchExtract)
@@ -32,11 +34,18 @@ from scripts.chip_extract import (creodiasCARDchips, rawChipExtractor,
 UPLOAD_ENABLE = False  # Enable upload page (http://HOST/files/upload).
 DEFAULT_AOI = ''
 STORAGE = 'files'  # Storage folder
+CACHE_SIZE = 2048  # Time series responses kept in memory.
+CACHE_DIR = ''  # Folder for the on-disk time series cache ('' to disable).
+CACHE_DISK_SIZE = 2  # Size budget of the on-disk cache in GB.
+MAX_JOBS = 4  # Background jobs (async=True requests) running at the same time.
 
 
 app = Flask(__name__)
 app.secret_key = os.urandom(12)
 datasets = db_queries.get_datasets()
+ts_cache = response_cache.ResponseCache(CACHE_SIZE, CACHE_DIR,
+                                          CACHE_DISK_SIZE)
+job_queue = jobs.JobQueue(MAX_JOBS)
 
 try:
     import flask_monitoringdashboard as dashboard
@@ -128,6 +137,52 @@ def get_user_id():
     return user
 
 
+def cached_response(key, dataset, build,
+                    get_version=db_queries.getExtractedVersion, prefix=2):
+    """Serve a query response from the time series cache.
+
+    The key must start with (aoi, year), the entries with the same key[:prefix]
+    are invalidated when get_version(dataset) changes, by default when new
+    images are extracted for the dataset. On a miss build() is called to
+    create the response, empty and error responses are not cached. Supports
+    If-None-Match with the ETag.
+    """
+    version = ts_cache.version(
+        key[:prefix], lambda: get_version(dataset))
+    entry = ts_cache.get(key, version)
+    if entry is None:
+        response = make_response(build())
+        body = response.get_data()
+        if (response.status_code != 200 or
+                body.strip() in (b'', b'{}', b'[]', b'null')):
+            return response
+        headers = {k: v for k, v in response.headers.items()
+                   if k.lower() in ('content-type', 'content-disposition')}
+        entry = ts_cache.set(key, version, body, headers)
+    response = current_app.response_class(entry.body, headers=entry.headers)
+    response.set_etag(entry.etag)
+    return response.make_conditional(request)
+
+
+def async_request(params=None):
+    """Check if the request asks for a background job (async=True)."""
+    if params is not None and str(params.pop('async', '')) == 'True':
+        return True
+    return request.args.get('async') == 'True'
+
+
+def submit_job(key, work):
+    """Run work(progress) as a background job.
+
+    Identical requests (same key) share the running job. Returns the job
+    id and the URL of its status (jobStatus).
+    """
+    job = job_queue.submit(key, work, user)
+    logger.info(f"{user} {job.id} {key}")
+    return {'job': job.id, 'status': job.status,
+            'status_url': url_for('job_status', job=job.id)}, 202
+
+
 swag = Swagger(app, decorators=[auth_required],
                template_file='static/swagger.yaml')
 try:
@@ -148,6 +203,45 @@ def info():
                                       mimetype="application/json")
 
 
+@app.route('/query/poolStats', methods=['GET'])
+@auth_required
+def pool_stats():
+    """
+    Get the database connection pools metrics (in use, waits, timeouts).
+    """
+    return current_app.response_class(json.dumps(db.pool_stats(), indent=4),
+                                      mimetype="application/json")
+
+
+@app.route('/query/cacheStats', methods=['GET'])
+@auth_required
+def cache_stats():
+    """
+    Get the hits, misses and hit rate of the background tile cache.
+    """
+    return current_app.response_class(
+        json.dumps({'background_tiles': backgroundExtract.cache_stats()},
+                   indent=4), mimetype="application/json")
+
+
+@app.route('/query/jobStatus', methods=['GET'])
+@auth_required
+def job_status():
+    """
+    Get the status of a background job (requests with async=True).
+    responses:
+        description: The job status, the number of completed and total
+        chips, the URLs of the generated files and the URL of the result.
+        Without a job id, the number of jobs by status.
+    """
+    if 'job' not in request.args.keys():
+        return job_queue.stats()
+    job = job_queue.get(request.args.get('job'))
+    if job is None:
+        return {"error": "Job not found or expired"}, 404
+    return job.to_dict()
+
+
 @app.route('/static/tmp/<unique_id>/<png_id>')
 # @auth_required
 def statictmp(unique_id, png_id):
@@ -242,18 +336,44 @@ def backgroundByID_query():
         iformat = request.args.get('iformat')
     if 'withGeometry' in request.args.keys():
         if request.args.get('withGeometry') == 'True':
-            withGeometry = [aoi, year, pid, ptype]
+            withGeometry = True
 
     dataset = datasets[f'{aoi}_{year}']
-    lon, lat = db_queries.getParcelCentroid(dataset, pid, ptype)
+    if withGeometry:
+        # The parcel with its geometry for the outline, queried once.
+        pdata = db_queries.getParcelByID(dataset, pid, ptype, True, False)
+        if not pdata or len(pdata) < 2:
+            return {}
+        withGeometry = dict(zip(list(pdata[0]),
+                                [list(i) for i in zip(*pdata[1:])]))
+        lon, lat = withGeometry['clon'][0], withGeometry['clat'][0]
+    else:
+        centroid = db_queries.getParcelCentroid(dataset, pid, ptype)
+        if not centroid:
+            return {}
+        lon, lat = centroid
     unique_id = f"static/tmp/E{lon}N{lat}_{chipsize}_{chipextend}_{tms}".replace('.', '_')
-    data = backgroundExtract.getBackgroundExtract(
-        lon, lat, chipsize, chipextend, unique_id, tms, iformat, withGeometry)
-    if data:
+
+    def work(progress=None):
+        data = backgroundExtract.getBackgroundExtract(
+            lon, lat, chipsize, chipextend, unique_id, tms, iformat,
+            withGeometry)
+        if not data:
+            return None
+        filename = f"{unique_id}/{tms.lower()}.{iformat}"
+        if progress:
+            progress(1, 1, [filename])
+        return filename
+
+    if async_request():
+        return submit_job(('backgroundByParcelID', unique_id, iformat,
+                           bool(withGeometry)), work)
+    filename = work()
+    if filename:
         if 'raw' in request.args.keys() or iformat == 'tif':
-            return f"{unique_id}/{tms.lower()}.{iformat}"
+            return filename
         else:
-            flist = glob.glob(f"{unique_id}/{tms.lower()}.{iformat}")
+            flist = glob.glob(filename)
             full_filename = url_for(
                 'static', filename=flist[0].replace('static/', ''))
             return render_template("bg_page.html", bg_image=full_filename)
@@ -320,42 +440,52 @@ def chipsByParcelID_query():
     pid = request.args.get('pid')
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
-    band = request.args.get('band')
     if 'aoi' in request.args.keys():
         aoi = request.args.get('aoi').lower()
+    if 'lut' in request.args.keys():
+        lut = request.args.get('lut')
+    else:
+        lut = '5_95'
+    if 'bands' in request.args.keys():
+        bands = request.args.get('bands')
+    else:
+        bands = 'B08_B04_B03'
     if 'plevel' in request.args.keys():
         plevel = request.args.get('plevel')
     else:
         plevel = 'LEVEL2A'
-    if 'chipsize' in request.args.keys():
-        chipsize = request.args.get('chipsize')
-    else:
-        chipsize = '1280'
     ptype = ''
     if 'ptype' in request.args.keys():
         if request.args.get('ptype') != '':
             ptype = f"_{request.args.get('ptype')}"
     dataset = datasets[f'{aoi}_{year}']
     pdata = db_queries.getParcelByID(dataset, pid, ptype, False, False)
-    if not pdata:
-        parcel = {}
-    elif len(pdata) == 1:
-        parcel = dict(zip(list(pdata[0]),
-                          [[] for i in range(len(pdata[0]))]))
-    else:
-        parcel = dict(zip(list(pdata[0]),
-                          [list(i) for i in zip(*pdata[1:])]))
+    if not pdata or len(pdata) < 2:
+        return {}
+    parcel = dict(zip(list(pdata[0]), [list(i) for i in zip(*pdata[1:])]))
 
-    lon = str(json.loads(parcel)['clon'][0])
-    lat = str(json.loads(parcel)['clat'][0])
-    unique_id = f"static/tmp/E{lon}N{lat}_{plevel}_{chipsize}_{band}".replace(
+    lon = str(parcel['clon'][0])
+    lat = str(parcel['clat'][0])
+    unique_id = f"static/tmp/E{lon}N{lat}L{lut}_{plevel}_{bands}".replace(
         '.', '_')
-    data = chipS2Extractor.parallelExtract(
-        lon, lat, start_date, end_date, unique_id, band, chipsize, plevel)
-    if data:
-        return send_from_directory(unique_id, 'chipslist.json')
-    else:
+
+    def work(progress=None):
+        data = chipS2Extractor.parallelExtract(
+            lon, lat, start_date, end_date, unique_id, lut, bands, plevel,
+            progress, dataset)
+        if data < 0:
+            raise ValueError("Request results in too many chips")
+        chipS2Extractor.buildHTML(unique_id, start_date, end_date)
+        return f"{unique_id}/chipsview.html"
+
+    if async_request():
+        return submit_job(('chipsByParcelID', unique_id, start_date,
+                           end_date), work)
+    try:
+        work()
+    except ValueError:
         return {}
+    return send_from_directory(unique_id, 'chipsview.html')
 
 
 @app.route('/query/rawChipByLocation', methods=['GET'])
@@ -453,13 +583,14 @@ def rawChipByParcelID_query():
         onlylist = True if request.args.get('onlylist') == 'True' else False
         if onlylist:
             chiplist = creodiasCARDchips.getS2Chips(float(lon), float(
-                lat), start_date, end_date, int(chipsize), plevel)
+                lat), start_date, end_date, int(chipsize), plevel, dataset)
             chiplist = creodiasCARDchips.rinseAndDryS2(chiplist)
             return {'chips': chiplist}
     unique_id = f"static/tmp/E{lon}N{lat}_{plevel}_{chipsize}_{band}".replace(
         '.', '_')
     data = rawChipExtractor.parallelExtract(
-        lon, lat, start_date, end_date, unique_id, band, chipsize, plevel)
+        lon, lat, start_date, end_date, unique_id, band, chipsize, plevel,
+        dataset)
     rawChipExtractor.buildJSON(unique_id, start_date, end_date)
     if data >= 0:
         return send_from_directory(unique_id, 'chipslist.json')
@@ -482,6 +613,7 @@ def rawChipsBatch_query():
     required = ["lon", "lat", "tiles", "bands", "chipsize"]
     if request.is_json:
         params = request.get_json()
+        run_async = async_request(params)
         i = 0
         for k in params.keys():
             if k not in required:
@@ -493,18 +625,26 @@ def rawChipsBatch_query():
     unique_id = f"static/tmp/{params.get('lon')}_{params.get('lat')}_{params.get('chipsize')}_RAW".replace('.', '_')
     logger.info(unique_id)
 
-    if not os.path.exists(unique_id):
-        os.makedirs(unique_id)
-    with open(f"{unique_id}/params.json", "w") as f:
-        logger.info("Dumping params")
-        f.write(json.dumps(params))
-
-    data = rawChipBatchExtract.parallelExtract(unique_id)
-    rawChipBatchExtract.buildJSON(unique_id)
-    if data >= 0:
-        return send_from_directory(unique_id, 'chipslist.json')
-    else:
+    def work(progress=None):
+        if not os.path.exists(unique_id):
+            os.makedirs(unique_id, exist_ok=True)
+        with open(f"{unique_id}/params.json", "w") as f:
+            logger.info("Dumping params")
+            f.write(json.dumps(params))
+        data = rawChipBatchExtract.parallelExtract(unique_id, progress)
+        rawChipBatchExtract.buildJSON(unique_id)
+        if data < 0:
+            raise ValueError("Request results in too many chips")
+        return f"{unique_id}/chipslist.json"
+
+    if run_async:
+        return submit_job(('rawChipsBatch', json.dumps(params, sort_keys=True)),
+                          work)
+    try:
+        work()
+    except ValueError:
         return {}
+    return send_from_directory(unique_id, 'chipslist.json')
 
 
 @app.route('/query/rawS1ChipsBatch', methods=['POST'])
@@ -518,17 +658,19 @@ def rawS1ChipsBatch_query():
     """
     app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
     required = ["lon", "lat", "dates", "chipsize", "plevel"]
+    optional = ["orbit"]
     if request.is_json:
         params = request.get_json()
         i = 0
         for k in params.keys():
-            if k not in required:
+            if k not in required + optional:
                 return {"error": f"{k} not allowed as key"}
-            else:
+            elif k in required:
                 i += 1
         if i != len(required):
             return {"error": f"{i} parameters supplied, {len(required)} required"}
-    unique_id = f"static/tmp/{params.get('lon')}_{params.get('lat')}_{params.get('chipsize')}_{params.get('plevel')}_RAW".replace('.', '_')
+    orbit = f"_{params['orbit'].upper()}" if params.get('orbit') else ''
+    unique_id = f"static/tmp/{params.get('lon')}_{params.get('lat')}_{params.get('chipsize')}_{params.get('plevel')}{orbit}_RAW".replace('.', '_')
     logger.info(unique_id)
 
     if not os.path.exists(unique_id):
@@ -625,30 +767,91 @@ def parcelTimeSeries_query():
         tsformat = True if request.args.get('tsformat') == 'csv' else False
 
     dataset = datasets[f'{aoi}_{year}']
-    if tstype.lower() == 'scl':
-        data = db_queries.getParcelSCL(dataset, pid, ptype)
-    else:
-        data = db_queries.getParcelTimeSeries(dataset, pid, ptype,
-                                              tstype, band, scl, ref)
-    if tsformat:
-        io_file = StringIO()
-        write = csv.writer(io_file, delimiter=',')
-        write.writerows(data)
-        csv_file = make_response(io_file.getvalue())
-        fname = f"filename=timeseries_{aoi}{year}{ptype}_{pid}_{tstype}.csv"
-        csv_file.headers["Content-Disposition"] = f"attachment; {fname}"
-        csv_file.headers["Content-type"] = "text/csv"
-        return csv_file
-    else:
-        if not data:
-            return {}
-        elif len(data) == 1:
-            return dict(zip(list(data[0]),
-                            [[] for i in range(len(data[0]))]))
+
+    def build():
+        if tstype.lower() == 'scl':
+            data = db_queries.getParcelSCL(dataset, pid, ptype)
+        else:
+            data = db_queries.getParcelTimeSeries(dataset, pid, ptype,
+                                                  tstype, band, scl, ref)
+        if tsformat:
+            io_file = StringIO()
+            write = csv.writer(io_file, delimiter=',')
+            write.writerows(data)
+            csv_file = make_response(io_file.getvalue())
+            fname = f"filename=timeseries_{aoi}{year}{ptype}_{pid}_{tstype}.csv"
+            csv_file.headers["Content-Disposition"] = f"attachment; {fname}"
+            csv_file.mimetype = "text/csv"
+            return csv_file
         else:
-            return json.dumps(dict(zip(list(data[0]),
-                                       [list(i) for i in zip(*data[1:])])),
-                              cls=CustomJsonEncoder)
+            if not data:
+                return {}
+            elif len(data) == 1:
+                return dict(zip(list(data[0]),
+                                [[] for i in range(len(data[0]))]))
+            else:
+                return json.dumps(dict(zip(list(data[0]),
+                                           [list(i) for i in zip(*data[1:])])),
+                                  cls=CustomJsonEncoder)
+
+    key = (aoi, year, pid, ptype, tstype, band, scl, ref, tsformat)
+    return cached_response(key, dataset, build)
+
+
+@app.route('/query/parcelsTimeSeries', methods=['POST'])
+@auth_required
+def parcelsTimeSeries_query():
+    """
+    Get the time series of many parcels with post request.
+    The parcels are selected by a list of 'pids', a 'polygon' (list of
+    [lon, lat] pairs) or a 'filter' on the parcel columns.
+    responses:
+        description: The time series rows streamed as ndjson (default),
+        csv or arrow (Apache Arrow IPC stream).
+    """
+    allowed = ["aoi", "year", "pids", "polygon", "filter", "ptype",
+               "tstype", "band", "scl", "format"]
+    if not request.is_json:
+        return {"error": "A JSON body is required"}
+    params = request.get_json()
+    for k in params.keys():
+        if k not in allowed:
+            return {"error": f"{k} not allowed as key"}
+    if not any(k in params for k in ["pids", "polygon", "filter"]):
+        return {"error": "One of pids, polygon or filter is required"}
+
+    aoi = params.get('aoi', DEFAULT_AOI).lower()
+    year = params.get('year')
+    if not users.data_auth(aoi, user):
+        return make_response(
+            """Not authorized for this dataset.
+            Please contact the system administrator.""", 401)
+    ptype = f"_{params['ptype']}" if params.get('ptype') else ''
+    tstype = params.get('tstype', 's2')
+    scl = params.get('scl', True) if tstype.lower() == 's2' else False
+    oformat = params.get('format', 'ndjson')
+    if not stream_formats.available(oformat):
+        return {"error": f"{oformat} format is not supported"}, 400
+
+    dataset = datasets[f'{aoi}_{year}']
+    chunks = db_queries.getParcelsTimeSeries(
+        dataset, params.get('pids'), params.get('polygon'),
+        params.get('filter'), ptype, tstype, params.get('band'), scl)
+    try:
+        description = next(chunks)
+    except StopIteration:
+        return {}
+    except ValueError as err:
+        return {"error": str(err)}
+    except Exception:
+        return {"error": "Could not get the time series"}, 500
+    columns = [c.name for c in description]
+    types = [c.type_code for c in description]
+
+    encode = stream_formats.ENCODERS[oformat]
+    return current_app.response_class(
+        stream_with_context(encode(columns, chunks, types)),
+        mimetype=stream_formats.MIMETYPES[oformat])
 
 
 @app.route('/query/weatherTimeSeries', methods=['GET'])
@@ -671,26 +874,33 @@ def meteo():
     if 'tsformat' in request.args.keys():
         tsformat = True if request.args.get('tsformat') == 'csv' else False
     dataset = datasets[f'{aoi}_{year}']
-    data = db_queries.getParcelWeatherTS(dataset, pid, ptype)
-    if tsformat:
-        io_file = StringIO()
-        write = csv.writer(io_file, delimiter=',')
-        write.writerows(data)
-        csv_file = make_response(io_file.getvalue())
-        fname = f"filename=timeseries_{aoi}{year}{ptype}_{pid}_WeatherTS.csv"
-        csv_file.headers["Content-Disposition"] = f"attachment; {fname}"
-        csv_file.headers["Content-type"] = "text/csv"
-        return csv_file
-    else:
-        if not data:
-            return {}
-        elif len(data) == 1:
-            return dict(zip(list(data[0]),
-                            [[] for i in range(len(data[0]))]))
+
+    def build():
+        data = db_queries.getParcelWeatherTS(dataset, pid, ptype)
+        if tsformat:
+            io_file = StringIO()
+            write = csv.writer(io_file, delimiter=',')
+            write.writerows(data)
+            csv_file = make_response(io_file.getvalue())
+            fname = f"filename=timeseries_{aoi}{year}{ptype}_{pid}_WeatherTS.csv"
+            csv_file.headers["Content-Disposition"] = f"attachment; {fname}"
+            csv_file.mimetype = "text/csv"
+            return csv_file
         else:
-            return json.dumps(dict(zip(list(data[0]),
-                                       [list(i) for i in zip(*data[1:])])),
-                              cls=CustomJsonEncoder)
+            if not data:
+                return {}
+            elif len(data) == 1:
+                return dict(zip(list(data[0]),
+                                [[] for i in range(len(data[0]))]))
+            else:
+                return json.dumps(dict(zip(list(data[0]),
+                                           [list(i) for i in zip(*data[1:])])),
+                                  cls=CustomJsonEncoder)
+
+    # Versioned by the ERA5 loads, not by the image extraction.
+    key = (aoi, year, 'weather', pid, ptype, tsformat)
+    return cached_response(key, dataset, build,
+                           db_queries.getWeatherVersion, 3)
 
 
 # -------- Queries - Parcel information -------------------------------------- #
@@ -6,8 +6,14 @@
 
     Author: Guido Lemoine, European Commission, Joint Research Centre
     License: see git repository
-    Version 1.2 - 2021-04-14
+    Version 1.3 - 2021-06-01
 
+    Revisions in 1.3: by Konstantinos Anastasakis
+    - Local tile cache, the WMTS tiles are fetched once and composed from
+      the local disk, the TMS datasets and the coordinate transformation are
+      kept open between the requests
+    - The parcel outline is drawn in the image array before it is written
+      (no matplotlib figures)
     Revisions in 1.2: by Konstantinos Anastasakis
     - Updates: pep8 code style paths and html handling
     Revisions in 1.1:
@@ -19,13 +25,200 @@
 import os
 import glob
 import math
+import tempfile
+import threading
 import numpy as np
+from functools import lru_cache
 import logging
 import rasterio as rio
 from rasterio.windows import Window
 from rasterio.transform import Affine
+from rasterio.warp import reproject, Resampling
+from rasterio.features import rasterize
 from osgeo import osr, ogr
 
+TILE_CACHE = 'tile_cache'  # Folder of the local tile cache.
+TILE_CACHE_SIZE = 2  # Size budget of the tile cache in GB.
+TILE_SIZE = 256  # Pixels of the WMTS tiles (BlockSizeX/Y of the xml files).
+EVICT_INTERVAL = 100  # Check the size of the cache every n new tiles.
+OUTLINE_COLOR = (255, 255, 0)  # Color of the parcel outline (yellow).
+OUTLINE_WIDTH = 2  # Width of the parcel outline in pixels.
+
+_datasets = {}  # Open TMS datasets and their locks.
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'evicted': 0, 'new': 0}
+
+
+@lru_cache(maxsize=1)
+def to_web_mercator():
+    """Get the (cached) transformation from EPSG:4326 to EPSG:3857."""
+    source = osr.SpatialReference()
+    source.ImportFromEPSG(4326)
+    target = osr.SpatialReference()
+    target.ImportFromEPSG(3857)
+    return source, osr.CoordinateTransformation(source, target)
+
+
+def tms_dataset(tms):
+    """Get the open dataset of a TMS xml file and its lock, the datasets
+    are kept open for the next requests."""
+    with _lock:
+        if tms not in _datasets:
+            _datasets[tms] = (rio.open(f"config/tms/{tms}.xml"),
+                              threading.Lock())
+        return _datasets[tms]
+
+
+def cache_stats():
+    """Get the hits and misses of the tile cache."""
+    total = _stats['hits'] + _stats['misses']
+    return dict(_stats, hit_rate=round(_stats['hits'] / total, 3)
+                if total else None)
+
+
+def evict_tiles():
+    """Remove the least recently used tiles over the cache size budget."""
+    entries = []
+    for root, dirs, files in os.walk(TILE_CACHE):
+        for f in files:
+            path = os.path.join(root, f)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    total = sum(e[1] for e in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= TILE_CACHE_SIZE * 1024**3:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            _stats['evicted'] += 1
+        except OSError:
+            pass
+
+
+def read_tile(tms, dataset, lock, level, row, col):
+    """Get a tile of a zoom level (as overview level of the TMS dataset),
+    from the tile cache or from the tile server."""
+    path = f"{TILE_CACHE}/{tms}/{level}/{row}_{col}.npy"
+    if os.path.isfile(path):
+        try:
+            tile = np.load(path)
+            os.utime(path)  # Most recently used.
+            _stats['hits'] += 1
+            return tile
+        except (OSError, ValueError):
+            pass  # Evicted or incomplete.
+    size = TILE_SIZE * 2**level
+    if not (0 <= row * size < dataset.height and
+            0 <= col * size < dataset.width):
+        # Outside of the tile matrix.
+        return np.zeros((dataset.count, TILE_SIZE, TILE_SIZE),
+                        dtype=dataset.profile['dtype'])
+    with lock:
+        tile = dataset.read(window=Window(col * size, row * size,
+                                          size, size),
+                            out_shape=(dataset.count, TILE_SIZE, TILE_SIZE))
+    _stats['misses'] += 1
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, tile)
+    os.replace(tmp, path)
+    _stats['new'] += 1
+    if _stats['new'] % EVICT_INTERVAL == 0:
+        evict_tiles()
+    return tile
+
+
+def read_extract(tms, west, south, east, north, chipSize):
+    """Compose an extract of a TMS from the tiles of the zoom level with
+    the nearest finer resolution."""
+    dataset, lock = tms_dataset(tms)
+    res = (east - west) / chipSize
+    level = int(math.floor(math.log2(max(res / dataset.res[0], 1))))
+    level = min(level, len(dataset.overviews(1)))
+    tile_res = dataset.res[0] * 2**level
+    tile_extend = TILE_SIZE * tile_res
+    x0, y0 = dataset.transform.c, dataset.transform.f
+    col0 = int(math.floor((west - x0) / tile_extend))
+    col1 = int(math.floor((east - x0) / tile_extend))
+    row0 = int(math.floor((y0 - north) / tile_extend))
+    row1 = int(math.floor((y0 - south) / tile_extend))
+
+    mosaic = np.zeros((dataset.count, (row1 - row0 + 1) * TILE_SIZE,
+                       (col1 - col0 + 1) * TILE_SIZE),
+                      dtype=dataset.profile['dtype'])
+    for row in range(row0, row1 + 1):
+        for col in range(col0, col1 + 1):
+            r, c = (row - row0) * TILE_SIZE, (col - col0) * TILE_SIZE
+            mosaic[:, r:r + TILE_SIZE, c:c + TILE_SIZE] = read_tile(
+                tms, dataset, lock, level, row, col)
+    logging.debug(f"Tile cache {cache_stats()}")
+
+    output_dataset = np.zeros((dataset.count, chipSize, chipSize),
+                              dtype=dataset.profile['dtype'])
+    reproject(mosaic, output_dataset,
+              src_transform=Affine(tile_res, 0, x0 + col0 * tile_extend,
+                                   0, -tile_res, y0 - row0 * tile_extend),
+              dst_transform=Affine(res, 0, west, 0, -res, north),
+              src_crs='EPSG:3857', dst_crs='EPSG:3857',
+              resampling=Resampling.nearest)
+    return output_dataset, dataset.count, dataset.profile['dtype']
+
+
+def parcel_parts(withGeometry):
+    """Get the parcel record with the geometry, withGeometry is the parcel
+    record of db_queries.getParcelByID or [aoi, year, pid, ptype]."""
+    if isinstance(withGeometry, dict):
+        return withGeometry
+    from scripts import db_queries
+    datasets = db_queries.get_datasets()
+    aoi, year, pid, ptype = withGeometry
+    dataset = datasets[f'{aoi}_{year}']
+    pdata = db_queries.getParcelByID(dataset, pid, ptype, True, False)
+    if len(pdata) == 1:
+        return dict(zip(list(pdata[0]), [[] for i in range(len(pdata[0]))]))
+    return dict(zip(list(pdata[0]), [list(i) for i in zip(*pdata[1:])]))
+
+
+def outline_mask(geom, transform, shape, width=OUTLINE_WIDTH):
+    """Rasterize the rings of a (multi)polygon GeoJSON geometry as lines of
+    width pixels."""
+    if geom['type'] == 'Polygon':
+        rings = geom['coordinates']
+    else:
+        rings = [r for polygon in geom['coordinates'] for r in polygon]
+    mask = rasterize([{'type': 'MultiLineString', 'coordinates': rings}],
+                     out_shape=shape, transform=transform, fill=0,
+                     all_touched=True, dtype='uint8').astype(bool)
+    outline = mask.copy()
+    for i in range(1, width):
+        outline[i:, :] |= mask[:-i, :]
+        outline[:, i:] |= mask[:, :-i]
+    return outline
+
+
+def draw_outline(image, parcel, transform):
+    """Draw the parcel outline in the image array (bands, rows, cols).
+
+    The image is not changed if the parcel has no geometry or the geometry
+    could not be transformed to EPSG:3857.
+    """
+    from scripts import spatial_utils
+    if not parcel.get('geom'):
+        return image
+    geom = spatial_utils.transform_geometry(parcel, 3857)['geom'][0]
+    if not isinstance(geom, dict):
+        # transform_geometry returns the source (GeoJSON string) on failure.
+        return image
+    mask = outline_mask(geom, transform, image.shape[1:])
+    for band, value in zip(image, OUTLINE_COLOR):
+        band[mask] = value
+    return image
+
 
 def getBackgroundExtract(lon, lat, chipSize, chipExtend, unique_dir,
                          tms="Google", iformat='tif', withGeometry=False):
@@ -39,6 +232,9 @@ def getBackgroundExtract(lon, lat, chipSize, chipExtend, unique_dir,
         unique_dir (str): the path for the file to be stored
         tms (str): tile map server
         iformat (str): File format '.tif' or '.png'
+        withGeometry: draw the parcel outline on png images, the parcel
+            record of db_queries.getParcelByID (with the geometry) or
+            [aoi, year, pid, ptype]
     """
     lon, lat = float(lon), float(lat)
     chipSize = int(chipSize)
@@ -61,104 +257,54 @@ def getBackgroundExtract(lon, lat, chipSize, chipExtend, unique_dir,
 
     point = ogr.Geometry(ogr.wkbPoint)
     point.AddPoint(lon, lat)
-    source = osr.SpatialReference()
-    source.ImportFromEPSG(4326)
+    source, transform = to_web_mercator()
 
     # Assign this projection to the geometry
     point.AssignSpatialReference(source)
-    target = osr.SpatialReference()
-    target.ImportFromEPSG(3857)
-    transform = osr.CoordinateTransformation(source, target)
 
     # Reproject the point geometry to image projection
-    point.Transform(transform)
+    with _lock:
+        point.Transform(transform)
     west = point.GetX() - chipExtend / 2
     east = point.GetX() + chipExtend / 2
     south = point.GetY() - chipExtend / 2
     north = point.GetY() + chipExtend / 2
 
     if os.path.isfile(f"config/tms/{tms.lower()}.xml"):
-        with rio.open(f"config/tms/{tms.lower()}.xml") as TMS_dataset:
-            bl = TMS_dataset.index(west, south, op=math.floor)
-            tr = TMS_dataset.index(east, north, op=math.ceil)
-
-            window = Window(bl[1], tr[0], tr[1] - bl[1], bl[0] - tr[0])
-
-            # image_size is a tuple (num_bands, h, w)
-            output_dataset = np.empty(shape=(
-                TMS_dataset.count, chipSize, chipSize),
-                dtype=TMS_dataset.profile['dtype'])
-
-            # Read all bands
-            TMS_dataset.read(out=output_dataset, window=window)
-
-            res = float(chipExtend) / chipSize
-            transform = Affine.translation(
-                west + res / 2, north - res / 2) * Affine.scale(res, -res)
-
-            if iformat == 'tif':
-                chipset = rio.open(f"{unique_dir}/{tms.lower()}.tif", 'w',
-                                   driver='GTiff',
-                                   width=output_dataset.shape[2],
-                                   height=output_dataset.shape[1],
-                                   count=TMS_dataset.count,
-                                   crs=3857,
-                                   transform=transform,
-                                   dtype=TMS_dataset.profile['dtype']
-                                   )
-            elif iformat == 'png':
-                chipset = rio.open(f"{unique_dir}/{tms.lower()}.png", 'w',
-                                   driver='PNG',
-                                   width=output_dataset.shape[2],
-                                   height=output_dataset.shape[1],
-                                   count=TMS_dataset.count,
-                                   crs=3857,
-                                   transform=transform,
-                                   dtype=TMS_dataset.profile['dtype']
-                                   )
-            else:
-                return False
-            chipset.write(output_dataset)
-            chipset.close()
-            if withGeometry and iformat == 'png':
-                from copy import copy
-                from rasterio.plot import show
-                import matplotlib.pyplot as plt
-                from descartes import PolygonPatch
-
-                from scripts import spatial_utils
-                from scripts import db_queries
-
-                def overlay_parcel(img, geom):
-                    """Create parcel polygon overlay"""
-                    patche = [PolygonPatch(feature, edgecolor="yellow",
-                                           facecolor="none", linewidth=2
-                                           ) for feature in geom['geom']]
-                    return patche
-                datasets = db_queries.get_datasets()
-                aoi, year, pid, ptype = withGeometry
-                dataset = datasets[f'{aoi}_{year}']
-                pdata = db_queries.getParcelByID(dataset, pid, ptype,
-                                                 withGeometry, False)
-                if len(pdata) == 1:
-                    parcel = dict(zip(list(pdata[0]),
-                                      [[] for i in range(len(pdata[0]))]))
-                else:
-                    parcel = dict(zip(list(pdata[0]),
-                                      [list(i) for i in zip(*pdata[1:])]))
-
-                with rio.open(f"{unique_dir}/{tms.lower()}.png") as img:
-                    geom = spatial_utils.transform_geometry(parcel, 3857)
-                    patches = overlay_parcel(img, geom)
-                    for patch in patches:
-                        fig = plt.figure()
-                        ax = fig.gca()
-                        plt.axis('off')
-                        plt.box(False)
-                        ax.add_patch(copy(patch))
-                        show(img, ax=ax)
-                        plt.savefig(f"{unique_dir}/{tms.lower()}.png",
-                                    bbox_inches='tight')
-            return True
+        output_dataset, count, dtype = read_extract(
+            tms.lower(), west, south, east, north, chipSize)
+
+        res = float(chipExtend) / chipSize
+        if withGeometry and iformat == 'png':
+            draw_outline(output_dataset, parcel_parts(withGeometry),
+                         Affine(res, 0, west, 0, -res, north))
+        transform = Affine.translation(
+            west + res / 2, north - res / 2) * Affine.scale(res, -res)
+
+        if iformat == 'tif':
+            chipset = rio.open(f"{unique_dir}/{tms.lower()}.tif", 'w',
+                               driver='GTiff',
+                               width=output_dataset.shape[2],
+                               height=output_dataset.shape[1],
+                               count=count,
+                               crs=3857,
+                               transform=transform,
+                               dtype=dtype
+                               )
+        elif iformat == 'png':
+            chipset = rio.open(f"{unique_dir}/{tms.lower()}.png", 'w',
+                               driver='PNG',
+                               width=output_dataset.shape[2],
+                               height=output_dataset.shape[1],
+                               count=count,
+                               crs=3857,
+                               transform=transform,
+                               dtype=dtype
+                               )
+        else:
+            return False
+        chipset.write(output_dataset)
+        chipset.close()
+        return True
     else:
         return False
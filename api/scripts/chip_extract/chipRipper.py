@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" chipRipper.py -- Extract chips from the imagery in S3 object storage,
+        in the API process (see chiptools.runjobs).
+        Essential part of DIAS functionality for CAP Checks by Monitoring
+    Author: Konstantinos Anastasakis, European Commission, Joint Research Centre
+    License: see git repository
+    Version 1.1
+
+    Replaces the docker run rawChipRipper.py, rawChipRipper2.py,
+    chipRipper2.py and rawS1ChipRipper.py jobs on the remote VMs. Only the
+    chip window is read from the scenes through GDAL '/vsis3/' and the chips
+    are written directly to the request folder, with the same file names.
+
+    Revisions:
+    1.1: Chips are placed from the shared chip store (see chip_store.py),
+         only the chips missing from the store are extracted.
+"""
+
+import os
+import json
+import logging
+import tempfile
+from functools import lru_cache
+
+import boto3
+import numpy as np
+import rasterio
+from rasterio.session import AWSSession
+from rasterio.warp import transform as warp_transform
+from rasterio.windows import from_bounds, Window
+
+from scripts.chip_extract import chip_store
+
+S3_CONFIG = 'config/main.json'
+RESOLUTIONS = ('10m', '20m', '60m')  # Preferred S2 band resolutions.
+
+
+@lru_cache(maxsize=1)
+def s3_config():
+    with open(S3_CONFIG) as f:
+        return json.load(f)['s3']
+
+
+@lru_cache(maxsize=1)
+def s3_client():
+    conf = s3_config()
+    session = boto3.session.Session(aws_access_key_id=conf['access_key'],
+                                    aws_secret_access_key=conf['secret_key'])
+    return session, session.client('s3', endpoint_url=conf['host'])
+
+
+def s3_env():
+    """A rasterio environment to read '/vsis3/' paths of the DIAS bucket."""
+    conf = s3_config()
+    host = conf['host'].replace('http://', '').replace('https://', '')
+    session, client = s3_client()
+    return rasterio.Env(AWSSession(session), AWS_S3_ENDPOINT=host,
+                        AWS_HTTPS='YES' if conf['host'].startswith('https')
+                        else 'NO', AWS_VIRTUAL_HOSTING=False)
+
+
+@lru_cache(maxsize=256)
+def list_keys(prefix):
+    """List the keys of a product in the bucket (cached per process)."""
+    session, client = s3_client()
+    keys = []
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=s3_config()['bucket'],
+                                   Prefix=prefix):
+        keys.extend(o['Key'] for o in page.get('Contents', []))
+    return tuple(keys)
+
+
+def s2_key(reference, band):
+    """Get the S3 key of a S2 band, the best available resolution."""
+    reference = reference.replace('.SAFE', '')
+    parts = reference.split('_')
+    obstime = parts[2][0:8]
+    level = 'L1C' if 'MSIL1C' in parts[1] else 'L2A'
+    prefix = (f"Sentinel-2/MSI/{level}/{obstime[0:4]}/{obstime[4:6]}/"
+              f"{obstime[6:8]}/{reference}.SAFE/GRANULE/")
+    keys = [k for k in list_keys(prefix) if k.endswith('.jp2') and
+            '/IMG_DATA/' in k]
+    if level == 'L1C':
+        found = [k for k in keys if k.endswith(f"_{band}.jp2")]
+    else:
+        found = []
+        for res in RESOLUTIONS:
+            found = [k for k in keys if k.endswith(f"_{band}_{res}.jp2")]
+            if found:
+                break
+    if not found:
+        raise FileNotFoundError(f"{band} of {reference} not found")
+    return found[0]
+
+
+def s1_key(reference, polarization, plevel='CARD-BS'):
+    """Get the S3 key of a S1 CARD polarization image."""
+    if reference.endswith('CARD_BS'):
+        obstime = reference.split('_')[4][0:8]
+    else:
+        obstime = reference.split('_')[1][0:8]
+    prefix = (f"Sentinel-1/SAR/{plevel}/{obstime[0:4]}/{obstime[4:6]}/"
+              f"{obstime[6:8]}/{reference}/")
+    found = [k for k in list_keys(prefix) if polarization in k.split('/')[-1]
+             and k.endswith(('.img', '.tif'))]
+    if not found:
+        raise FileNotFoundError(f"{polarization} of {reference} not found")
+    return found[0]
+
+
+def chip_window(src, lon, lat, chipsize):
+    """Get the pixel window of a chipsize (meters) chip centred on lon, lat.
+    """
+    xs, ys = warp_transform('EPSG:4326', src.crs, [float(lon)], [float(lat)])
+    half = float(chipsize) / 2
+    w = from_bounds(xs[0] - half, ys[0] - half, xs[0] + half, ys[0] + half,
+                    src.transform)
+    # Snap to the pixel grid of the image.
+    return Window(round(w.col_off), round(w.row_off), round(w.width),
+                  round(w.height))
+
+
+def open_image(key):
+    return rasterio.open(f"/vsis3/{s3_config()['bucket']}/{key}")
+
+
+def read_chip(src, window):
+    """Read the chip window of an image.
+
+    Returns:
+        The chip array and the rasterio profile for a GeoTIFF.
+    """
+    data = src.read(1, window=window, boundless=True, fill_value=0)
+    profile = {'driver': 'GTiff', 'count': 1, 'dtype': data.dtype,
+               'width': window.width, 'height': window.height,
+               'crs': src.crs, 'transform': src.window_transform(window),
+               'nodata': 0}
+    return data, profile
+
+
+def store_chip(path, key, window, chipsize, write, options=''):
+    """Place a chip at path from the chip store, write(path) extracts the
+    chip if it is not stored (or the store is disabled)."""
+    store = chip_store.default()
+    if store is None:
+        return write(path)
+    return store.fetch(chip_store.chip_key(key, window, chipsize, options),
+                       path, write)
+
+
+def tif_chip(path, key, lon, lat, chipsize):
+    """GeoTIFF chip of an image."""
+    with open_image(key) as src:
+        window = chip_window(src, lon, lat, chipsize)
+        return store_chip(path, key, window, chipsize,
+                          lambda p: write_file(p, *read_chip(src, window)))
+
+
+def write_file(path, data, profile):
+    """Write an image to path atomically (temporary file and rename)."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                               suffix=os.path.splitext(path)[1])
+    os.close(fd)
+    try:
+        with rasterio.open(tmp, 'w', **profile) as dst:
+            dst.write(data if data.ndim == 3 else data[np.newaxis, ...])
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return path
+
+
+def raw_chip(lon, lat, reference, unique_dir, band, chipsize,
+             plevel='LEVEL2A'):
+    """GeoTIFF chip of a S2 band, as rawChipRipper.py."""
+    return tif_chip(os.path.join(
+        unique_dir, reference.replace('SAFE', f'{band}.tif')),
+        s2_key(reference, band), lon, lat, chipsize)
+
+
+def raw_batch_chip(lon, lat, chip, unique_dir, chipsize):
+    """GeoTIFF chip of a '{tile}.{band}' chip, as rawChipRipper2.py."""
+    reference, band = chip.rsplit('.', 1)
+    return tif_chip(os.path.join(unique_dir, f"{chip}.tif"),
+                    s2_key(reference, band), lon, lat, chipsize)
+
+
+def png_chip(lon, lat, reference, unique_dir, lut='5_95',
+             bands='B08_B04_B03', plevel='LEVEL2A', chipsize=1280):
+    """Stretched 3 band PNG composite, as chipRipper2.py.
+
+    lut is the lower and upper percentile of the stretch of each band.
+    """
+    keys = [s2_key(reference, band) for band in bands.split('_')]
+    with open_image(keys[0]) as src:
+        window = chip_window(src, lon, lat, chipsize)
+    return store_chip(os.path.join(unique_dir, f"{reference}.png"),
+                      ' '.join(keys), window, chipsize,
+                      lambda p: write_png(p, keys, lon, lat, chipsize, lut),
+                      lut)
+
+
+def write_png(path, keys, lon, lat, chipsize, lut):
+    low, high = [float(v) for v in lut.split('_')]
+    layers = []
+    for key in keys:
+        with open_image(key) as src:
+            data, profile = read_chip(src, chip_window(src, lon, lat,
+                                                       chipsize))
+        if layers and data.shape != layers[0].shape:
+            # Nearest neighbour resampling of 20 m bands to the 10 m grid.
+            rows = np.arange(layers[0].shape[0]) * data.shape[0] // \
+                layers[0].shape[0]
+            cols = np.arange(layers[0].shape[1]) * data.shape[1] // \
+                layers[0].shape[1]
+            data = data[rows][:, cols]
+        valid = data[data > 0]
+        if valid.size:
+            lo, hi = np.percentile(valid, (low, high))
+        else:
+            lo, hi = 0, 1
+        layers.append(np.clip(255 * (data.astype('float32') - lo) /
+                              max(hi - lo, 1), 0, 255).astype('uint8'))
+    image = np.stack(layers)
+    profile = {'driver': 'PNG', 'count': image.shape[0], 'dtype': 'uint8',
+               'width': image.shape[2], 'height': image.shape[1]}
+    return write_file(path, image, profile)
+
+
+def raw_s1_chip(lon, lat, reference, unique_dir, chipsize,
+                plevel='CARD-BS'):
+    """GeoTIFF chips of the VV and VH images, as rawS1ChipRipper.py."""
+    files = []
+    for pol in ('VV', 'VH'):
+        files.append(tif_chip(os.path.join(
+            unique_dir, f"{reference}_{pol}.tif"),
+            s1_key(reference, pol, plevel), lon, lat, chipsize))
+    return files
+
+
+RIPPERS = {
+    'rawChipRipper.py': raw_chip,
+    'rawChipRipper2.py': raw_batch_chip,
+    'chipRipper2.py': png_chip,
+    'rawS1ChipRipper.py': raw_s1_chip
+}
+
+
+def run(script, lon, lat, reference, unique_dir, args):
+    """Run the chip extraction of a ripper script with its command line
+    arguments (as the remote 'docker run ... python {script}' jobs)."""
+    with s3_env():
+        try:
+            return RIPPERS[script](lon, lat, reference, unique_dir,
+                                   *str(args).split())
+        except Exception as err:
+            logging.debug(f"{script} {reference} failed: {err}")
+            raise
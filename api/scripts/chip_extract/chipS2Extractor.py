@@ -32,13 +32,13 @@ logging.basicConfig(
 
 
 def parallelExtract(lon, lat, start_date, end_date, unique_dir,
-                    lut, bands, plevel):
+                    lut, bands, plevel, progress=None, dataset=None):
     start = time.time()
     logging.debug(start)
     # Read in chip list, make sure to skip duplicates that have least complete
     # overlap or lower version numbers
     chiplist = creodiasCARDchips.getS2Chips(
-        float(lon), float(lat), start_date, end_date, 1280, plevel)
+        float(lon), float(lat), start_date, end_date, 1280, plevel, dataset)
     chiplist = creodiasCARDchips.rinseAndDryS2(chiplist)
     logging.debug("INITIAL CHIPS")
     logging.debug(chiplist)
@@ -63,12 +63,12 @@ def parallelExtract(lon, lat, start_date, end_date, unique_dir,
         logging.debug(f"Creating {unique_dir} on host")
         os.makedirs(unique_dir)
     logging.debug(f"Processing {len(chiplist)} chips")
-    if len(chiplist) > 24:
+    if len(chiplist) > chiptools.max_chips(24):
         print("Request results in too many chips, please revise selection")
         logging.debug("Too many chips requested")
         return -1
     chiptools.runjobs(chiplist, lon, lat, unique_dir,
-                      'chipRipper2.py', f'{lut} {bands} {plevel}')
+                      'chipRipper2.py', f'{lut} {bands} {plevel}', progress)
 
     logging.debug(f"Generated {len(chiplist)} chips")
     chiptools.chipCollect(unique_dir, 'png')  # Collect the generate chips
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" chip_store.py -- Shared store of the extracted chips.
+        Essential part of DIAS functionality for CAP Checks by Monitoring
+    Author: Konstantinos Anastasakis, European Commission, Joint Research Centre
+    License: see git repository
+    Version 1.0
+
+    Chips are stored once, by the hash of the image (S3 key of the scene
+    band), the pixel window snapped to the image grid, the chip size and the
+    rendering options (e.g. the lut of the PNG composites). The same chip
+    requested with a different request folder (unique_dir), from another
+    endpoint or by another user is not extracted again, the request folders
+    get hard links (or copies) of the stored files.
+
+    The index is a sqlite database in the store folder, shared by the chip
+    engine processes. The links (and copies) placed in the request folders
+    are recorded with their chip. When the store grows over its size budget
+    the least recently used chips are removed, together with their links,
+    so that their disk blocks are freed.
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import sqlite3
+import logging
+import tempfile
+import threading
+from contextlib import closing
+
+STORE_DIR = 'static/chips'  # Folder of the chip store ('' to disable).
+STORE_SIZE = 10  # Size budget in GB.
+INDEX = 'index.sqlite'
+
+_stores = {}
+_lock = threading.Lock()
+
+
+def chip_key(image, window, chipsize, options=''):
+    """Get the store key of a chip.
+
+    Arguments:
+        image, the S3 key(s) of the scene band(s)
+        window, the rasterio Window of the chip on the image grid
+        chipsize, the chip size in meters
+        options, the rendering options of the chip file
+    """
+    window = (int(window.col_off), int(window.row_off),
+              int(window.width), int(window.height))
+    return hashlib.sha256(
+        f"{image}|{window}|{chipsize}|{options}".encode()).hexdigest()
+
+
+class ChipStore:
+    """A content addressed chip store with a sqlite index and LRU eviction."""
+
+    def __init__(self, directory=STORE_DIR, size=STORE_SIZE):
+        self.directory = directory
+        self.max_bytes = int(float(size) * 1024**3)
+        os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS chips (
+                key text PRIMARY KEY, path text, size integer, used real)""")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS chips_used ON chips (used)")
+            # Files placed in the request folders, size is 0 for hard links.
+            conn.execute("""CREATE TABLE IF NOT EXISTS links (
+                path text PRIMARY KEY, key text, size integer)""")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS links_key ON links (key)")
+
+    def _connect(self):
+        # A connection per call, the index is shared by the worker processes.
+        conn = sqlite3.connect(os.path.join(self.directory, INDEX),
+                               timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def path(self, key, ext):
+        return os.path.join(self.directory, key[:2], f"{key}{ext}")
+
+    def get(self, key):
+        """Get the path of a stored chip, None if it is not stored."""
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT path FROM chips WHERE key = ?",
+                               (key,)).fetchone()
+            if row is None:
+                return None
+            if not os.path.isfile(row[0]):
+                conn.execute("DELETE FROM chips WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE chips SET used = ? WHERE key = ?",
+                         (time.time(), key))
+            return row[0]
+
+    def put(self, key, ext, write):
+        """Store a chip, write(path) writes the chip file to path."""
+        path = self.path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=ext)
+        os.close(fd)
+        try:
+            write(tmp)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        with closing(self._connect()) as conn:
+            conn.execute("INSERT OR REPLACE INTO chips VALUES (?, ?, ?, ?)",
+                         (key, path, os.path.getsize(path), time.time()))
+        self.evict(keep=key)
+        return path
+
+    def fetch(self, key, localfile, write):
+        """Place the stored chip at localfile, extract it on a miss.
+
+        Returns:
+            localfile
+        """
+        ext = os.path.splitext(localfile)[1]
+        # The chip can be evicted by another process between get and link,
+        # it is then stored again.
+        for _ in range(2):
+            path = self.get(key)
+            if path is None:
+                path = self.put(key, ext, write)
+            else:
+                logging.debug(f"{localfile} from the chip store")
+            if os.path.exists(localfile):
+                os.remove(localfile)
+            try:
+                os.link(path, localfile)
+                size = 0
+            except FileNotFoundError:
+                continue
+            except OSError:
+                try:
+                    shutil.copyfile(path, localfile)
+                except FileNotFoundError:
+                    continue
+                size = os.path.getsize(localfile)
+            with closing(self._connect()) as conn:
+                conn.execute("INSERT OR REPLACE INTO links VALUES (?, ?, ?)",
+                             (localfile, key, size))
+            if size:
+                self.evict(keep=key)
+            return localfile
+        return write(localfile)
+
+    def size(self):
+        """Get the total size of the stored chips and copies in bytes."""
+        with closing(self._connect()) as conn:
+            return self._total(conn)
+
+    def _total(self, conn):
+        return conn.execute(
+            """SELECT (SELECT coalesce(sum(size), 0) FROM chips) +
+                      (SELECT coalesce(sum(size), 0) FROM links)"""
+        ).fetchone()[0]
+
+    def evict(self, keep=None):
+        """Remove the least recently used chips and their links until the
+        store fits the size budget. The chip 'keep' is never removed."""
+        with closing(self._connect()) as conn:
+            total = self._total(conn)
+            if total <= self.max_bytes:
+                return
+            rows = conn.execute(
+                "SELECT key, path, size FROM chips ORDER BY used").fetchall()
+            for key, path, size in rows:
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                links = conn.execute(
+                    "SELECT path, size FROM links WHERE key = ?",
+                    (key,)).fetchall()
+                for link, link_size in links + [(path, size)]:
+                    try:
+                        os.remove(link)
+                    except OSError:
+                        pass
+                    total -= link_size
+                conn.execute("DELETE FROM links WHERE key = ?", (key,))
+                conn.execute("DELETE FROM chips WHERE key = ?", (key,))
+
+
+def default():
+    """Get the chip store of the process, None if it is disabled."""
+    if not STORE_DIR:
+        return None
+    with _lock:
+        if STORE_DIR not in _stores:
+            _stores[STORE_DIR] = ChipStore(STORE_DIR, STORE_SIZE)
+        return _stores[STORE_DIR]
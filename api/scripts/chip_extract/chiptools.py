@@ -4,10 +4,18 @@ import os
 import sys
 import socket
 import logging
-from ssh2.session import Session
+import threading
 from datetime import datetime, timedelta
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
+from scripts.chip_extract import chipRipper
+
+EXECUTOR = 'local'  # 'local' chip engine or 'remote' (docker on the vms).
+WORKERS = os.cpu_count()  # Processes of the local chip engine.
+MAX_CHIPS = 512  # Chips per request with the local chip engine.
+
+_pool = None
+_pool_lock = threading.Lock()
 
 vms = ['192.168.0.11', '192.168.0.13', '192.168.0.8', '192.168.0.15']
 USERNAME = 'eouser'
@@ -17,6 +25,8 @@ DOCKERRUN = f'docker run --rm -v {CHIPSDIR}:/usr/src/app -u 1000:1000 glemoine62
 
 def chipCollect(unique_dir, ftype='tif'):
     # Collect the generate chips
+    if EXECUTOR == 'local':
+        return  # Written directly to the unique_dir.
     for vm in vms:
         logging.debug(f"Collecting from {vm}")
         os.popen(f"scp -i {PRIVATEKEY} -o \"StrictHostKeyChecking no\" {USERNAME}@{vm}:{CHIPSDIR}/{unique_dir}/*.{ftype} {unique_dir}").readlines()
@@ -36,7 +46,45 @@ def calendarCheck(klist, start_date, end_date):
     return slist
 
 
-def runjobs(chiplist, lon, lat, unique_dir, script, args):
+def max_chips(remote_limit):
+    """Get the largest number of chips per request of the executor."""
+    return MAX_CHIPS if EXECUTOR == 'local' else remote_limit
+
+
+def worker_pool():
+    """Get the persistent process pool of the local chip engine."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(WORKERS)
+        return _pool
+
+
+def runjobs(chiplist, lon, lat, unique_dir, script, args, progress=None):
+    """Run the chip jobs, progress(done, total, files) is called after each
+    completed chip (e.g. the progress of an API background job)."""
+    if EXECUTOR == 'remote':
+        return runremote(chiplist, lon, lat, unique_dir, script, args,
+                         progress)
+    chip_set = {}
+    jobs = {worker_pool().submit(chipRipper.run, script, lon, lat,
+                                 reference, unique_dir, args): reference
+            for reference in chiplist}
+    for job in as_completed(jobs):
+        reference = jobs[job]
+        try:
+            chip_set[reference] = job.result()
+        except Exception as err:
+            logging.debug(f"{reference} failed: {err}")
+            chip_set[reference] = None
+        if progress:
+            files = chip_set[reference]
+            progress(len(chip_set), len(chiplist),
+                     files if isinstance(files, list) else [files])
+    return chip_set
+
+
+def runremote(chiplist, lon, lat, unique_dir, script, args, progress=None):
     chip_set = {}
     with ProcessPoolExecutor(len(chiplist)) as executor:
         jobs = {}
@@ -52,9 +100,13 @@ def runjobs(chiplist, lon, lat, unique_dir, script, args):
         for job in as_completed(jobs):
             instance = jobs[job]
             chip_set[instance] = job.result()
+            if progress:
+                progress(len(chip_set), len(chiplist))
+    return chip_set
 
 
 def launchjob(host, cmd):
+    from ssh2.session import Session
     if not os.path.isfile(PRIVATEKEY):
         print(f"No such private key {PRIVATEKEY}")
         sys.exit(1)
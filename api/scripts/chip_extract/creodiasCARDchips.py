@@ -13,12 +13,38 @@
 # Version 1.1 - 2020-03-24
 # - Include intersection calculation
 #
+# Version 1.4
+# - Select the chips from the local dias_catalogue table (spatial index)
+#   with a TTL cache, the remote finder search is optional (SOURCE)
+# - The catalogue table is the dias_catalog of the dataset, without dataset
+#   the catalogues of the datasets of the year are searched and the remote
+#   finder is used if none of them has scenes at the location
+# - The S1 orbit direction is derived from the local solar time
+#
 
+import math
+import time
 import logging
+import threading
 import requests
+import numpy as np
 import pandas as pd
+import shapely
 from osgeo import ogr, osr
 
+from scripts import db, db_queries
+
+SOURCE = 'catalog'  # 'catalog' (local dias_catalogue) or 'finder' (remote).
+CELL = 0.1  # Degrees, catalogue lookups are cached per grid cell.
+CACHE_TTL = 600  # Seconds to keep the catalogue lookups.
+CACHE_SIZE = 1024  # Catalogue lookups kept in memory.
+EARTH_RADIUS = 6378137.0  # EPSG:3857 sphere radius.
+
+# (db, table, cell, start, end, card, level): (timestamp, refs, obstimes,
+#                                              footprints)
+_cache = {}
+_cache_lock = threading.Lock()
+
 # Define the query string for the DIAS catalog search
 
 
@@ -53,7 +79,151 @@ def ogr_intersect(lon, lat, chipsize, footprint):
     return intersection.GetArea() / chipPoly.GetArea()
 
 
-def getS2Chips(lon, lat, startDate, endDate, chipsize=1280, ptype='LEVEL2A'):
+def catalogs(dataset=None, startDate=None):
+    """Get the (database, dias catalogue table) of the dataset, or of all the
+    configured datasets of the year of startDate if None."""
+    if dataset is not None:
+        return [(dataset['db'], dataset['tables']['dias_catalog'])]
+    found = []
+    for name, d in db_queries.get_datasets().items():
+        year = str(d.get('year') or name.split('_')[-1])
+        if startDate and year.isdigit() and \
+                not str(startDate).startswith(year):
+            continue
+        if (d['db'], d['tables']['dias_catalog']) not in found:
+            found.append((d['db'], d['tables']['dias_catalog']))
+    return found
+
+
+def orbitDirection(obstime, lon):
+    """Get the S1 orbit direction from the local solar time of the
+    acquisition, morning acquisitions are from descending orbits and evening
+    acquisitions from ascending orbits."""
+    hour = (obstime.hour + obstime.minute / 60 + lon / 15) % 24
+    return 'DESCENDING' if hour < 12 else 'ASCENDING'
+
+
+def catalogFootprints(lon, lat, startDate, endDate, card, level, catalog):
+    """Get the references, acquisition times and footprints of the catalogue
+    scenes that intersect the grid cell of the location.
+
+    The lookups are cached for CACHE_TTL seconds per (catalogue, cell, dates,
+    card, level), so requests for neighbouring parcels do not query the
+    database. The catalogue is a (database, table) tuple (see catalogs).
+    """
+    catalog_db, catalog_table = catalog
+    cell = (math.floor(lon / CELL), math.floor(lat / CELL))
+    key = (catalog_db, catalog_table, cell, startDate, endDate, card, level)
+    now = time.monotonic()
+    with _cache_lock:
+        hit = _cache.get(key)
+    if hit and now - hit[0] < CACHE_TTL:
+        return hit[1], hit[2], hit[3]
+
+    sql = f"""
+        SELECT reference, obstime, ST_AsBinary(footprint)
+        FROM {catalog_table}
+        WHERE footprint && ST_MakeEnvelope(%s, %s, %s, %s, 4326)
+        And obstime >= %s::date And obstime < %s::date + 1
+        And card = %s And reference LIKE %s
+        ORDER BY obstime DESC;
+    """
+    with db.pool_conn(catalog_db) as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, (cell[0] * CELL, cell[1] * CELL,
+                              (cell[0] + 1) * CELL, (cell[1] + 1) * CELL,
+                              startDate, endDate, card, f"%{level}%"))
+            rows = cur.fetchall()
+        conn.rollback()
+
+    references = [r[0] for r in rows]
+    obstimes = [r[1] for r in rows]
+    footprints = shapely.from_wkb([bytes(r[2]) for r in rows])
+    with _cache_lock:
+        if len(_cache) >= CACHE_SIZE:
+            # Drop the oldest lookup.
+            del _cache[min(_cache, key=lambda k: _cache[k][0])]
+        _cache[key] = (now, references, obstimes, footprints)
+    return references, obstimes, footprints
+
+
+def chipOverlap(lon, lat, chipsize, footprints):
+    """Get the fraction of the chip covered by each footprint.
+
+    The chip is a square of chipsize EPSG:3857 meters around the location
+    (as ogr_intersect), computed in degrees for all footprints at once.
+    """
+    half = chipsize // 2
+    dx = math.degrees(half / EARTH_RADIUS)
+    dy = dx * math.cos(math.radians(lat))
+    chip = shapely.box(lon - dx, lat - dy, lon + dx, lat + dy)
+    return shapely.area(shapely.intersection(footprints, chip)) / chip.area
+
+
+def catalogChips(lon, lat, startDate, endDate, chipsize, card, level,
+                 dataset=None):
+    """Get the catalogue scenes that contain the location, with their
+    acquisition time and chip overlap.
+
+    Without dataset, the scenes of the first catalogue of the year with
+    scenes at the location are returned, None if there is no such catalogue
+    (the location or the dates are outside the configured datasets).
+    """
+    for catalog in catalogs(dataset, startDate):
+        references, obstimes, footprints = catalogFootprints(
+            lon, lat, startDate, endDate, card, level, catalog)
+        if not references:
+            continue
+        inside = shapely.intersects_xy(footprints, lon, lat)
+        if not inside.any():
+            continue
+        overlap = chipOverlap(lon, lat, chipsize, footprints[inside])
+        return ([r for r, i in zip(references, inside) if i],
+                [t for t, i in zip(obstimes, inside) if i], overlap)
+    if dataset is None:
+        return None
+    return [], [], np.array([])
+
+
+def getS2Chips(lon, lat, startDate, endDate, chipsize=1280, ptype='LEVEL2A',
+               dataset=None):
+    # Select all footprint that intersect with the chip centroid
+    if SOURCE == 'finder':
+        return finderS2Chips(lon, lat, startDate, endDate, chipsize, ptype)
+    chips = catalogChips(
+        lon, lat, startDate, endDate, chipsize, 's2',
+        'MSI' + ptype.replace('LEVEL', 'L') + '\\_', dataset)
+    if chips is None:
+        return finderS2Chips(lon, lat, startDate, endDate, chipsize, ptype)
+    references, _, overlap = chips
+    return [{'id': r, 'chipoverlap': o} for r, o in zip(references, overlap)]
+
+
+def getS1Chips(lon, lat, startDate, endDate, chipsize=1280, ptype='CARD-BS',
+               orbit=None, dataset=None):
+    """Get the S1 chips, of both orbit directions if orbit is None, else of
+    the orbit direction ('ASCENDING' or 'DESCENDING')."""
+    card = {'CARD-BS': 'bs', 'CARD-COH6': 'c6'}.get(ptype, ptype)
+    found = None
+    if SOURCE != 'finder':
+        found = catalogChips(
+            lon, lat, startDate, endDate, chipsize, card, '', dataset)
+    if found is None:
+        chips = finderS1Chips(lon, lat, startDate, endDate, chipsize, ptype)
+    else:
+        references, obstimes, overlap = found
+        # The orbit direction is not in the catalogue.
+        chips = [{'id': r, 'orbitDirection': orbitDirection(t, lon),
+                  'chipoverlap': o}
+                 for r, t, o in zip(references, obstimes, overlap)]
+    if orbit is not None:
+        chips = [c for c in chips
+                 if c['orbitDirection'].upper() == orbit.upper()]
+    return chips
+
+
+def finderS2Chips(lon, lat, startDate, endDate, chipsize=1280,
+                  ptype='LEVEL2A'):
     # Select all footprint that intersect with the chip centroid
     aoi = "POINT({}+{})".format(lon, lat)
     # Query must be one continuous line, without line breaks!!
@@ -94,7 +264,8 @@ def rinseAndDryS2(references):
     return list(df.id)
 
 
-def getS1Chips(lon, lat, startDate, endDate, chipsize=1280, ptype='CARD-BS'):
+def finderS1Chips(lon, lat, startDate, endDate, chipsize=1280,
+                  ptype='CARD-BS'):
     aoi = "POINT({}+{})".format(lon, lat)
     # Query must be one continuous line, without line breaks!!
     url = """https://finder.creodias.eu/resto/api/collections/Sentinel1/search.json?maxRecords=2000&startDate={}T00:00:00Z&completionDate={}T23:59:59Z&productType={}&sortParam=startDate&sortOrder=descending&status=all&geometry={}&dataset=ESA-DATASET"""
@@ -134,7 +305,8 @@ def rinseAndDryS1(references):
         '_')[4][0:8] if r.endswith('CARD_BS') else r.split('_')[1][0:8])
     df.sort_values(
         by=['chipoverlap', 'orbitDirection', 'tstamp'], inplace=True)
-    df.drop_duplicates(subset='tstamp', keep='last', inplace=True)
+    df.drop_duplicates(subset=['tstamp', 'orbitDirection'], keep='last',
+                       inplace=True)
     return list(df.id)
 
 
@@ -29,7 +29,7 @@ logging.basicConfig(
     format='%(name)s - %(levelname)s - %(message)s', level=logging.DEBUG)
 
 
-def parallelExtract(unique_dir):
+def parallelExtract(unique_dir, progress=None):
     start = time.time()
     logging.debug(start)
     # Read in params from json chipslist
@@ -80,12 +80,12 @@ def parallelExtract(unique_dir):
 
     logging.debug(f"Processing {len(chiplist)} chips")
 
-    if len(chiplist) > 36:
+    if len(chiplist) > chiptools.max_chips(36):
         print("Request results in too many chips, please revise selection")
         logging.debug("Too many chips requested")
         return -1
     chiptools.runjobs(chiplist, lon, lat, unique_dir,
-                      'rawChipRipper2.py', chipsize)
+                      'rawChipRipper2.py', chipsize, progress)
 
     logging.debug(
         f"Total time required for {len(chiplist)} images: {time.time() - start} seconds")
@@ -29,12 +29,13 @@ logging.basicConfig(filename='logs/main.log', filemode='w',
 
 
 def parallelExtract(lon, lat, start_date, end_date, unique_dir,
-                    band, chipsize, plevel):
+                    band, chipsize, plevel, dataset=None):
     start = time.time()
     logging.debug(start)
     # Make sure to skip duplicates that have lower version numbers
     chiplist = creodiasCARDchips.getS2Chips(
-        float(lon), float(lat), start_date, end_date, int(chipsize), plevel)
+        float(lon), float(lat), start_date, end_date, int(chipsize), plevel,
+        dataset)
     chiplist = creodiasCARDchips.rinseAndDryS2(chiplist)
 
     logging.debug("INITIAL CHIPS")
@@ -60,7 +61,7 @@ def parallelExtract(lon, lat, start_date, end_date, unique_dir,
         logging.debug(f"Creating {unique_dir} on host")
         os.makedirs(unique_dir)
     logging.debug(f"Processing {len(chiplist)} chips")
-    if len(chiplist) > 24:
+    if len(chiplist) > chiptools.max_chips(24):
         logging.debug("Too many chips requested")
         print("Request results in too many chips, please revise selection")
         return -1
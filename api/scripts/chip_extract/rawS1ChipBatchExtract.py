@@ -47,9 +47,10 @@ def parallelExtract(unique_dir):
     chipsize = params.get('chipsize')
     dates = params.get('dates')
     plevel = params.get('plevel')
+    orbit = params.get('orbit')
 
     chiplist = creodiasCARDchips.getS1Chips(float(lon), float(
-        lat), dates[0], dates[1], int(chipsize), plevel)
+        lat), dates[0], dates[1], int(chipsize), plevel, orbit)
     chiplist = creodiasCARDchips.rinseAndDryS1(chiplist)
 
     logging.debug("INITIAL CHIPS")
@@ -79,7 +80,7 @@ def parallelExtract(unique_dir):
 
     logging.debug(f"Processing {len(chiplist)} chips")
 
-    if len(chiplist) > 36:
+    if len(chiplist) > chiptools.max_chips(36):
         print("Request results in too many chips, please revise selection")
         logging.debug("Too many chips requested")
         return -1
@@ -18,6 +18,10 @@ Functions:
       - Get database connection information.
   get_version(dict_keys, var_name=None)
       - Get the database version .
+  pool_conn(db='main')
+      - Check out a pooled connection, returned to the pool on exit.
+  pool_stats()
+      - Get the connection pools usage metrics.
 
 Options:
   -h, --help    Show this screen.
@@ -25,12 +29,24 @@ Options:
 """
 
 import json
+import time
+import threading
 import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
 import pandas as pd
+from contextlib import contextmanager
 # from cbm.utils import config
 
 db_conf_file = 'config/main.json'
 
+POOL_MAXCONN = 10  # Maximum open connections per database.
+POOL_TIMEOUT = 30  # Seconds to wait for a free connection.
+POOL_CHECK_IDLE = 60  # Ping connections idle for longer than this (seconds).
+
+_pools = {}
+_pools_lock = threading.Lock()
+
 
 def conn_str(db='main'):
     """Get the database connection string to connect to the database.
@@ -61,6 +77,172 @@ def conn(db='main'):
         return ''
 
 
+class PoolTimeout(psycopg2.pool.PoolError):
+    """No connection became available within the pool timeout."""
+
+
+class ConnectionPool:
+    """A bounded, thread safe pool of connections to one database.
+
+    Connections are opened lazily up to 'maxconn'. A connection that has been
+    idle for longer than 'check_idle' seconds is pinged before it is handed
+    out, broken connections are discarded and replaced. When all connections
+    are in use, callers wait up to 'timeout' seconds before PoolTimeout.
+    """
+
+    def __init__(self, db='main', maxconn=POOL_MAXCONN, timeout=POOL_TIMEOUT,
+                 check_idle=POOL_CHECK_IDLE):
+        self.db = db
+        self.dsn = conn_str(db)
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self._idle = []  # (connection, last used timestamp)
+        self._opened = 0
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._counters = {'checkouts': 0, 'waits': 0, 'timeouts': 0,
+                          'connects': 0, 'discarded': 0}
+
+    def _healthy(self, connection, last_used):
+        if connection.closed:
+            return False
+        if time.monotonic() - last_used < self.check_idle:
+            return True
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SELECT 1;")
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._opened -= 1
+            self._counters['discarded'] += 1
+            self._cond.notify()
+
+    def getconn(self):
+        """Check out a connection, waiting if the pool is exhausted."""
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        while True:
+            with self._cond:
+                while not self._idle and self._opened >= self.maxconn:
+                    if not waited:
+                        waited = True
+                        self._counters['waits'] += 1
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters['timeouts'] += 1
+                        raise PoolTimeout(
+                            f"No free connection to the '{self.db}' database"
+                            f" after {self.timeout} seconds.")
+                    self._cond.wait(remaining)
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                else:
+                    connection, last_used = None, None
+                    self._opened += 1
+
+            if connection is None:
+                try:
+                    connection = psycopg2.connect(self.dsn)
+                except Exception:
+                    with self._cond:
+                        self._opened -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._counters['connects'] += 1
+            elif not self._healthy(connection, last_used):
+                self._discard(connection)
+                continue
+
+            with self._cond:
+                self._in_use += 1
+                self._counters['checkouts'] += 1
+            return connection
+
+    def putconn(self, connection):
+        """Return a connection to the pool, ending any open transaction."""
+        with self._cond:
+            self._in_use -= 1
+        if not connection.closed:
+            try:
+                if (connection.get_transaction_status() !=
+                        psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+                    connection.rollback()
+            except psycopg2.Error:
+                pass
+        if connection.closed:
+            self._discard(connection)
+            return
+        with self._cond:
+            self._idle.append((connection, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        """Close all idle connections."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+        for connection, _ in idle:
+            connection.close()
+
+    def stats(self):
+        """Get the pool usage metrics as a dictionary."""
+        with self._cond:
+            return {'maxconn': self.maxconn, 'opened': self._opened,
+                    'in_use': self._in_use, 'idle': len(self._idle),
+                    **self._counters}
+
+
+def pool(db='main'):
+    """Get the connection pool of the given database, create it if needed."""
+    with _pools_lock:
+        if db not in _pools:
+            _pools[db] = ConnectionPool(db)
+        return _pools[db]
+
+
+@contextmanager
+def pool_conn(db='main'):
+    """Check out a pooled connection, it is returned to the pool on exit.
+
+    Example:
+        with db.pool_conn(dataset['db']) as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT 1;")
+    """
+    db_pool = pool(db)
+    connection = db_pool.getconn()
+    try:
+        yield connection
+    finally:
+        db_pool.putconn(connection)
+
+
+def pool_stats():
+    """Get the usage metrics of all the connection pools."""
+    with _pools_lock:
+        pools = dict(_pools)
+    return {db: db_pool.stats() for db, db_pool in pools.items()}
+
+
+def close_pools():
+    """Close the idle connections of all the connection pools."""
+    with _pools_lock:
+        pools = dict(_pools)
+    for db_pool in pools.values():
+        db_pool.closeall()
+
+
 def conn_cur(db='main'):
     """Create a cursor to execute PostgreSQL command in a database session"""
     try:
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Background jobs for the long running chip and background requests.
+
+A job runs a function in a bounded thread pool, the function gets a
+progress(done, total, files) callback to report the files it has produced.
+Identical requests (same key) submitted while a job is queued or running
+get the same job.
+
+Example:
+    queue = JobQueue(max_workers=4)
+    job = queue.submit(key, work)  # work(progress) returns the result path
+    queue.get(job.id).to_dict()
+"""
+
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_WORKERS = 4  # Jobs running at the same time.
+JOB_TTL = 3600  # Seconds to keep the finished jobs.
+
+
+class Job:
+    """The state of a background job."""
+
+    def __init__(self, key, user=None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.user = user
+        self.status = 'queued'
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = 0
+        self.total = None
+        self.files = []
+        self.result = None
+        self.error = None
+        self._lock = threading.Lock()
+
+    def progress(self, done=None, total=None, files=()):
+        """Report the progress of the job."""
+        with self._lock:
+            if done is not None:
+                self.done = done
+            if total is not None:
+                self.total = total
+            self.files.extend(f for f in files if f)
+
+    def active(self):
+        return self.status in ('queued', 'running')
+
+    def to_dict(self):
+        with self._lock:
+            return {'job': self.id, 'status': self.status,
+                    'done': self.done, 'total': self.total,
+                    'files': [f"/{f}" for f in self.files],
+                    'result': f"/{self.result}" if self.result else None,
+                    'error': self.error, 'submitted': self.submitted,
+                    'started': self.started, 'finished': self.finished}
+
+
+class JobQueue:
+    """A bounded background executor with de-duplication of the jobs."""
+
+    def __init__(self, max_workers=MAX_WORKERS, ttl=JOB_TTL):
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._jobs = {}  # id: job
+        self._active = {}  # key: job
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        now = time.time()
+        for job_id in [i for i, j in self._jobs.items()
+                       if j.finished and now - j.finished > self.ttl]:
+            del self._jobs[job_id]
+
+    def submit(self, key, func, user=None):
+        """Run func(progress) in the background, return the job.
+
+        The running or queued job with the same key is returned instead of
+        a new job.
+        """
+        with self._lock:
+            self._expire()
+            job = self._active.get(key)
+            if job is not None and job.active():
+                return job
+            job = Job(key, user)
+            self._jobs[job.id] = job
+            self._active[key] = job
+        self._executor.submit(self._run, job, func)
+        return job
+
+    def _run(self, job, func):
+        job.status = 'running'
+        job.started = time.time()
+        try:
+            job.result = func(job.progress)
+            job.status = 'done'
+        except Exception as err:
+            logging.debug(f"Job {job.id} failed: {err}")
+            job.error = str(err)
+            job.status = 'failed'
+        finally:
+            job.finished = time.time()
+            with self._lock:
+                if self._active.get(job.key) is job:
+                    del self._active[job.key]
+
+    def get(self, job_id):
+        """Get a job by id, None if it does not exist or expired."""
+        with self._lock:
+            self._expire()
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return counts
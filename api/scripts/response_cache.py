@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Server side cache for the query responses.
+
+Responses are stored with the 'version' of the dataset they were built from,
+the version token changes when new images are extracted for the dataset
+(dias_catalog rows with status 'extracted'). Entries built from an older
+version are treated as misses and dropped.
+
+Example:
+    cache = ResponseCache(size=2048, directory='cache/ts', disk_size=2)
+    entry = cache.get(key, version)
+    if entry is None:
+        entry = cache.set(key, version, body, headers)
+"""
+
+import os
+import time
+import pickle
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+
+VERSION_CHECK_INTERVAL = 60  # Seconds between dataset version queries.
+DISK_SIZE = 2  # Size budget of the on-disk store in GB.
+PREFIX_LENGTH = 2  # Key items of a dataset, e.g. (aoi, year).
+
+Entry = namedtuple('Entry', ['body', 'headers', 'etag', 'version'])
+
+
+def make_etag(body):
+    """Get a strong entity tag for the response body."""
+    return hashlib.sha1(body).hexdigest()
+
+
+class MemoryStore:
+    """A bounded in-memory LRU store."""
+
+    def __init__(self, size=2048):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate(self, prefix):
+        """Drop all the entries with keys starting with the prefix tuple."""
+        with self._lock:
+            for key in [k for k in self._entries
+                        if k[:len(prefix)] == prefix]:
+                del self._entries[key]
+
+
+class DiskStore:
+    """A bounded on-disk LRU store, one pickle file per entry.
+
+    Files are written to a temporary name and moved into place, so
+    concurrent API workers never read partial entries. The entries are
+    grouped in folders by the first PREFIX_LENGTH items of their key (the
+    dataset), read entries are touched and the least recently used ones are
+    removed when the store grows over its size budget.
+    """
+
+    def __init__(self, directory, size=DISK_SIZE):
+        self.directory = directory
+        self.max_bytes = int(float(size) * 1024**3)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._bytes = sum(size for _, size, _ in self._files())
+
+    def _group(self, prefix):
+        name = hashlib.sha1(repr(tuple(prefix[:PREFIX_LENGTH])).encode())
+        return os.path.join(self.directory, name.hexdigest())
+
+    def _path(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self._group(key), f"{name}.pkl")
+
+    def _files(self):
+        """List the (last used, size, path) of the stored entries."""
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith('.pkl'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            os.utime(path)
+            return entry
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, entry):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except (OSError, pickle.PicklingError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        with self._lock:
+            self._bytes += os.path.getsize(path)
+            if self._bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the store fits the
+        size budget (the size is counted again, the store is shared by the
+        API workers)."""
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._bytes = total
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def invalidate(self, prefix):
+        """Drop the entries of the dataset (the whole store if the prefix is
+        shorter than PREFIX_LENGTH, the whole dataset if it is longer)."""
+        if len(prefix) < PREFIX_LENGTH:
+            folders = [os.path.join(self.directory, d)
+                       for d in os.listdir(self.directory)]
+        else:
+            folders = [self._group(prefix)]
+        for folder in folders:
+            shutil.rmtree(folder, ignore_errors=True)
+        with self._lock:
+            self._bytes = sum(size for _, size, _ in self._files())
+
+
+class ResponseCache:
+    """A memory LRU cache with an optional on-disk second level."""
+
+    def __init__(self, size=2048, directory=None, disk_size=DISK_SIZE):
+        self.stores = [MemoryStore(size)]
+        if directory:
+            self.stores.append(DiskStore(directory, disk_size))
+        self._versions = {}  # dataset: (checked timestamp, version)
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def get(self, key, version):
+        """Get the cached entry for the key, None if missing or outdated."""
+        if version is None:
+            return None
+        for i, store in enumerate(self.stores):
+            entry = store.get(key)
+            if entry is None:
+                continue
+            if entry.version != version:
+                store.delete(key)
+                continue
+            for upper in self.stores[:i]:
+                upper.set(key, entry)
+            self.stats['hits'] += 1
+            return entry
+        self.stats['misses'] += 1
+        return None
+
+    def set(self, key, version, body, headers):
+        """Store a response body and its headers, return the new entry."""
+        entry = Entry(body, headers, make_etag(body), version)
+        if version is not None:
+            for store in self.stores:
+                store.set(key, entry)
+        return entry
+
+    def invalidate(self, prefix):
+        for store in self.stores:
+            store.invalidate(prefix)
+
+    def version(self, prefix, get_version):
+        """Get the current version of a dataset.
+
+        The version is queried with get_version() at most once every
+        VERSION_CHECK_INTERVAL seconds. When it changes, all the entries with
+        keys starting with prefix are dropped.
+        """
+        now = time.monotonic()
+        with self._lock:
+            checked, version = self._versions.get(prefix, (None, None))
+        if checked is not None and now - checked < VERSION_CHECK_INTERVAL:
+            return version
+        new_version = get_version()
+        with self._lock:
+            self._versions[prefix] = (now, new_version)
+        if checked is not None and new_version != version:
+            self.invalidate(prefix)
+        return new_version
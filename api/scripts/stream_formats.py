@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""Encode chunks of query rows as streamed response bodies.
+
+Each function takes the column names, an iterable of row chunks (lists of
+tuples) and optionally the PostgreSQL type codes (OIDs) of the columns, and
+yields the encoded bytes chunk by chunk.
+
+If reading the rows fails after the response has started, the stream ends
+with an error record the client can detect: an {"error": ...} object
+(ndjson), a line starting with '# error' (csv) or an empty record batch
+with 'error' metadata (arrow).
+"""
+
+import csv
+import json
+import logging
+from io import StringIO
+from decimal import Decimal
+
+MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'arrow': 'application/vnd.apache.arrow.stream'
+}
+
+
+def available(oformat):
+    """Check that the libraries needed for the format are installed."""
+    if oformat == 'arrow':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return False
+    return oformat in ENCODERS
+
+
+def _rows(chunks, errors):
+    """Iterate the chunks, a failure is logged and appended to errors."""
+    try:
+        for rows in chunks:
+            yield rows
+    except Exception as err:
+        logging.exception("Streaming the query rows failed")
+        errors.append(str(err) or type(err).__name__)
+
+
+def _default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} "
+                    "is not JSON serializable")
+
+
+def ndjson(columns, chunks, types=None):
+    """Newline delimited JSON, one object per row."""
+    errors = []
+    for rows in _rows(chunks, errors):
+        yield ''.join(json.dumps(dict(zip(columns, r)), default=_default)
+                      + '\n' for r in rows).encode()
+    for err in errors:
+        yield (json.dumps({'error': err}) + '\n').encode()
+
+
+def csv_rows(columns, chunks, types=None):
+    """CSV with a header line."""
+    io_file = StringIO()
+    write = csv.writer(io_file, delimiter=',')
+    write.writerow(columns)
+    errors = []
+    for rows in _rows(chunks, errors):
+        write.writerows(rows)
+        yield io_file.getvalue().encode()
+        io_file.seek(0)
+        io_file.truncate()
+    for err in errors:
+        write.writerow([f"# error: {err}"])
+    yield io_file.getvalue().encode()
+
+
+class _Sink:
+    """A write only file object collecting the bytes written to it."""
+
+    def __init__(self):
+        self.buffers = []
+        self.closed = False
+
+    def write(self, data):
+        self.buffers.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.buffers)
+        self.buffers = []
+        return data
+
+
+def arrow_type(type_code):
+    """Get the Arrow type of a PostgreSQL type OID (string by default)."""
+    import pyarrow as pa
+    if type_code == 16:
+        return pa.bool_()
+    elif type_code in (20, 21, 23):
+        return pa.int64()
+    elif type_code in (700, 701, 1700):
+        return pa.float64()
+    elif type_code == 1082:
+        return pa.date32()
+    elif type_code in (1114, 1184):
+        return pa.timestamp('us')
+    return pa.string()
+
+
+def arrow(columns, chunks, types=None):
+    """Apache Arrow IPC stream, one record batch per chunk.
+
+    The schema is declared from the column types (PostgreSQL OIDs), columns
+    without a type are strings.
+    """
+    import pyarrow as pa
+
+    def value(v):
+        if isinstance(v, Decimal):
+            return float(v)
+        elif isinstance(v, (dict, list)):
+            return json.dumps(v)
+        return v
+
+    types = types or [None] * len(columns)
+    schema = pa.schema([(c, arrow_type(t)) for c, t in zip(columns, types)])
+    sink = _Sink()
+    writer = pa.ipc.new_stream(sink, schema)
+    yield sink.drain()
+    errors = []
+    for rows in _rows(chunks, errors):
+        arrays = [[value(v) for v in c] for c in zip(*rows)]
+        batch = pa.RecordBatch.from_arrays(
+            [pa.array(a, type=f.type) for a, f in zip(arrays, schema)],
+            schema=schema)
+        writer.write_batch(batch)
+        yield sink.drain()
+    for err in errors:
+        writer.write_batch(pa.RecordBatch.from_pylist([], schema=schema),
+                           custom_metadata={'error': err})
+    writer.close()
+    yield sink.drain()
+
+
+ENCODERS = {'ndjson': ndjson, 'csv': csv_rows, 'arrow': arrow}
@@ -12,10 +12,52 @@
 import os
 import sys
 import json
+import time
+import copy
+import hmac
 import hashlib
+import threading
 from codecs import encode
 
 users_file = 'config/users.json'
+AUTH_CACHE_TTL = 900  # Seconds a verified credential is trusted.
+
+_cache_lock = threading.Lock()
+_users_cache = {}  # file: (mtime, users)
+_verified = {}  # (username, password digest): expiry timestamp
+_cache_secret = os.urandom(32)
+
+
+def _load(file=users_file):
+    """Get the parsed users file, it is re-read only if it changed on disk.
+
+    The verified credentials cache is cleared whenever the file changes.
+    """
+    mtime = os.stat(file).st_mtime_ns
+    with _cache_lock:
+        cached = _users_cache.get(file)
+        if cached and cached[0] == mtime:
+            return cached[1]
+    with open(file, 'r') as u:
+        users = json.load(u)
+    with _cache_lock:
+        _users_cache[file] = (mtime, users)
+        if file == users_file:
+            _verified.clear()
+    return users
+
+
+def clear_cache():
+    """Drop the cached users file and the verified credentials."""
+    with _cache_lock:
+        _users_cache.clear()
+        _verified.clear()
+
+
+def _credential_key(username, password):
+    digest = hmac.new(_cache_secret, password.encode('utf-8'),
+                      hashlib.sha256).digest()
+    return (username, digest)
 
 
 def auth(username, password, aoi=None):
@@ -49,21 +91,30 @@ def auth(username, password, aoi=None):
 
     """
     try:
-        users = get_list(users_file, False)
+        users = _load(users_file)
         user = users[username.lower()]
 
-        salt = encode(user['salt'].encode().decode('unicode_escape'),
-                      "raw_unicode_escape")
+        cred = _credential_key(username.lower(), password)
+        with _cache_lock:
+            verified = _verified.get(cred, 0) > time.monotonic()
 
-        key = encode(user['key'].encode().decode('unicode_escape'),
-                     "raw_unicode_escape")
+        if not verified:
+            salt = encode(user['salt'].encode().decode('unicode_escape'),
+                          "raw_unicode_escape")
 
-        new_key = hashlib.pbkdf2_hmac(
-            'sha256', password.encode('utf-8'), salt, 100000)
+            key = encode(user['key'].encode().decode('unicode_escape'),
+                         "raw_unicode_escape")
 
-        if key == new_key:
+            new_key = hashlib.pbkdf2_hmac(
+                'sha256', password.encode('utf-8'), salt, 100000)
+
+            verified = hmac.compare_digest(key, new_key)
+            if verified:
+                with _cache_lock:
+                    _verified[cred] = time.monotonic() + AUTH_CACHE_TTL
+
+        if verified:
             if aoi:
-                users = get_list(users_file, False)
                 if any(x in [aoi, 'admin'] for x in users[username]['aois']):
                     return True
                 else:
@@ -78,7 +129,7 @@ def auth(username, password, aoi=None):
 
 
 def data_auth(aoi, username):
-    users = get_list(users_file, False)
+    users = _load(users_file)
     if any(x in [aoi, 'admin'] for x in users[username]['aois']):
         return True
     else:
@@ -113,6 +164,7 @@ def add(username, password='', aoi=''):
     }
     with open(users_file, 'w') as u:
         json.dump(users, u, indent=2)
+    clear_cache()
 
     if aoi == 'admin':
         aoi = "all"
@@ -130,8 +182,7 @@ def get_list(file=users_file, only_names=True, aois=False):
 
     """
     try:
-        with open(file, 'r') as u:
-            users = json.load(u)
+        users = copy.deepcopy(_load(file))
         if only_names:
             return [*users]
         elif aois:
@@ -170,6 +221,7 @@ def delete(username):
 
     with open(users_file, 'w') as u:
         json.dump(users, u, indent=2)
+    clear_cache()
 
 
 def sort(data_file):
@@ -8,16 +8,112 @@
 # License   : 3-Clause BSD
 
 import io
+import os
+import threading
 import requests
 from os.path import join, normpath, isfile
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from cbm.utils import config
 
+WORKERS = 8  # Concurrent chip downloads.
+CHUNK_SIZE = 1024 * 1024  # Download buffer size in bytes.
+RETRIES = 3  # Retries of the failed requests (connection errors, 429, 5xx).
+BACKOFF = 0.5  # Backoff factor of the retries in seconds.
+TIMEOUT = 300  # Seconds to wait for the server to respond.
+
+_clients = {}
+_lock = threading.Lock()
+
+
+class Client:
+    """A RESTful API client with a pooled keep-alive session.
+
+    Failed requests (connection errors, 429 and 5xx responses) are retried
+    with exponential backoff.
+
+    Example:
+        session = api.client()
+        response = session.get(f"{session.api_url}/query/info")
+        session.download_all(urls, 'temp/chips')
+    """
+
+    def __init__(self, api_url, api_user, api_pass, workers=WORKERS,
+                 retries=RETRIES, backoff=BACKOFF):
+        self.api_url = api_url
+        self.workers = workers
+        self.session = requests.Session()
+        self.session.auth = (api_user, api_pass)
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=4,
+                              pool_maxsize=max(workers, 10))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, timeout=TIMEOUT, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, timeout=TIMEOUT, **kwargs)
+
+    def download(self, url, outf):
+        """Download a file to outf.
+
+        The file is written to a temporary name and moved into place when
+        complete, a failed download leaves no partial file at outf.
+        """
+        tmp = f"{outf}.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            with self.get(url, stream=True) as res:
+                res.raise_for_status()
+                with open(tmp, "wb") as handle:
+                    for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+                        handle.write(chunk)
+            os.replace(tmp, outf)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return outf
+
+    def download_all(self, urls, outfiles, workers=None, debug=False):
+        """Download files concurrently.
+
+        Returns:
+            A list of the downloaded files, None for the failed downloads.
+        """
+        def download(args):
+            url, outf = args
+            try:
+                self.download(url, outf)
+                if debug:
+                    print(f"Downloaded {outf}")
+                return outf
+            except Exception as err:
+                print(f"Could not download {url}: {err}")
+                return None
+
+        with ThreadPoolExecutor(workers or self.workers) as executor:
+            return list(executor.map(download, zip(urls, outfiles)))
+
+
+def client():
+    """Get the API client of the configured credentials."""
+    credentials = config.credentials('api')
+    with _lock:
+        if credentials not in _clients:
+            _clients[credentials] = Client(*credentials)
+        return _clients[credentials]
+
 
 def get_options(debug=False):
-    api_url, api_user, api_pass = config.credentials('api')
+    session = client()
+    api_url = session.api_url
     requrl = """{}/query/info"""
-    response = requests.get(requrl.format(api_url), auth=(api_user, api_pass))
+    response = session.get(requrl.format(api_url))
     if debug:
         print(requrl.format(api_url), response)
     return response.content
@@ -26,7 +122,8 @@ def get_options(debug=False):
 def parcel_by_loc(aoi, year, lon, lat, ptype=None,
                   geom=False, wgs84=False, debug=False):
 
-    api_url, api_user, api_pass = config.credentials('api')
+    session = client()
+    api_url = session.api_url
     requrl = """{}/query/parcelByLocation?aoi={}&year={}&lon={}&lat={}"""
     if geom is True:
         requrl = f"{requrl}&withGeometry=True"
@@ -35,8 +132,7 @@ def parcel_by_loc(aoi, year, lon, lat, ptype=None,
     if wgs84 is True:
         requrl = f"{requrl}&wgs84={wgs84}"
     # print(requrl.format(api_url, aoi, year, lon, lat))
-    response = requests.get(requrl.format(api_url, aoi, year, lon, lat),
-                            auth=(api_user, api_pass))
+    response = session.get(requrl.format(api_url, aoi, year, lon, lat))
     if debug:
         print(requrl.format(api_url, aoi, year, lon, lat), response)
     return response.content
@@ -44,7 +140,8 @@ def parcel_by_loc(aoi, year, lon, lat, ptype=None,
 
 def parcel_by_id(aoi, year, pid, ptype=None, geom=False,
                  wgs84=False, debug=False):
-    api_url, api_user, api_pass = config.credentials('api')
+    session = client()
+    api_url = session.api_url
     requrl = """{}/query/parcelByID?aoi={}&year={}&pid={}"""
     if geom is True:
         requrl = f"{requrl}&withGeometry=True"
@@ -53,8 +150,7 @@ def parcel_by_id(aoi, year, pid, ptype=None, geom=False,
     if wgs84 is True:
         requrl = f"{requrl}&wgs84={wgs84}"
     # print(requrl.format(api_url, aoi, year, pid))
-    response = requests.get(requrl.format(api_url, aoi, year, pid),
-                            auth=(api_user, api_pass))
+    response = session.get(requrl.format(api_url, aoi, year, pid))
     if debug:
         print(requrl.format(api_url, aoi, year, pid), response)
     return response.content
@@ -63,7 +159,8 @@ def parcel_by_id(aoi, year, pid, ptype=None, geom=False,
 def parcel_by_polygon(aoi, year, polygon, ptype=None, geom=False,
                       wgs84=False, only_ids=True, debug=False):
 
-    api_url, api_user, api_pass = config.credentials('api')
+    session = client()
+    api_url = session.api_url
     requrl = """{}/query/parcelsByPolygon?aoi={}&year={}&polygon={}"""
     if geom is True:
         requrl = f"{requrl}&withGeometry=True"
@@ -73,8 +170,7 @@ def parcel_by_polygon(aoi, year, polygon, ptype=None, geom=False,
         requrl = f"{requrl}&ptype={ptype}"
     if wgs84 is True:
         requrl = f"{requrl}&wgs84={wgs84}"
-    response = requests.get(requrl.format(api_url, aoi, year, polygon),
-                            auth=(api_user, api_pass))
+    response = session.get(requrl.format(api_url, aoi, year, polygon))
     if debug:
         print(requrl.format(api_url, aoi, year, polygon), response)
     return response.content
@@ -82,12 +178,13 @@ def parcel_by_polygon(aoi, year, polygon, ptype=None, geom=False,
 
 def parcel_peers(aoi, year, pid, distance=1000.0,
                  maxPeers=10, ptype=None, debug=False):
-    api_url, api_user, api_pass = config.credentials('api')
+    session = client()
+    api_url = session.api_url
     requrl = """{}/query/parcelPeers?aoi={}&year={}&pid={}&distance={}&max={}"""
     if ptype not in [None, '']:
         requrl = f"{requrl}&ptype={ptype}"
-    response = requests.get(requrl.format(api_url, aoi, year, pid, distance,
-                                          maxPeers), auth=(api_user, api_pass))
+    response = session.get(requrl.format(api_url, aoi, year, pid, distance,
+                                         maxPeers))
     if debug:
         print(requrl.format(api_url, aoi, year, pid, distance, maxPeers),
               response)
@@ -96,15 +193,15 @@ def parcel_peers(aoi, year, pid, distance=1000.0,
 
 def parcel_ts(aoi, year, pid, tstype='s2', ptype=None, band='', debug=False):
 
-    api_url, api_user, api_pass = config.credentials('api')
+    session = client()
+    api_url = session.api_url
     requrl = """{}/query/parcelTimeSeries?aoi={}&year={}&pid={}&tstype={}"""
     if ptype not in [None, '']:
         requrl = f"{requrl}&ptype={ptype}"
     if band not in [None, '']:
         requrl = f"{requrl}&band={band}"
-    response = requests.get(requrl.format(api_url, aoi, year,
-                                          pid, tstype, band),
-                            auth=(api_user, api_pass))
+    response = session.get(requrl.format(api_url, aoi, year,
+                                         pid, tstype, band))
     if debug:
         print(requrl.format(api_url, aoi, year, pid, tstype, band), response)
     return response.content
@@ -112,19 +209,20 @@ def parcel_ts(aoi, year, pid, tstype='s2', ptype=None, band='', debug=False):
 
 def parcel_wts(aoi, year, pid, ptype=None, debug=False):
 
-    api_url, api_user, api_pass = config.credentials('api')
+    session = client()
+    api_url = session.api_url
     requrl = """{}/query/weatherTimeSeries?aoi={}&year={}&pid={}"""
     if ptype not in [None, '']:
         requrl = f"{requrl}&ptype={ptype}"
-    response = requests.get(requrl.format(api_url, aoi, year, pid),
-                            auth=(api_user, api_pass))
+    response = session.get(requrl.format(api_url, aoi, year, pid))
     if debug:
         print(requrl.format(api_url, aoi, year, pid), response)
     return response.content
 
 
 def cbl(lon, lat, start_date, end_date, bands=None, lut=None, chipsize=None):
-    api_url, api_user, api_pass = config.credentials('api')
+    session = client()
+    api_url = session.api_url
     requrl = """{}/query/chipsByLocation?lon={}&lat={}&start_date={}&end_date={}"""
     band = '_'.join(bands)
     if band is not None:
@@ -134,58 +232,65 @@ def cbl(lon, lat, start_date, end_date, bands=None, lut=None, chipsize=None):
     if lut != '':
         requrl = f"{requrl}&lut={lut}"
     # print(requrl.format(api_url, lon, lat, start_date, end_date))
-    response = requests.get(requrl.format(api_url, lon, lat,
-                                          start_date, end_date),
-                            auth=(api_user, api_pass))
+    response = session.get(requrl.format(api_url, lon, lat,
+                                         start_date, end_date))
     return response
 
 
 def rcbl(clon, clat, start_date, end_date,
-         bands, chipsize, filespath, debug=False):
-    """Get parcel raw chip images from RESTful API by location"""
-    import os
-    import os.path
+         bands, chipsize, filespath, debug=False, workers=None):
+    """Get parcel raw chip images from RESTful API by location.
+
+    The chip lists of all the bands are requested and the chips are
+    downloaded concurrently (workers, default WORKERS), the chips already
+    downloaded to filespath are skipped. The chip list of each band is
+    stored to 'images_list.{band}.csv'.
+    """
+    if not bands:
+        return
     import pandas as pd
     import time
     start = time.time()
-    api_url, api_user, api_pass = config.credentials('api')
+    session = client()
+    api_url = session.api_url
 
-    for band in bands:
+    def chip_list(band):
         requrl = """{}/query/rawChipByLocation?lon={}&lat={}&start_date={}&end_date={}"""
         if band is not None:
             requrl = f"{requrl}&band={band}"
         if chipsize is not None:
             requrl = f"{requrl}&chipsize={chipsize}"
 
-        response = requests.get(requrl.format(api_url, clon, clat, start_date,
-                                              end_date, band, chipsize),
-                                auth=(api_user, api_pass)).content
+        response = session.get(requrl.format(api_url, clon, clat, start_date,
+                                             end_date, band, chipsize)).content
         if debug:
             print("Request url:", requrl.format(
                 api_url, clon, clat, start_date, end_date, band, chipsize))
             print("Response:", response)
         # Create a pandas DataFrame from the json response
-        df = pd.read_json(io.StringIO(response.decode('utf-8')))
-        os.makedirs(filespath, exist_ok=True)
+        return pd.read_json(io.StringIO(response.decode('utf-8')))
+
+    with ThreadPoolExecutor(min(len(bands), workers or session.workers)
+                            ) as executor:
+        dfs = dict(zip(bands, executor.map(chip_list, bands)))
+    os.makedirs(filespath, exist_ok=True)
 
-        # Download the GeoTIFFs that were just created in the user cache
+    # Download the GeoTIFFs that were just created in the user cache
+    urls, outfiles = [], []
+    for band, df in dfs.items():
         for c in df.chips:
-            url = f"{api_url}{c}"
             outf = normpath(join(filespath, c.split('/')[-1]))
-            res = requests.get(url, stream=True)
-            if debug:
-                print(f"Downloading {c.split('/')[-1]}")
-            with open(outf, "wb") as handle:
-                for chunk in res.iter_content(chunk_size=512):
-                    if chunk:  # filter out keep-alive new chunks
-                        handle.write(chunk)
+            if not isfile(outf):
+                urls.append(f"{api_url}{c}")
+                outfiles.append(outf)
+    session.download_all(urls, outfiles, workers, debug)
 
-        # Sore DataFrame to file
+    # Store DataFrames to files
+    for band, df in dfs.items():
         df_file = normpath(join(filespath, f'images_list.{band}.csv'))
         if isfile(df_file):
             df_old = pd.read_csv(df_file, index_col=[0])
-            # df = pd.concat([df, df_old], ignore_index=True)
-            df = df.append(df_old, ignore_index=True)
+            df = pd.concat([df, df_old], ignore_index=True)
             df = df.drop_duplicates(subset=['chips'])
         df = df.sort_values(by="dates")
         df = df.reset_index(drop=True)
@@ -215,10 +320,11 @@ def background(lon, lat, chipsize=512, extend=512, tms='Google',
         bg_path, the path of the output file (str).
     """
     # Make the request
-    api_url, api_user, api_pass = config.credentials('api')
+    session = client()
+    api_url = session.api_url
     params = f"&chipsize={chipsize}&extend={extend}&tms={tms}&iformat=tif"
     requrl = f"{api_url}/query/backgroundByLocation?lon={lon}&lat={lat}{params}"
-    response = requests.get(requrl, auth=(api_user, api_pass))
+    response = session.get(requrl)
 
     # Try to download the image
     try:
@@ -231,14 +337,8 @@ def background(lon, lat, chipsize=512, extend=512, tms='Google',
         else:
             if debug:
                 print(requrl, response)
-            res = requests.get(img_url, stream=True)
             image_name = img_url.split('/')[-1].lower()
             bg_file = normpath(join(bg_path, image_name))
-
-            with open(bg_file, "wb") as handle:
-                for chunk in res.iter_content(chunk_size=1024):
-                    if chunk:  # filter out keep-alive new chunks
-                        handle.write(chunk)
-            return bg_file
-    except AttributeError as err:
+            return session.download(img_url, bg_file)
+    except (AttributeError, requests.RequestException) as err:
         return err
@@ -28,6 +28,7 @@ Exaple code:
 
 import boto3
 from cbm.utils import config
+from cbm.datas import scene_cache
 
 
 class crls:
@@ -55,18 +56,30 @@ def connection(arg=None):
         return session.client('s3', endpoint_url=crls.S3HOST)
 
 
-def get_file(s3file, localfile, bucket_, progress_bar=False, to_memory=False, status=False):
+def get_file(s3file, localfile, bucket_=None, progress_bar=False,
+             to_memory=False, status=False, cache=True):
+    """Download a file from the s3 storage.
+
+    Files downloaded to local storage are served from the scene cache
+    (see scene_cache) if it is enabled and cache is True.
+    """
     import botocore
-    """Download a file from the s3 storage"""
     session = boto3.session.Session(aws_access_key_id=crls.ACCESS_KEY,
                                     aws_secret_access_key=crls.SECRET_KEY)
     s3 = session.resource('s3', endpoint_url=crls.S3HOST)
     bucket_ = s3.Bucket(crls.BUCKET)
     object_ = bucket_.Object(s3file)
-    filesize = object_.content_length
 
     try:
-        if to_memory is True:
+        filesize = object_.content_length
+        scenes = scene_cache.default() if cache else None
+        if to_memory is False and progress_bar is False and scenes:
+            scenes.fetch(s3file, object_.e_tag, localfile,
+                         lambda tmp: bucket_.download_file(s3file, tmp))
+            if status:
+                print("File downloaded as: ", localfile)
+            return 1
+        elif to_memory is True:
             import io
 #             localfile = io.BytesIO()
             print("-Downloading to memory-")
@@ -315,19 +328,47 @@ SAFE/GRANULE/L2A_{ref_list[5]}_"
 # Configure S3 access (-> to config loading)
 
 
-def get_subset(fkey, features):
-    import numpy as np
-#     import pandas as pd
+def vsis3_path(s3file, bucket=None):
+    """Get the GDAL '/vsis3/' path of a file in the s3 storage"""
+    return '/vsis3/{}/{}'.format(bucket or crls.BUCKET, s3file)
+
+
+def vsis3_env(**options):
+    """Get a rasterio environment to read '/vsis3/' paths.
+
+    GDAL reads only the byte ranges it needs, e.g. the tiles of a window.
+    Extra GDAL configuration options can be passed as keyword arguments.
+    """
     import rasterio
-    from rasterio.mask import mask
     from rasterio.session import AWSSession
     s3host_ = crls.S3HOST.replace('http://', '')
     s3host_ = s3host_.replace('https://', '')
 
     session = connection('session')
-    with rasterio.Env(AWSSession(session), AWS_S3_ENDPOINT=s3host_,
-                      AWS_HTTPS='NO', AWS_VIRTUAL_HOSTING=False) as env:
-        with rasterio.open('/vsis3/{}/{}'.format(crls.BUCKET, fkey)) as src:
+    return rasterio.Env(AWSSession(session), AWS_S3_ENDPOINT=s3host_,
+                        AWS_HTTPS='NO', AWS_VIRTUAL_HOSTING=False, **options)
+
+
+def exists(s3file, bucket=None):
+    """Check if a file exists in the s3 storage"""
+    import botocore
+    try:
+        connection().head_object(Bucket=bucket or crls.BUCKET, Key=s3file)
+        return True
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return False
+        raise
+
+
+def get_subset(fkey, features):
+    import numpy as np
+#     import pandas as pd
+    import rasterio
+    from rasterio.mask import mask
+
+    with vsis3_env():
+        with rasterio.open(vsis3_path(fkey)) as src:
             out_image, out_transform = mask(src, features, crop=True,
                                             pad=False, all_touched=False)
 #             print('--out_image.shape: ', out_image.shape)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+On-disk cache of the images downloaded from the DIAS object storage.
+
+Files are stored by the sha256 of their S3 key and ETag, so a changed
+object is never served from an old copy. Downloads are written to a
+temporary file and moved into place, concurrent workers (processes or
+containers sharing the directory) never see partial files. When the cache
+grows over its size budget, the least recently used files are removed.
+
+The requested local files are hard links to the cached files (copies if the
+file system does not support links), removing them does not affect the
+cache.
+
+The cache is opt-in, it is configured in the 's3' section of
+config/main.json with 'cache_dir' (missing or empty to disable) and
+'cache_size' (in GB).
+
+Example:
+    from cbm.datas import scene_cache
+    cache = scene_cache.default()
+    cache.fetch(s3file, etag, 'tmp/B04.jp2',
+                lambda tmp: bucket.download_file(s3file, tmp))
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
+CACHE_DIR = 'scene_cache'  # Default directory of SceneCache().
+CACHE_SIZE = 20  # Default size budget in GB.
+PARTIAL_TTL = 86400  # Seconds to keep partial downloads of crashed workers.
+
+_caches = {}
+_lock = threading.Lock()
+
+
+class SceneCache:
+    """A content addressed on-disk file cache with LRU eviction."""
+
+    def __init__(self, directory=CACHE_DIR, size=CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = int(float(size) * 1024**3)
+        self.stats = {'hits': 0, 'misses': 0, 'evicted': 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key, etag):
+        """Get the cache path of an S3 object."""
+        digest = hashlib.sha256(f"{key}\n{etag}".encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2],
+                            digest + os.path.splitext(key)[1])
+
+    def get(self, key, etag, download):
+        """Get the cached file of an S3 object, download it if missing.
+
+        Arguments:
+            key, etag, the S3 key and ETag of the object
+            download, a function that downloads the object to a given path
+
+        Returns:
+            The path of the cached file.
+        """
+        path = self.path(key, etag)
+        if os.path.isfile(path):
+            try:
+                os.utime(path)  # Most recently used.
+                self.stats['hits'] += 1
+                return path
+            except OSError:
+                pass  # Evicted in the meantime.
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                                   suffix='.part')
+        os.close(fd)
+        try:
+            download(tmp)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.stats['misses'] += 1
+        self.evict(keep=path)
+        return path
+
+    def fetch(self, key, etag, localfile, download):
+        """Place the cached file of an S3 object at localfile.
+
+        Returns:
+            localfile
+        """
+        if os.path.dirname(localfile):
+            os.makedirs(os.path.dirname(localfile), exist_ok=True)
+        # The file can be evicted by another worker between get and link,
+        # it is then downloaded again.
+        for _ in range(2):
+            path = self.get(key, etag, download)
+            if os.path.exists(localfile):
+                os.remove(localfile)
+            try:
+                os.link(path, localfile)
+                return localfile
+            except FileNotFoundError:
+                continue
+            except OSError:
+                try:
+                    shutil.copyfile(path, localfile)
+                    return localfile
+                except FileNotFoundError:
+                    continue
+        download(localfile)
+        return localfile
+
+    def entries(self):
+        """Get a list of (last used, size, path) of the cached files."""
+        entries = []
+        now = time.time()
+        for root, dirs, files in os.walk(self.directory):
+            for f in files:
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if f.endswith('.part'):
+                    if now - st.st_mtime > PARTIAL_TTL:
+                        self._remove(path)
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def size(self):
+        """Get the total size of the cached files in bytes."""
+        return sum(e[1] for e in self.entries())
+
+    def evict(self, keep=None):
+        """Remove the least recently used files until the cache fits the
+        size budget. The file 'keep' is never removed."""
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path != keep and self._remove(path):
+                total -= size
+                self.stats['evicted'] += 1
+
+    def clear(self):
+        """Remove all the cached files."""
+        for mtime, size, path in self.entries():
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+
+def default():
+    """Get the scene cache of the configuration, None if it is disabled
+    (no 'cache_dir' is set)."""
+    from cbm.utils import config
+    values = config.read().get('s3', {})
+    directory = values.get('cache_dir')
+    if not directory:
+        return None
+    size = values.get('cache_size') or CACHE_SIZE
+    with _lock:
+        if (directory, size) not in _caches:
+            _caches[(directory, size)] = SceneCache(directory, size)
+        return _caches[(directory, size)]
@@ -24,7 +24,9 @@ def tables_dict():
                 status character varying(12)
                     DEFAULT 'ingested'::character varying not null,
                 footprint public.geometry(Polygon,4326)
-                );"""
+                );
+                CREATE INDEX dias_catalogue_footprint_idx ON public.dias_catalogue USING GIST (
+                    footprint);"""
         },
         "aois": {
             "name": "AOIs (Optional) - Regions or Municipalities",
@@ -52,7 +54,8 @@ def tables_dict():
                     max real,
                     p25 real,
                     p50 real,
-                    p75 real
+                    p75 real,
+                    PRIMARY KEY (pid, obsid, band)
                 );
                 """
         },
@@ -72,7 +75,8 @@ def tables_dict():
                     max real,
                     p25 real,
                     p50 real,
-                    p75 real
+                    p75 real,
+                    PRIMARY KEY (pid, obsid, band)
                 );
                 """
         },
@@ -92,7 +96,8 @@ def tables_dict():
                     max real,
                     p25 real,
                     p50 real,
-                    p75 real
+                    p75 real,
+                    PRIMARY KEY (pid, obsid, band)
                 );
                 """
         },
@@ -112,9 +117,107 @@ def tables_dict():
                     max real,
                     p25 real,
                     p50 real,
-                    p75 real
+                    p75 real,
+                    PRIMARY KEY (pid, obsid, band)
                 );
                 """
         }
     }
     return tb
+
+
+MIN_AREA = 3000.0  # Smallest parcel area to extract (parcels table units).
+UTM_MARGIN = 0.5  # Degrees, S2 tiles overlap the neighbouring UTM zones.
+
+
+def extraction_table(parcels_table):
+    """Get the name of the precomputed parcel extraction table."""
+    return f"{parcels_table}_extract"
+
+
+def utm_zones(conn, parcels_table, margin=UTM_MARGIN):
+    """Get the EPSG codes of the UTM zones (north) covering the parcels."""
+    sql = f"""
+    SELECT ST_XMin(e), ST_XMax(e) FROM (
+        SELECT ST_Transform(ST_SetSRID(ST_Extent(wkb_geometry)::geometry,
+            (SELECT ST_SRID(wkb_geometry) FROM {parcels_table} LIMIT 1)),
+            4326) As e
+        FROM {parcels_table}) t;
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql)
+        xmin, xmax = cur.fetchone()
+    conn.commit()
+    first = int((xmin - margin + 180) // 6) + 1
+    last = int((xmax + margin + 180) // 6) + 1
+    return [32600 + z for z in range(max(first, 1), min(last, 60) + 1)]
+
+
+def extraction_zones(conn, parcels_table):
+    """Get the UTM zones of the extraction table, [] if it does not exist."""
+    sql = """
+    SELECT a.attname FROM pg_attribute a
+    WHERE a.attrelid = to_regclass(%s)
+    And a.attname LIKE 'wkb\\_%%' And NOT a.attisdropped;
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql, (extraction_table(parcels_table),))
+        zones = [int(r[0][4:]) for r in cur.fetchall()]
+    conn.commit()
+    return sorted(zones)
+
+
+def setup_extraction_table(conn, parcels_table, pid_column, zones=None):
+    """Create or refresh the precomputed parcel extraction table.
+
+    The table has one row per parcel with the parcel id (pid), the area,
+    the geometry in EPSG:4326 (geom, GIST indexed for the intersection with
+    the footprints of the dias catalogue) and the WKB geometry in each UTM
+    zone (wkb_326NN columns). The per scene parcel selection becomes an index
+    scan without any geometry computation.
+
+    The new table is built next to the old one and swapped in a single
+    transaction, run it again after the parcels table is changed.
+
+    Arguments:
+        conn, a psycopg2 connection
+        parcels_table, the parcels table
+        pid_column, the parcel id column of the parcels table
+        zones, list of UTM EPSG codes, by default the zones of the parcels
+
+    Returns:
+        The name of the extraction table.
+    """
+    if zones is None:
+        zones = utm_zones(conn, parcels_table)
+    table = extraction_table(parcels_table)
+    schema, name = (table.rsplit('.', 1) if '.' in table
+                    else (None, table))
+    prefix = f"{schema}." if schema else ''
+    wkb = ',\n        '.join(
+        f"ST_AsBinary(ST_Transform(p.wkb_geometry, {z})) As wkb_{z}"
+        for z in zones)
+
+    sql = f"""
+    DROP TABLE IF EXISTS {table}_new;
+    CREATE TABLE {table}_new AS
+    SELECT p.{pid_column} As pid, st_area(p.wkb_geometry) As area,
+        ST_Transform(p.wkb_geometry, 4326) As geom,
+        {wkb}
+    FROM {parcels_table} p;
+    CREATE INDEX {name}_geom_new_idx ON {table}_new USING GIST (geom);
+    CREATE INDEX {name}_pid_new_idx ON {table}_new (pid);
+    DROP TABLE IF EXISTS {table};
+    ALTER TABLE {table}_new RENAME TO {name};
+    ALTER INDEX {prefix}{name}_geom_new_idx RENAME TO {name}_geom_idx;
+    ALTER INDEX {prefix}{name}_pid_new_idx RENAME TO {name}_pid_idx;
+    """
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(sql)
+    with conn.cursor() as cur:
+        # Planner statistics for the new table.
+        cur.execute(f"ANALYZE {table};")
+    conn.commit()
+    print(f"The table {table} is ready, UTM zones: {zones}")
+    return table
@@ -11,17 +11,15 @@
 import time
 import sys
 import os
-import io
 import json
 import psycopg2
 import psycopg2.extras
 import rasterio
-from rasterstats import zonal_stats
 from datetime import datetime
-import pandas as pd
 
 from cbm.utils import config
 from cbm.datas import db, object_storage
+from cbm.extract import zonal, signatures
 
 def extractS1bs(startdate, enddate):
     start = time.time()
@@ -207,8 +205,10 @@ def extractS1bs(startdate, enddate):
 
     for b in bands:
         with rasterio.open(f'{frootpath}/{reference}_{b}.img') as src:
-            affine[b] = cbm.transform
-            array[b] = cbm.read(1)
+            affine[b] = src.transform
+            array[b] = src.read(1)
+
+    writer = signatures.SignatureWriter(outconn, results_table)
 
     while True:
         rowset = incurs.fetchmany(size=2000)
@@ -216,46 +216,20 @@ def extractS1bs(startdate, enddate):
         if not rowset:
             break
 
-        features = { "type": "FeatureCollection",
-            "features": [{"type": "feature", "geometry": f[1], "properties": {"pid": int(f[0])}} for f in rowset]}
+        geometries = [f[1] for f in rowset]
+        pids = [int(f[0]) for f in rowset]
+        stats = zonal.block_stats(geometries, pids,
+                                  {b: (array[b], affine[b]) for b in bands})
 
         for b in bands:
+            nrows[b] = nrows[b] + len(rowset)
+            if len(stats[b]['pid']) > 0:
+                writer.add(stats[b], oid, b)
+            else:
+                print("No valid data in block {}".format(nrows[b]))
 
-            zs = zonal_stats(features, array[b], affine=affine[b], stats=["count", "mean", "std", "min", "max", "percentile_25", "percentile_50", "percentile_75"], prefix="", nodata=0, geojson_out=True)
-
-            df = pd.DataFrame(zs)
-
-            df = pd.DataFrame.from_dict(df.properties.to_dict(), orient='index')
-
-            df['obsid'] = oid
-            df['band'] = b
-
-            df.rename(index=str, columns={"percentile_25": "p25", "percentile_50": "p50","percentile_75": "p75"}, inplace=True)
-
-            nrows[b] = nrows[b] + len(df)
-            # df is the dataframe
-            if len(df) > 0:
-                df.dropna(inplace=True)
-                if len(df.values) > 0:
-                    df_columns = list(df)
-                    s_buf = io.StringIO()
-                    df.to_csv(s_buf, header=False, index=False, sep=',')
-                    s_buf.seek(0)
-                    outcurs = outconn.cursor()
-                    #print(tuple(df_columns))
-                    try:
-                        #psycopg2.extras.execute_batch(outcurs, insert_stmt, df.values)
-                        outcurs.copy_from(s_buf, dbconfig['tables']['results_table'], columns = tuple(df_columns), sep = ',')
-                        outconn.commit()
-                    except psycopg2.IntegrityError as e:
-                        print("insert statement {} contains duplicate index".format(insert_stmt))
-                    #except Error as e:
-                    #    print(e)
-                    finally:
-                        outcurs.close()
-                else:
-                    print("No valid data in block {}".format(nrows[b]))
-
+    # One transaction per scene.
+    writer.commit()
     outconn.close()
 
     incurs.close()
@@ -16,6 +16,17 @@
     License: see git repository
     Version 1.3 - 2020-02-03
 
+    Revisions in 1.4:
+    - Long running worker mode, scenes are claimed with SKIP LOCKED and
+      processed in parallel, failures are stored as the scene status
+    - Vectorised zonal statistics (cbm.extract.zonal) instead of rasterstats,
+      each block of parcels is rasterised once per band resolution
+    - Windowed mode, only the block aligned windows covered by the parcels
+      are read with GDAL '/vsis3/' range reads, without downloading the scene
+    - Signatures are written with binary COPY and committed once per scene
+    - Parcels are selected from the precomputed extraction table if it
+      exists (db_tables.setup_extraction_table), as WKB
+
     Revisions in 1.3 (2020-7-12):
     By: Konstantinos Anastasakis, European Commission, Joint Research Centre
     - Configure to be compatible with the graphical notebooks panels
@@ -34,23 +45,40 @@
 """
 
 import os
-import io
 import sys
 import time
-import pandas as pd
 import psycopg2
 import psycopg2.extras
 import rasterio
-from rasterstats import zonal_stats
+from shapely import wkb
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
 
 from cbm.utils import config
 from cbm.datas import db, object_storage
+from cbm.extract import zonal, windows, signatures, db_tables
 
+updateSql = """
+UPDATE {} SET status='{}'
+WHERE id = {} And status = '{}'
+"""
 
-def main(startdate, enddate, parcels_table=None, results_table=None,
-         dias=None, dias_catalogue=None):
-    start = time.time()
 
+class SceneError(Exception):
+    """The scene can not be processed, 'status' is stored in the catalogue."""
+
+    def __init__(self, status, message=None):
+        super().__init__(message or status)
+        self.status = status
+
+
+def settings(parcels_table=None, results_table=None, dias=None,
+             dias_catalogue=None, windowed=False):
+    """Get the extraction settings, missing values are read from config.
+
+    With windowed=True the images are not downloaded, only the windows
+    covered by the parcels are read from the object storage.
+    """
     values = config.read()
     dsc = values['set']['dataset']
     if dias_catalogue is None:
@@ -61,64 +89,67 @@ def main(startdate, enddate, parcels_table=None, results_table=None,
         results_table = values['dataset'][dsc]['tables']['s2']
     if dias is None:
         dias = values['s3']['dias']
+    pid_column = config.get_value(['dataset', dsc, 'columns', 'parcels_id'])
+    return {'parcels_table': parcels_table, 'results_table': results_table,
+            'dias': dias, 'dias_catalogue': dias_catalogue,
+            'pid_column': pid_column, 'windowed': windowed}
 
-    inconn = db.connection()
-    if not inconn:
-        print("No in connection established")
-        sys.exit(1)
-
-    outconn = db.connection()
-    if not outconn:
-        print("No out connection established")
-        sys.exit(1)
 
-    incurs = inconn.cursor()
-    srid = -1
+def get_srid(conn, parcels_table):
+    """Get the srid of the parcels table, -1 if it is not a spatial table."""
     sridSql = "SELECT srid FROM geometry_columns WHERE f_table_name = '{}';"
+    with conn.cursor() as cur:
+        cur.execute(sridSql.format(parcels_table))
+        result = cur.fetchone()
+    conn.commit()
+    if not result:
+        print(f"{parcels_table} does not exist or is not a spatial table")
+        return -1
+    return result[0]
 
-    try:
-        incurs.execute(sridSql.format(parcels_table))
-        result = incurs.fetchone()
-        if not result:
-            print("{} does not exist or is not a spatial table")
-        else:
-            srid = result[0]
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-        inconn.close()
-        sys.exit(1)
-    # print("Parcel srid = ", srid)
-
-    # Get the first image record that is not yet processed
-    imagesql = f"""
-    SELECT id, reference, obstime FROM {dias_catalogue}
-    WHERE obstime between '{startdate}' And '{enddate}'
-    And status ='ingested' And card = 's2'
-    ORDER by obstime asc LIMIT 1
+
+def claim_scene(conn, dias_catalogue, startdate, enddate):
+    """Claim the first ingested S2 scene and set its status to 'inprogress'.
+
+    The row is locked with FOR UPDATE SKIP LOCKED, so concurrent workers
+    never claim the same scene and do not wait for each other.
+
+    Returns:
+        (id, reference) of the scene or None if no scene is left.
     """
-    updateSql = """
-    UPDATE {} SET status='{}'
-    WHERE id = {} And status = '{}'
+    claimSql = f"""
+    UPDATE {dias_catalogue} SET status = 'inprogress'
+    WHERE id = (
+        SELECT id FROM {dias_catalogue}
+        WHERE obstime between '{startdate}' And '{enddate}'
+        And status = 'ingested' And card = 's2'
+        ORDER by obstime asc LIMIT 1
+        FOR UPDATE SKIP LOCKED)
+    RETURNING id, reference;
     """
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(claimSql)
+            return cur.fetchone()
 
-    with inconn:
-        with inconn.cursor() as trans_cur:
-            trans_cur.execute(imagesql)
-            result = trans_cur.fetchone()
-            if not result:
-                print("All signatures for the given dates have been extracted.")
-                inconn.close()
-                sys.exit(1)
-            else:
-                oid = result[0]
-                reference = result[1]
-                obstime = result[2]
-            # Fails if this record is changed in the meantime
-            trans_cur.execute(updateSql.format(
-                dias_catalogue, 'inprogress', oid, 'ingested'))
 
+def set_status(conn, dias_catalogue, oid, status, current='inprogress'):
+    """Set the status of a scene, only if it still has the current status."""
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(updateSql.format(dias_catalogue, status[:12], oid,
+                                         current))
+
+
+def scene_keys(reference, dias):
+    """Get the S3 keys of the B4, B8 and SC images of a scene.
+
+    Returns:
+        A dictionary with a list of candidate keys for each band.
+    Raises:
+        SceneError if the scene is not available.
+    """
     obstime = reference.split('_')[2][0:8]
-    # print(obstime)
     obs_path = "{}/{}/{}".format(obstime[0:4], obstime[4:6], obstime[6:8])
 
     mgrs_tile = reference.split('_')[5]
@@ -139,20 +170,12 @@ def main(startdate, enddate, parcels_table=None, results_table=None,
 
     flist = object_storage.list_files(s3path)
     if not flist:
-        print("Resource {} not available in S3 storage (FATAL)".format(s3path))
-        incurs.execute(updateSql.format(
-            dias_catalogue, 'S2_nopath', oid, 'inprogress'))
-        inconn.commit()
-        incurs.close()
-        inconn.close()
-        sys.exit(1)
+        raise SceneError('S2_nopath', "Resource {} not available in S3 "
+                         "storage (FATAL)".format(s3path))
 
     # We want 3 image files only, e.g. to create NDVI
     # SOBLOO does not produce 10 m L2A bands and only B8A (not B08)
     s3subdir = flist[1]['Key'].replace(s3path, '').split('/')[0]
-    # print(s3path)
-    # print(flist[1])
-    # print(s3subdir)
 
     selection = {
         'B4': '{}/{}_{}_{}_{}.jp2'.format(
@@ -163,164 +186,378 @@ def main(startdate, enddate, parcels_table=None, results_table=None,
             'R20m', mgrs_tile, full_tstamp, 'SCL', '20m')
     }
 
+    # LEVEL2AP has another naming convention.
+    return {k: ['{}{}/IMG_DATA/{}'.format(s3path, s3subdir, s),
+                '{}{}/IMG_DATA/{}'.format(s3path, s3subdir,
+                                          s.replace('0m/', '0m/L2A_'))]
+            for k, s in selection.items()}
+
+
+def download_scene(reference, dias, tmp='tmp'):
+    """Copy the B4, B8 and SC images of a scene from S3 to local disk.
+
+    Returns:
+        A dictionary with the local file of each band.
+    Raises:
+        SceneError if the images are not available.
+    """
     file_set = {}
 
     # Copy input data from S3 to local disk
-    for k in selection.keys():
-        s = selection.get(k)
-        fpath = f"tmp/{s.split('/')[-1]}"
-        alt_s = s.replace('0m/', '0m/L2A_')
-
-        if object_storage.get_file('{}{}/IMG_DATA/{}'.format(
-                s3path, s3subdir, s), fpath) == 1:
-            #             print("Image {} found in bucket".format(s))
-            file_set[k] = fpath
-        elif object_storage.get_file('{}{}/IMG_DATA/{}'.format(
-                s3path, s3subdir, alt_s), fpath) == 1:
-            # LEVEL2AP has another naming convention.
-            #             print("Image {} found in bucket".format(alt_s))
-            file_set[k] = fpath
+    for k, keys in scene_keys(reference, dias).items():
+        for key in keys:
+            fpath = f"{tmp}/{key.split('/')[-1].replace('L2A_', '')}"
+            if object_storage.get_file(key, fpath) == 1:
+                file_set[k] = fpath
+                break
         else:
-            print("Neither Image {} nor {} found in bucket".format(s, alt_s))
-            incurs.execute(updateSql.format(
-                dias_catalogue, '{} notfound'.format(k), oid, 'inprogress'))
-            inconn.commit()
-            incurs.close()
-            inconn.close()
-            sys.exit(1)
+            remove_files(file_set)
+            raise SceneError(f'{k} notfound', "Neither Image {} nor {} "
+                             "found in bucket".format(*keys))
 
-    # Get the parcel polygon in this image' footprint
-    print(f"Downloaded '*{file_set['B4'][4:-12]}*' images ...")
+    return file_set
 
-    outsrid = int(f'326{mgrs_tile[1:3]}')
 
-    incurs.close()
+def locate_scene(reference, dias):
+    """Get the '/vsis3/' paths of the B4, B8 and SC images of a scene.
 
-    outconn = db.connection()
-    if not outconn:
-        print("No out connection established")
-        sys.exit(1)
+    Nothing is downloaded, the images are read window by window during the
+    extraction (see extract_scene).
 
-    # Open a named cursor
-    incurs = inconn.cursor(name='fetch_image_coverage',
-                           cursor_factory=psycopg2.extras.DictCursor)
-    dataset = config.get_value(['set', 'dataset'])
-    pid_column = config.get_value(
-        ['dataset', dataset, 'columns', 'parcels_id'])
+    Returns:
+        A dictionary with the '/vsis3/' path of each band.
+    Raises:
+        SceneError if the images are not available.
+    """
+    file_set = {}
+    for k, keys in scene_keys(reference, dias).items():
+        for key in keys:
+            if object_storage.exists(key):
+                file_set[k] = object_storage.vsis3_path(key)
+                break
+        else:
+            raise SceneError(f'{k} notfound', "Neither Image {} nor {} "
+                             "found in bucket".format(*keys))
+    return file_set
+
+
+def fetch_scene(reference, sets):
+    """Download or locate (windowed mode) the images of a scene."""
+    if sets.get('windowed'):
+        return locate_scene(reference, sets['dias'])
+    return download_scene(reference, sets['dias'])
+
+
+def remove_files(file_set):
+    for f in file_set.keys():
+        if os.path.exists(file_set.get(f)):
+            os.remove(file_set.get(f))
+
+
+def parcels_sql(conn, oid, outsrid, srid, parcels_table, dias_catalogue,
+                pid_column):
+    """Get the query of the parcels in the footprint of a scene.
 
-    parcelsql = f"""
+    The precomputed extraction table (see db_tables.setup_extraction_table)
+    is used if it has the UTM zone of the scene, the parcels are then
+    selected with an index scan and returned as WKB.
+    """
+    if outsrid in db_tables.extraction_zones(conn, parcels_table):
+        return f"""
+        SELECT p.pid, p.wkb_{outsrid}
+        FROM {db_tables.extraction_table(parcels_table)} p,
+            {dias_catalogue} dc
+        WHERE p.geom && dc.footprint
+        And p.area > {db_tables.MIN_AREA}
+        And dc.id = {oid}
+        """
+    return f"""
     SELECT p.{pid_column}, ST_AsGeoJSON(st_transform(p.wkb_geometry,
         {outsrid}))::json
     FROM {parcels_table} p, {dias_catalogue} dc
     WHERE p.wkb_geometry && st_transform(dc.footprint, {srid})
-    And st_area(p.wkb_geometry) > 3000.0
+    And st_area(p.wkb_geometry) > {db_tables.MIN_AREA}
     And dc.id = {oid}
-    -- And p.{pid_column} not in (SELECT distinct pid
-    --     FROM {results_table} where obsid = {oid})
     """
-    incurs.execute(parcelsql)
 
-    sqlload = time.time() - start
-    print(f"Features selected from database in {sqlload} seconds")
 
-    nrows = {}
-    for k in file_set.keys():
-        nrows[k] = 0
+def load_geometries(rowset):
+    """Get the (pid, geometry) rows, WKB geometries are loaded with shapely.
+    """
+    return [(f[0], wkb.loads(bytes(f[1]))
+             if isinstance(f[1], (bytes, memoryview)) else f[1])
+            for f in rowset]
 
-    affine = {}
-    array = {}
 
-    bands = file_set.keys()
+def write_block(writer, oid, rowset, rasters):
+    """Compute the signatures of a block of parcels and add them to the
+    signatures writer."""
+    geometries = [f[1] for f in rowset]
+    pids = [int(f[0]) for f in rowset]
+    stats = zonal.block_stats(geometries, pids, rasters)
 
-    for b in bands:
-        with rasterio.open(file_set.get(b)) as src:
-            affine[b] = src.transform
-            array[b] = src.read(1)
+    for b in rasters.keys():
+        if len(stats[b]['pid']) > 0:
+            writer.add(stats[b], oid, b)
+        else:
+            print(f"No valid data in block of {b}")
 
-    print(f"Extracting signatures for '*{file_set['B4'][4:-12]}* images ...'")
-    while True:
-        rowset = incurs.fetchmany(size=2000)
 
-        if not rowset:
-            break
+def extract_scene(inconn, outconn, oid, reference, file_set, srid,
+                  parcels_table, results_table, dias_catalogue, pid_column,
+                  windowed=False):
+    """Extract the signatures of the parcels in the scene footprint.
 
-        features = {"type": "FeatureCollection",
-                    "features": [{"type": "feature", "geometry": f[1],
-                                  "properties": {"pid": int(f[0])}} for f in rowset]}
+    With windowed=True the file_set holds '/vsis3/' paths and only the
+    (block aligned, merged) windows covered by the parcels are read.
 
-        for b in bands:
+    Returns:
+        A dictionary with the number of extracted parcels per band.
+    """
+    mgrs_tile = reference.split('_')[5]
+    outsrid = int(f'326{mgrs_tile[1:3]}')
 
-            zs = zonal_stats(features, array[b], affine=affine[b], stats=[
-                             "count", "mean", "std", "min", "max",
-                             "percentile_25", "percentile_50",
-                             "percentile_75"],
-                             prefix="", nodata=0, geojson_out=True)
-
-            df = pd.DataFrame(zs)
-
-            df = pd.DataFrame.from_dict(
-                df.properties.to_dict(), orient='index')
-
-            df['obsid'] = oid
-            df['band'] = b
-
-            df.rename(index=str, columns={
-                      "percentile_25": "p25", "percentile_50": "p50",
-                      "percentile_75": "p75"}, inplace=True)
-
-            nrows[b] = nrows[b] + len(df)
-            # df is the dataframe
-            if len(df) > 0:
-                df.dropna(inplace=True)
-                if len(df.values) > 0:
-                    df_columns = list(df)
-                    s_buf = io.StringIO()
-                    df.to_csv(s_buf, header=False, index=False, sep=',')
-                    s_buf.seek(0)
-                    outcurs = outconn.cursor()
-                    # print(tuple(df_columns))
-                    try:
-                        #psycopg2.extras.execute_batch(outcurs, insert_stmt, df.values)
-                        outcurs.copy_from(s_buf, results_table,
-                                          columns=tuple(df_columns), sep=',')
-                        outconn.commit()
-                    except psycopg2.IntegrityError as e:
-                        print(
-                            f"insert statement {insert_stmt} contains duplicate index", e)
-                    # except Exception as e:
-                    #     print(e)
-                    finally:
-                        outcurs.close()
-                else:
-                    print(f"No valid data in block {nrows[b]}")
+    # Open a named cursor
+    incurs = inconn.cursor(name='fetch_image_coverage',
+                           cursor_factory=psycopg2.extras.DictCursor)
 
-    outconn.close()
+    parcelsql = parcels_sql(inconn, oid, outsrid, srid, parcels_table,
+                            dias_catalogue, pid_column)
+    incurs.execute(parcelsql)
+
+    writer = signatures.SignatureWriter(outconn, results_table)
+    bands = file_set.keys()
+    nrows = {}
+    for k in bands:
+        nrows[k] = 0
 
+    if windowed:
+        blocks = []
+        while True:
+            rowset = incurs.fetchmany(size=2000)
+            if not rowset:
+                break
+            rowset = load_geometries(rowset)
+            blocks.append(rowset)
+            for b in bands:
+                nrows[b] = nrows[b] + len(rowset)
+
+        readdir = {'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR'}
+        with object_storage.vsis3_env(**readdir):
+            sources = {b: rasterio.open(file_set.get(b)) for b in bands}
+            try:
+                for indices, rasters in windows.read_blocks(
+                        sources, [[f[1] for f in r] for r in blocks]):
+                    for i in indices:
+                        write_block(writer, oid, blocks[i], rasters)
+            finally:
+                for src in sources.values():
+                    src.close()
+    else:
+        rasters = {}
+        for b in bands:
+            with rasterio.open(file_set.get(b)) as src:
+                rasters[b] = (src.read(1), src.transform)
+
+        while True:
+            rowset = incurs.fetchmany(size=2000)
+            if not rowset:
+                break
+            rowset = load_geometries(rowset)
+            for b in bands:
+                nrows[b] = nrows[b] + len(rowset)
+            write_block(writer, oid, rowset, rasters)
+
+    # One transaction per scene.
+    writer.commit()
     incurs.close()
+    inconn.commit()
+    return nrows
+
 
-    incurs = inconn.cursor()
+def process_scene(inconn, outconn, oid, reference, file_set, srid, sets):
+    """Extract a downloaded scene and store the result as the scene status.
 
+    Failures are stored as the status of the scene instead of raised.
+
+    Returns:
+        A dictionary with the scene processing statistics.
+    """
+    start = time.time()
+    status = 'extracted'
+    nrows = {}
     try:
-        incurs.execute(updateSql.format(
-            dias_catalogue, 'extracted', oid, 'inprogress'))
-        inconn.commit()
+        nrows = extract_scene(
+            inconn, outconn, oid, reference, file_set, srid,
+            sets['parcels_table'], sets['results_table'],
+            sets['dias_catalogue'], sets['pid_column'], sets['windowed'])
+    except Exception as err:
+        print(f"Extraction of {reference} failed: {err}")
+        inconn.rollback()
+        outconn.rollback()
+        status = 'failed'
+    finally:
+        remove_files(file_set)
+    set_status(inconn, sets['dias_catalogue'], oid, status)
+
+    seconds = time.time() - start
+    features = max(nrows.values(), default=0)
+    print(f"{reference}: {status}, {features} features in {seconds:.1f}",
+          f"seconds ({features / max(seconds, 1e-6):.1f} features/s)")
+    return {'id': oid, 'reference': reference, 'status': status,
+            'features': features, 'seconds': seconds}
+
+
+def main(startdate, enddate, parcels_table=None, results_table=None,
+         dias=None, dias_catalogue=None, windowed=False):
+    """Extract the signatures of the first not yet processed scene."""
+    start = time.time()
+    sets = settings(parcels_table, results_table, dias, dias_catalogue,
+                    windowed)
+
+    inconn = db.conn()
+    if not inconn:
+        print("No in connection established")
+        sys.exit(1)
+
+    outconn = db.conn()
+    if not outconn:
+        print("No out connection established")
+        sys.exit(1)
+
+    try:
+        srid = get_srid(inconn, sets['parcels_table'])
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
         inconn.close()
-        if outconn:
-            outconn.close()
+        sys.exit(1)
 
-    incurs.close()
-    inconn.close()
+    # Get the first image record that is not yet processed
+    result = claim_scene(inconn, sets['dias_catalogue'], startdate, enddate)
+    if not result:
+        print("All signatures for the given dates have been extracted.")
+        inconn.close()
+        sys.exit(1)
+    oid, reference = result
 
-    print(f"Removing '*{file_set['B4'][4:-12]}*' images.")
-    for f in file_set.keys():
-        if os.path.exists(file_set.get(f)):
-            print(f"Removing {file_set.get(f)}")
-            os.remove(file_set.get(f))
+    try:
+        file_set = fetch_scene(reference, sets)
+    except SceneError as err:
+        print(err)
+        set_status(inconn, sets['dias_catalogue'], oid, err.status)
+        inconn.close()
+        sys.exit(1)
+    if not windowed:
+        print(f"Downloaded '*{file_set['B4'][4:-12]}*' images ...")
+
+    stats = process_scene(inconn, outconn, oid, reference, file_set, srid,
+                          sets)
+
+    outconn.close()
+    inconn.close()
 
     print("Total time required for {} features and {} bands: {} seconds".format(
-        nrows.get('B8'), len(bands), time.time() - start))
+        stats['features'], len(file_set), time.time() - start))
+
+
+def _worker_loop(startdate, enddate, sets):
+    """Claim and process scenes until no scene is left.
+
+    The next scene is claimed and downloaded in a background thread while
+    the signatures of the current scene are extracted.
+    """
+    inconn = db.conn()
+    outconn = db.conn()
+    claimconn = db.conn()
+    srid = get_srid(inconn, sets['parcels_table'])
+    stats = []
+
+    def prefetch():
+        while True:
+            result = claim_scene(claimconn, sets['dias_catalogue'],
+                                 startdate, enddate)
+            if not result:
+                return None
+            oid, reference = result
+            try:
+                return oid, reference, fetch_scene(reference, sets)
+            except SceneError as err:
+                print(err)
+                set_status(claimconn, sets['dias_catalogue'], oid,
+                           err.status)
+                stats.append({'id': oid, 'reference': reference,
+                              'status': err.status, 'features': 0,
+                              'seconds': 0})
+            except Exception as err:
+                print(f"Download of {reference} failed: {err}")
+                set_status(claimconn, sets['dias_catalogue'], oid, 'failed')
+
+    scene = None
+    with ThreadPoolExecutor(max_workers=1) as downloader:
+        next_scene = downloader.submit(prefetch)
+        try:
+            while True:
+                scene = next_scene.result()
+                if scene is None:
+                    break
+                next_scene = downloader.submit(prefetch)
+                stats.append(process_scene(inconn, outconn, *scene, srid,
+                                           sets))
+                scene = None
+        finally:
+            # Release the claimed scenes that were not processed.
+            pending = [scene]
+            if not next_scene.cancel():
+                try:
+                    pending.append(next_scene.result())
+                except Exception:
+                    pass
+            for s in pending:
+                if s is not None:
+                    remove_files(s[2])
+                    set_status(claimconn, sets['dias_catalogue'], s[0],
+                               'ingested')
+
+    for conn in (inconn, outconn, claimconn):
+        conn.close()
+    return stats
+
+
+def worker(startdate, enddate, processes=4, parcels_table=None,
+           results_table=None, dias=None, dias_catalogue=None,
+           windowed=False):
+    """Long running extraction of all the ingested scenes in a date range.
+
+    Runs 'processes' worker processes, each one claims scenes with
+    SELECT ... FOR UPDATE SKIP LOCKED until no ingested scene is left.
+    Downloads of the next scene overlap with the extraction of the current
+    one, failures are stored as the scene status and do not stop the worker.
+    With windowed=True only the image windows covered by parcels are read.
+
+    Returns:
+        A list of dictionaries with per scene statistics.
+    """
+    start = time.time()
+    sets = settings(parcels_table, results_table, dias, dias_catalogue,
+                    windowed)
+
+    stats = []
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        jobs = [pool.submit(_worker_loop, startdate, enddate, sets)
+                for _ in range(processes)]
+        for job in as_completed(jobs):
+            try:
+                stats.extend(job.result())
+            except Exception as err:
+                print(f"Worker stopped: {err}")
+
+    seconds = time.time() - start
+    extracted = [s for s in stats if s['status'] == 'extracted']
+    features = sum(s['features'] for s in extracted)
+    print(f"{len(extracted)} of {len(stats)} scenes extracted,",
+          f"{features} features in {seconds:.1f} seconds",
+          f"({len(extracted) * 3600 / max(seconds, 1e-6):.1f} scenes/hour).")
+    return stats
 
 
 if __name__ == "__main__":
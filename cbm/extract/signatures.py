@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Write the extracted signatures to the database.
+
+The statistics of each block and band (see zonal.block_stats) are encoded
+in typed NumPy arrays and streamed with binary COPY into a temporary staging
+table. On commit the staging rows are moved to the signatures table in one
+statement and the transaction is committed, once per scene.
+
+Duplicate (pid, obsid, band) rows, e.g. from a scene processed again, are
+updated if the signatures table has a primary key (or unique index) on these
+columns, otherwise they are only removed within the scene.
+
+Example:
+    writer = signatures.SignatureWriter(outconn, 'sigs_2020_s2')
+    for rowset in blocks:
+        stats = zonal.block_stats(geometries, pids, rasters)
+        for b in stats:
+            writer.add(stats[b], oid, b)
+    writer.commit()
+"""
+
+import io
+import numpy as np
+
+from cbm.extract.zonal import STATS
+
+BUFFER_ROWS = 200000  # Rows to buffer before they are sent to the database.
+STAGING = 'sigs_staging'  # Name of the temporary staging table.
+
+_header = b'PGCOPY\n\xff\r\n\x00' + np.array([0, 0], '>i4').tobytes()
+_trailer = np.array([-1], '>i2').tobytes()
+
+
+def encode(stats, oid, band):
+    """Encode the statistics of a band as binary COPY tuples.
+
+    The fields are (pid bigint, obsid bigint, band text, count ... p75 real).
+    """
+    band = band.encode()
+    fields = [('pid', '>i8'), ('obsid', '>i8'), ('band', f'S{len(band)}')]
+    fields += [(s, '>f4') for s in STATS]
+    dtype = [('nfields', '>i2')]
+    for name, ftype in fields:
+        dtype += [(f'len_{name}', '>i4'), (name, ftype)]
+
+    n = len(stats['pid'])
+    rows = np.empty(n, dtype=dtype)
+    rows['nfields'] = len(fields)
+    for name, ftype in fields:
+        rows[f'len_{name}'] = np.dtype(ftype).itemsize
+    rows['pid'] = stats['pid']
+    rows['obsid'] = oid
+    rows['band'] = band
+    for s in STATS:
+        rows[s] = stats[s]
+    return rows.tobytes()
+
+
+class SignatureWriter:
+    """Buffer signatures and store them with binary COPY."""
+
+    def __init__(self, conn, table, buffer_rows=BUFFER_ROWS):
+        self.conn = conn
+        self.table = table
+        self.buffer_rows = buffer_rows
+        self._chunks = []
+        self._buffered = 0
+        self._staged = 0
+        self._key = None
+        self.rows = 0  # Rows committed by this writer.
+
+    def _create_staging(self):
+        columns = ', '.join(f'{s} real' for s in STATS)
+        with self.conn.cursor() as cur:
+            cur.execute(f"""
+                CREATE TEMP TABLE IF NOT EXISTS {STAGING} (
+                    pid bigint, obsid bigint, band text, {columns}
+                ) ON COMMIT DELETE ROWS;""")
+
+    def _has_key(self):
+        """Check for a unique index on (pid, obsid, band) of the table."""
+        if self._key is None:
+            with self.conn.cursor() as cur:
+                cur.execute("""
+                    SELECT count(*) FROM pg_index i
+                    WHERE i.indrelid = %s::regclass And i.indisunique
+                    And (SELECT array_agg(a.attname::text ORDER BY a.attname)
+                         FROM pg_attribute a
+                         WHERE a.attrelid = i.indrelid
+                         And a.attnum = ANY(i.indkey))
+                        = ARRAY['band', 'obsid', 'pid'];
+                    """, (self.table,))
+                self._key = cur.fetchone()[0] > 0
+        return self._key
+
+    def add(self, stats, oid, band):
+        """Add the statistics of a band of a block of parcels."""
+        n = len(stats['pid'])
+        if n == 0:
+            return
+        self._chunks.append(encode(stats, oid, band))
+        self._buffered += n
+        if self._buffered >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        """Send the buffered rows to the staging table."""
+        if not self._chunks:
+            return
+        if self._staged == 0:
+            self._create_staging()
+        data = io.BytesIO(b''.join([_header] + self._chunks + [_trailer]))
+        with self.conn.cursor() as cur:
+            cur.copy_expert(f"COPY {STAGING} FROM STDIN (FORMAT binary)",
+                            data)
+        self._staged += self._buffered
+        self._chunks = []
+        self._buffered = 0
+
+    def commit(self):
+        """Move the staged rows to the signatures table and commit.
+
+        Returns:
+            The number of rows written.
+        """
+        self.flush()
+        if self._staged == 0:
+            self.conn.commit()
+            return 0
+        columns = ', '.join(('pid', 'obsid', 'band') + STATS)
+        select = f"""
+            SELECT DISTINCT ON (pid, obsid, band) {columns}
+            FROM {STAGING} ORDER BY pid, obsid, band"""
+        if self._has_key():
+            updates = ', '.join(f'{s} = excluded.{s}' for s in STATS)
+            sql = f"""
+                INSERT INTO {self.table} ({columns}) {select}
+                ON CONFLICT (pid, obsid, band) DO UPDATE SET {updates};"""
+        else:
+            sql = f"INSERT INTO {self.table} ({columns}) {select};"
+        with self.conn.cursor() as cur:
+            cur.execute(sql)
+            rows = cur.rowcount
+        self.conn.commit()
+        self._staged = 0
+        self.rows += rows
+        return rows
+
+    def rollback(self):
+        """Drop the buffered and staged rows."""
+        self._chunks = []
+        self._buffered = 0
+        self._staged = 0
+        self.conn.rollback()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+"""
+Windowed reads of the image parts covered by blocks of parcels.
+
+The bounding window of each block of parcels is expanded to the internal
+tiles (blocks) of the image, overlapping or adjacent windows are merged and
+only the merged windows are read. With '/vsis3/' paths GDAL fetches only the
+byte ranges of the tiles in these windows (COG, tiled JP2), instead of
+downloading the full scene.
+
+Example:
+    from cbm.datas import object_storage
+    from cbm.extract import windows, zonal
+
+    with object_storage.vsis3_env():
+        sources = {b: rasterio.open(object_storage.vsis3_path(k))
+                   for b, k in keys.items()}
+        for indices, rasters in windows.read_blocks(sources, blocks):
+            for i in indices:
+                stats = zonal.block_stats(blocks[i], pids[i], rasters)
+"""
+
+import rasterio.windows
+from rasterio.windows import Window
+
+from cbm.extract import zonal
+
+MAX_PIXELS = 4096 * 4096  # The largest merged window in reference pixels.
+GAP = 0  # Merge windows that are less than GAP pixels apart.
+
+
+def align(window, block_shape, shape):
+    """Expand a window to the internal blocks of the image.
+
+    Arguments:
+        window, a rasterio Window with integer offsets
+        block_shape, the (rows, cols) of the image internal blocks
+        shape, the (rows, cols) shape of the image
+
+    Returns:
+        The block aligned window, clipped to the image.
+    """
+    if window.width == 0 or window.height == 0:
+        return window
+    bh, bw = block_shape
+    row0 = (int(window.row_off) // bh) * bh
+    col0 = (int(window.col_off) // bw) * bw
+    row1 = min(-(-int(window.row_off + window.height) // bh) * bh, shape[0])
+    col1 = min(-(-int(window.col_off + window.width) // bw) * bw, shape[1])
+    return Window(col0, row0, col1 - col0, row1 - row0)
+
+
+def _near(a, b, gap):
+    return (a.col_off - gap <= b.col_off + b.width and
+            b.col_off - gap <= a.col_off + a.width and
+            a.row_off - gap <= b.row_off + b.height and
+            b.row_off - gap <= a.row_off + a.height)
+
+
+def coalesce(windows, max_pixels=MAX_PIXELS, gap=GAP):
+    """Merge overlapping or adjacent windows.
+
+    Windows are merged greedily, as long as the merged window has no more
+    than max_pixels pixels. Empty windows (outside the image) are dropped.
+
+    Returns:
+        A list of (merged window, [indices of the windows it covers]).
+    """
+    groups = []
+    order = sorted((i for i, w in enumerate(windows)
+                    if w.width > 0 and w.height > 0),
+                   key=lambda i: (windows[i].row_off, windows[i].col_off))
+    for i in order:
+        w = windows[i]
+        for g, (gw, indices) in enumerate(groups):
+            if _near(gw, w, gap):
+                union = rasterio.windows.union(gw, w)
+                if union.width * union.height <= max_pixels:
+                    groups[g] = (union, indices + [i])
+                    break
+        else:
+            groups.append((w, [i]))
+    return groups
+
+
+def read_blocks(sources, blocks, band=1, max_pixels=MAX_PIXELS, gap=GAP):
+    """Read the image windows covered by blocks of geometries.
+
+    The windows are computed and merged on the grid of the finest source,
+    the other sources are read over the same area on their own grid.
+
+    Arguments:
+        sources, a dictionary {band name: open rasterio dataset}
+        blocks, a list of lists of geometries in the image crs
+
+    Yields:
+        ([indices of the blocks], {band name: (array, transform)}) for each
+        merged window, the rasters can be passed to zonal.block_stats.
+    """
+    ref = min(sources.values(), key=lambda src: src.res[0])
+    windows = [align(zonal.block_window(g, ref.transform, ref.shape),
+                     ref.block_shapes[band - 1], ref.shape) for g in blocks]
+    for window, indices in coalesce(windows, max_pixels, gap):
+        bounds = rasterio.windows.bounds(window, ref.transform)
+        rasters = {}
+        for name, src in sources.items():
+            w = align(zonal.bounds_window(bounds, src.transform, src.shape),
+                      src.block_shapes[band - 1], src.shape)
+            rasters[name] = (src.read(band, window=w),
+                             src.window_transform(w))
+        yield indices, rasters
@@ -9,9 +9,11 @@
 
 
 import os
+import copy
 import time
 import json
 import uuid
+import threading
 from os.path import dirname, abspath, join, normpath, exists, isfile
 
 path_work = abspath(os.curdir)
@@ -20,6 +22,9 @@ path_conf = 'config'
 conf_main = 'main.json'
 path_default = normpath(join(dirname(abspath(__file__)), 'default'))
 
+_cache = {}  # Parsed configuration files {path: (mtime, size, dict)}.
+_lock = threading.Lock()
+
 
 def get_value(dict_keys={}, file=conf_main, var_name=None, help_text=True):
     """Get value from a configuration file, with an arbitrary length key.
@@ -40,22 +45,18 @@ def get_value(dict_keys={}, file=conf_main, var_name=None, help_text=True):
             'The value for 'AOI' is: 'MyAOI'.'
     """
 
-    config_dict = read(file)
+    config_dict = load(file)
     try:
         if len(dict_keys) == 1:
             value = config_dict.get(dict_keys[0])
         else:
             dict_keys = [s.strip() for s in dict_keys]
+            _x = config_dict
             for key in dict_keys[:-1]:
-                if '_x' not in locals():
-                    if key not in config_dict:
-                        config_dict[key] = {}
-                    _x = config_dict.get(key)
-                else:
-                    if key not in _x:
-                        _x[key] = {}
-                    _x = _x.get(key)
+                _x = _x.get(key, {})
             value = _x[dict_keys[-1]]
+        if isinstance(value, (dict, list)):
+            value = copy.deepcopy(value)
         if var_name is not None and help_text is True:
             if value != '':
                 print(f"The value for '{var_name}' is: '{value}'.")
@@ -104,6 +105,7 @@ def set_value(dict_keys={}, val=None, file=conf_main):
         except WindowsError:
             os.remove(normpath(join(path_conf, file)))
             os.rename(tempfile, normpath(join(path_conf, file)))
+        invalidate(file)
     except Exception as err:
         print(f"Could not update key in the file '{file}': {err}")
 
@@ -143,6 +145,7 @@ def delete(dict_keys={}, file=conf_main):
         except WindowsError:
             os.remove(normpath(join(path_conf, file)))
             os.rename(tempfile, normpath(join(path_conf, file)))
+        invalidate(file)
     except Exception as err:
         print(f"Could not delete key in the file '{file}': {err}")
 
@@ -156,18 +159,49 @@ def read(file=conf_main):
         file (str): the name of the configuration file
 
     Returns:
-        data - A python dict of the selected file.
+        data - A python dict of the selected file (a copy that can be
+            modified).
+
+    """
+    return copy.deepcopy(load(file))
+
+
+def load(file=conf_main):
+    """Get the parsed configuration file from the in-process cache.
 
+    The file is parsed again only if its modification time or size changed,
+    or after set_value, delete or update_keys. The returned dict is shared,
+    it must not be modified (use read).
     """
+    path = normpath(join(path_conf, file))
     try:
-        with open(normpath(join(path_conf, file)), 'r') as f:
+        st = os.stat(path)
+    except OSError:
+        create(file)
+        st = os.stat(path)
+    with _lock:
+        entry = _cache.get(path)
+        if entry is not None and entry[:2] == (st.st_mtime_ns, st.st_size):
+            return entry[2]
+    try:
+        with open(path, 'r') as f:
             data = json.load(f)
-            return data
     except Exception:
         create(file)
-        with open(normpath(join(path_conf, file)), 'r') as f:
+        with open(path, 'r') as f:
             data = json.load(f)
-        return data
+    with _lock:
+        _cache[path] = (st.st_mtime_ns, st.st_size, data)
+    return data
+
+
+def invalidate(file=None):
+    """Drop a configuration file (or all files) from the cache."""
+    with _lock:
+        if file is None:
+            _cache.clear()
+        else:
+            _cache.pop(normpath(join(path_conf, file)), None)
 
 
 def create(to_file=conf_main, from_=path_default):
@@ -222,6 +256,7 @@ def update_keys(from_=path_default, to_file=conf_main):
     except WindowsError:
         os.remove(normpath(join(path_conf, to_file)))
         os.rename(tempfile, normpath(join(path_conf, to_file)))
+    invalidate(to_file)
 
     if updated_keys > 0:
         print(f"{updated_keys+1} new json configuration",
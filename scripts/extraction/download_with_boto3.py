@@ -13,6 +13,8 @@ import boto3
 import botocore
 import json
 
+from cbm.datas import scene_cache
+
 
 def getFileFromS3(s3file, localfile, bucket=None):
     with open('s3_config.json', 'r') as f:
@@ -28,7 +30,17 @@ def getFileFromS3(s3file, localfile, bucket=None):
     # print(s3file)
     # print(localfile)
     try:
-        s3.Bucket(bucket).download_file(s3file, localfile)
+        cache_dir = config['s3'].get('cache_dir')
+        if cache_dir:
+            # Keep the images in the shared scene cache for the next runs.
+            cache = scene_cache.SceneCache(
+                cache_dir, config['s3'].get('cache_size') or
+                scene_cache.CACHE_SIZE)
+            cache.fetch(s3file, s3.Object(bucket, s3file).e_tag, localfile,
+                        lambda tmp: s3.Bucket(bucket).download_file(
+                            s3file, tmp))
+        else:
+            s3.Bucket(bucket).download_file(s3file, localfile)
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == "404":
             # print("The object does not exist.")
@@ -11,14 +11,12 @@
 import time
 import sys
 import os
-import io
 import json
 
 import psycopg2
 import psycopg2.extras
 import rasterio
-import pandas as pd
-from rasterstats import zonal_stats
+from cbm.extract import zonal, signatures
 from datetime import datetime
 
 import download_with_boto3 as dwb
@@ -218,61 +216,29 @@ with rasterio.open(fpath) as src:
         array[b] = src.read(bands.index(b) + 1)
 
 
+writer = signatures.SignatureWriter(
+    outconn, dbconfig['tables']['results_table'])
+
 while True:  # nrows['VV'] < 2:
     rowset = incurs.fetchmany(size=2000)
 
     if not rowset:
         break
 
-    features = {"type": "FeatureCollection",
-                "features": [{"type": "feature", "geometry": f[1],
-                              "properties": {"pid": int(f[0])}} for f in rowset]}
+    geometries = [f[1] for f in rowset]
+    pids = [int(f[0]) for f in rowset]
+    stats = zonal.block_stats(geometries, pids,
+                              {b: (array[b], affine[b]) for b in bands})
 
     for b in bands:
-
-        zs = zonal_stats(features, array[b], affine=affine[b], stats=[
-            "count", "mean", "std", "min", "max",
-            "percentile_25", "percentile_50", "percentile_75"], prefix="",
-            nodata=0, geojson_out=True)
-
-        df = pd.DataFrame(zs)
-
-        df = pd.DataFrame.from_dict(df.properties.to_dict(), orient='index')
-
-        df['obsid'] = oid
-        df['band'] = b
-
-        df.rename(index=str, columns={
-                  "percentile_25": "p25", "percentile_50": "p50",
-                  "percentile_75": "p75"}, inplace=True)
-
-        nrows[b] = nrows[b] + len(df)
-        # df is the dataframe
-        if len(df) > 0:
-            df.dropna(inplace=True)
-            if len(df.values) > 0:
-                df_columns = list(df)
-                s_buf = io.StringIO()
-                df.to_csv(s_buf, header=False, index=False, sep=',')
-                s_buf.seek(0)
-                outcurs = outconn.cursor()
-                # print(tuple(df_columns))
-                try:
-                    #psycopg2.extras.execute_batch(outcurs, insert_stmt, df.values)
-                    outcurs.copy_from(
-                        s_buf, dbconfig['tables']['results_table'],
-                        columns=tuple(df_columns), sep=',')
-                    outconn.commit()
-                except psycopg2.IntegrityError as e:
-                    print("insert statement {} contains duplicate index".format(
-                        insert_stmt))
-                # except Error as e:
-                #    print(e)
-                finally:
-                    outcurs.close()
-            else:
-                print("No valid data in block {}".format(nrows[b]))
-
+        nrows[b] = nrows[b] + len(rowset)
+        if len(stats[b]['pid']) > 0:
+            writer.add(stats[b], oid, b)
+        else:
+            print("No valid data in block {}".format(nrows[b]))
+
+# One transaction per scene.
+writer.commit()
 outconn.close()
 
 incurs.close()
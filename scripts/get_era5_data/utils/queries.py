@@ -1,3 +1,4 @@
+import io
 import pandas as pd
 
 
@@ -26,3 +27,25 @@ def era5_grid_query(cursor, aoi):
 
 
 
+
+
+def copy_era5_data(cursor, df):
+    """Bulk load daily data to era5_data: COPY to a temporary table and
+    upsert (the existing grid cell and date rows are updated)."""
+    cols = ','.join(df.columns)
+    data = io.StringIO()
+    df.to_csv(data, index=False, header=False)
+    data.seek(0)
+    cursor.execute("""CREATE TEMP TABLE era5_load
+                    (LIKE public.era5_data INCLUDING DEFAULTS)
+                    ON COMMIT DROP;""")
+    cursor.copy_expert(
+        f"COPY era5_load ({cols}) FROM STDIN WITH (FORMAT csv)", data)
+    cursor.execute(f"""INSERT INTO public.era5_data ({cols})
+                    SELECT {cols} FROM era5_load
+                    ON CONFLICT ON CONSTRAINT era5_data_pkey
+                    DO UPDATE SET
+                    tmin = excluded.tmin,
+                    tmax = excluded.tmax,
+                    tmean = excluded.tmean,
+                    prec = excluded.prec;""")
@@ -8,79 +8,252 @@
 # License   : 3-Clause BSD
 # Created on Tue Sep  7 16:37:12 2021
 
+import io
+import os
+import pandas as pd
+
+# Columns of the marker output
+MARKER_COLUMNS = ["FID", "signal", "type", "start_date", "main_date", \
+                  "stop_date", "duration", "value 1", "value 2", "value 3", \
+                  "properties"]
+
+# Rows kept in memory before they are written to the output
+BUFFER_SIZE = 100000
+
+
+class column_buffer :
+    """
+    Summary:
+        Rows of a sink stored by column. Buffers with the same columns can be
+        merged, e.g. the buffers filled by parallel workers.
+    """
+    def __init__(self, columns : list) :
+        self.columns = list(columns)
+        self.data = {col : [] for col in self.columns}
+
+    def append(self, row : tuple) :
+        for col, value in zip(self.columns, row) :
+            self.data[col].append(value)
+
+    def extend(self, other) :
+        """
+        Summary :
+            Merge the rows of another buffer.
+        """
+        for col in self.columns :
+            self.data[col].extend(other.data[col])
+
+    def __len__(self) :
+        return len(self.data[self.columns[0]])
+
+    def clear(self) :
+        for col in self.columns :
+            self.data[col] = []
+
+    def to_frame(self) -> pd.DataFrame :
+        return pd.DataFrame(self.data, columns = self.columns)
+
+
+class table_writer :
+    """
+    Summary:
+        Write buffers of rows in batches to a csv file, a parquet file or a
+        postgres table (COPY).
+        The output is selected with the "format" option ("csv", "parquet" or
+        "postgres"), by default from the extension of the output file.
+        The postgres output requires the "connection" (host, port, dbname,
+        user, password) and "table" options.
+        The format and its backend (pyarrow, psycopg2) are checked when the
+        writer is created, not at the first write.
+    """
+    def __init__(self, options : dict, default_file : str) :
+        self.filename = options.get("output_file", default_file)
+        self.include_header = options.get("include_header", False)
+        if "format" in options :
+            self.format = options["format"]
+        elif "table" in options :
+            self.format = "postgres"
+        elif os.path.splitext(self.filename)[1] == ".parquet" :
+            self.format = "parquet"
+        else :
+            self.format = "csv"
+
+        if self.format == "parquet" :
+            import pyarrow
+            import pyarrow.parquet
+            self.pa, self.pq = pyarrow, pyarrow.parquet
+        elif self.format == "postgres" :
+            import psycopg2
+            self.psycopg2 = psycopg2
+            for key in ["connection", "table"] :
+                if key not in options :
+                    raise Exception("table_writer() - missing option " + key + \
+                                    " of the postgres output")
+        elif self.format != "csv" :
+            raise Exception("table_writer() - unsupported format " + self.format)
+
+        self.options = options
+        self.started = False
+        self.out = None
+
+    def open(self, df : pd.DataFrame) :
+        """
+        Summary :
+            Create the output, with the columns of the first batch.
+        """
+        if self.format == "csv" :
+            self.out = open(self.filename, 'w', newline = '')
+            if self.include_header :
+                self.out.write(','.join(df.columns) + '\n')
+        elif self.format == "parquet" :
+            self.schema = self.pa.Schema.from_pandas(df, preserve_index = False)
+            self.out = self.pq.ParquetWriter(self.filename, self.schema)
+        elif self.format == "postgres" :
+            self.out = self.psycopg2.connect(**self.options["connection"])
+            types = {'i' : 'bigint', 'f' : 'double precision', 'M' : 'timestamp', 'b' : 'boolean'}
+            columns = ', '.join('"%s" %s' % (col, types.get(df[col].dtype.kind, 'text')) \
+                                for col in df.columns)
+            with self.out.cursor() as cur :
+                cur.execute("CREATE TABLE IF NOT EXISTS %s (%s);" % (self.options["table"], columns))
+        self.started = True
+
+    def write(self, df : pd.DataFrame) :
+        """
+        Summary :
+            Write a batch of rows.
+        """
+        if not self.started :
+            self.open(df)
+        if len(df) == 0 :
+            return
+        if self.format == "csv" :
+            df.to_csv(self.out, header = False, index = False, \
+                      date_format = '%Y-%m-%d', na_rep = 'nan')
+        elif self.format == "parquet" :
+            self.out.write_table(self.pa.Table.from_pandas(df, schema = self.schema, \
+                                                           preserve_index = False))
+        elif self.format == "postgres" :
+            data = io.StringIO()
+            df.to_csv(data, header = False, index = False)
+            data.seek(0)
+            columns = ', '.join('"%s"' % col for col in df.columns)
+            with self.out.cursor() as cur :
+                cur.copy_expert("COPY %s (%s) FROM STDIN WITH (FORMAT csv)" % \
+                                (self.options["table"], columns), data)
+            self.out.commit()
+
+    def close(self) :
+        if self.out is not None :
+            self.out.close()
+            self.out = None
+
 
 class marker_sink :
     """
     Summary:
-        Object responsible for saving to csv file marker information.
+        Object responsible for saving marker information to a csv or parquet
+        file, or to a postgres table. The markers are buffered by column and
+        written in batches.
     """
     def __init__(self, sink_options : dict) :
         """
         Summary :
             Object constructur.
-        
+
         Arguments:
             options - dictionary with the options to initialize the object
-        
+                      (output_file, include_header, format, buffer_size and
+                      the connection and table of the postgres output)
+
         Returns:
             Nothing.
         """
-                    
-        # Check if the output file has been specified
-        if "output_file" in sink_options :
-            filename = sink_options["output_file"]
-        else :
-            filename = "./marker_output.csv"
-        
-        # Open the output file
-        self.out_file = open(filename, 'w')
-        
-        # Now check if the header should be printed
-        include_header = False
-        if "include_header" in sink_options :
-            include_header = sink_options["include_header"]
-        
-        if include_header :
-            self.out_file.write("FID,signal,type,start_data,main_date," \
-                                "stop_date,duration,value 1,value 2, value 3\n")
-    
+        self.writer = table_writer(sink_options, "./marker_output.csv")
+        self.buffer_size = sink_options.get("buffer_size", BUFFER_SIZE)
+        self.buffer = self.new_buffer()
+
         return
-    
-    def dump_marker_info(self, fid, markers) :
+
+    def new_buffer(self) -> column_buffer :
         """
         Summary :
-            Dump marker information to file.
-        
+            Get an empty marker buffer (e.g. to fill in a worker process and
+            merge with write_buffer).
+        """
+        return column_buffer(MARKER_COLUMNS)
+
+    @staticmethod
+    def add(buffer : column_buffer, fid, markers) :
+        """
+        Summary :
+            Add the markers of a parcel to a buffer.
+
         Arguments:
+            buffer - a marker buffer (see new_buffer)
             fid - FOI identifier
-        
-        Returns:
-            Nothing.
+            markers - list of markers or dictionary {signal : list of markers}
         """
         if isinstance(markers, list) :
-            for marker in markers :
-                self.out_file.write(str(fid) + ',-,' + \
-                                    marker.__str__() + '\n')
-        else :
-            # loop on the signals
-            for signal in markers :
-                for marker in markers[signal] :
-                    self.out_file.write(str(fid) + ',' + str(signal) + ',' + \
-                                        marker.__str__() + '\n')
-        
-        return
-    
-    def __del__(self) :
+            markers = {'-' : markers}
+
+        # loop on the signals
+        for signal in markers :
+            for marker in markers[signal] :
+                main_date = marker.main_date if marker.main_date != [] else None
+                buffer.append((str(fid), str(signal), marker.type, \
+                               marker.start_date, main_date, marker.stop_date, \
+                               marker.get_duration_in_days(), \
+                               float(marker.values[0]), float(marker.values[1]), \
+                               float(marker.values[2]), \
+                               marker.properties.__str__() if len(marker.properties) > 0 else ''))
+
+    def dump_marker_info(self, fid, markers) :
         """
         Summary :
-            Object destructur.
-        
+            Dump marker information to the output.
+
         Arguments:
-            None.
-            
+            fid - FOI identifier
+
         Returns:
             Nothing.
-        """        
-        
-        # Do not forget to close the output file
-        self.out_file.close()
+        """
+        self.add(self.buffer, fid, markers)
+        if len(self.buffer) >= self.buffer_size :
+            self.flush()
+
+        return
+
+    def write_buffer(self, buffer : column_buffer) :
+        """
+        Summary :
+            Merge the markers of another buffer (e.g. filled by a worker process).
+        """
+        self.buffer.extend(buffer)
+        if len(self.buffer) >= self.buffer_size :
+            self.flush()
+
+    def flush(self) :
+        """
+        Summary :
+            Write the buffered markers to the output.
+        """
+        df = self.buffer.to_frame()
+        for col in ["start_date", "main_date", "stop_date"] :
+            df[col] = pd.to_datetime(df[col])
+        self.writer.write(df)
+        self.buffer.clear()
+
+    def close(self) :
+        """
+        Summary :
+            Write the buffered markers and close the output.
+        """
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *args) :
+        self.close()
@@ -9,6 +9,8 @@
 
 import geopandas as gpd
 import numpy as np
+import pandas as pd
+import shapely
 from shapely import geometry
 
 import matplotlib.pyplot as plt
@@ -16,6 +18,16 @@ import math
 
 import warnings
 
+# Maximum number of pixels tested at once when counting the full S2 pixels
+MAX_PIXELS = 1000000
+
+# Geometric properties of a missing parcel
+MISSING_PROPERTIES = {'Area' : np.nan,
+                      'Perimeter' : np.nan,
+                      'Shape index' : np.nan,
+                      'Side ratio': np.nan,
+                      'S2 pixels' : np.nan }
+
 
 def min_area_rect( polygon, changeCrs = True ) :
     """
@@ -246,6 +258,136 @@ def pixels_to_polygons( bounds, pixel_size = 10 ) :
             
     return pixel_list
 
+def side_ratios( polygons : np.ndarray ) -> np.ndarray :
+    """
+    Summary:
+        Compute the ratio between the smallest and largest sides of the
+        minimum area oriented rectangles of an array of polygons.
+        
+    Arguments:
+        polygons - array of shapely polygons in a rectangular crs
+        
+    Returns:
+        Array of side ratios (nan for missing geometries).
+    """
+    rings = shapely.get_exterior_ring( shapely.oriented_envelope( polygons ) )
+    coords, index = shapely.get_coordinates( rings, return_index = True )
+    
+    # Sides are consecutive vertices of the same ring
+    same = index[1:] == index[:-1]
+    sidelen = np.hypot( *(coords[1:] - coords[:-1])[same].T )
+    index = index[1:][same]
+    
+    shortest = np.full( len(polygons), np.inf )
+    longest = np.zeros( len(polygons) )
+    np.minimum.at( shortest, index, sidelen )
+    np.maximum.at( longest, index, sidelen )
+    
+    with np.errstate( divide = 'ignore', invalid = 'ignore' ) :
+        ratio = np.where( longest > 0, shortest / longest, np.nan )
+    
+    return ratio
+
+def full_pixels_count( polygons : np.ndarray, pixel_size = 10 ) -> np.ndarray :
+    """
+    Summary:
+        Count the pixels of a grid aligned with the crs origin that are fully
+        contained in each polygon. The pixels in the bounds of the polygons
+        are tested at once (in batches of MAX_PIXELS).
+        
+    Arguments:
+        polygons - array of shapely polygons in the crs of the grid (UTM)
+        pixel_size - the pixel size
+        
+    Returns:
+        Array with the number of full pixels.
+    """
+    bounds = shapely.bounds( polygons )
+    x0 = np.ceil( bounds[:, 0] / pixel_size ) * pixel_size
+    y0 = np.ceil( bounds[:, 1] / pixel_size ) * pixel_size
+    nx = np.floor( bounds[:, 2] / pixel_size ) - x0 / pixel_size
+    ny = np.floor( bounds[:, 3] / pixel_size ) - y0 / pixel_size
+    nx = np.nan_to_num( np.maximum( nx, 0 ) ).astype(int)
+    ny = np.nan_to_num( np.maximum( ny, 0 ) ).astype(int)
+    npix = nx * ny
+    
+    shapely.prepare( polygons )
+    count = np.zeros( len(polygons), dtype = int )
+    cumulative = np.cumsum( npix )
+    
+    start = 0
+    while start < len(polygons) :
+        # Polygons whose pixels fit in the batch (at least one polygon)
+        offset = cumulative[start] - npix[start]
+        stop = max( np.searchsorted( cumulative, offset + MAX_PIXELS, side = 'right' ),
+                    start + 1 )
+        
+        owner = np.repeat( np.arange( start, stop ), npix[start:stop] )
+        pixel = np.arange( len(owner) ) - np.repeat( cumulative[start:stop] - \
+                                                     npix[start:stop] - offset, \
+                                                     npix[start:stop] )
+        minx = x0[owner] + ( pixel // ny[owner] ) * pixel_size
+        miny = y0[owner] + ( pixel % ny[owner] ) * pixel_size
+        pixels = shapely.box( minx, miny, minx + pixel_size, miny + pixel_size )
+        
+        inside = shapely.contains( polygons[owner], pixels )
+        count[start:stop] = np.bincount( owner - start, weights = inside, \
+                                         minlength = stop - start )
+        start = stop
+    
+    return count
+
+def get_geometric_properties_table( parcels : gpd.GeoDataFrame, fid_col = None, \
+                                    Is20mRes = False ) -> pd.DataFrame :
+    """
+    Summary :
+        Evaluate the geometric properties of all the parcels of a 
+        GeoDataFrame at once. The parcels are reprojected once to EPSG:3035 
+        (area, perimeter, shape index and side ratio) and once per UTM zone
+        (number of full Sentinel-2 pixels).
+
+    Arguments :
+        parcels - the parcels as a GeoDataFrame
+        fid_col - column with the parcel identifiers (the index if None)
+        Is20mRes - tell the resolution of a single S2 pixel. 10x10 m is 
+                   assumed by default
+        
+    Returns:
+        A DataFrame with the geometric properties, indexed by parcel.
+    """
+    if fid_col is None :
+        index = parcels.index
+    else :
+        index = pd.Index( parcels[fid_col].values )
+    
+    pixel_size = 20 if Is20mRes else 10
+    
+    rec_polygons = parcels.geometry.to_crs("EPSG:3035").to_numpy()
+    area = shapely.area( rec_polygons )
+    perimeter = shapely.length( rec_polygons )
+    with np.errstate( divide = 'ignore', invalid = 'ignore' ) :
+        si = perimeter / np.sqrt( np.pi * area )
+    
+    # The pixels of S2 images are aligned with the local UTM crs, the zone
+    # is given by the longitude of the parcel centroid
+    geo_polygons = parcels.geometry
+    if not geo_polygons.crs.is_geographic :
+        geo_polygons = geo_polygons.to_crs("EPSG:4326")
+    lon = shapely.get_x( shapely.centroid( geo_polygons.to_numpy() ) )
+    utm_zone = np.floor( ( lon + 180 ) / 6 ) + 1
+    
+    npixels = np.full( len(parcels), np.nan )
+    for zone in np.unique( utm_zone[~np.isnan(utm_zone)] ) :
+        in_zone = utm_zone == zone
+        utm_polygons = parcels.geometry[in_zone].to_crs("EPSG:326%02d" % zone).to_numpy()
+        npixels[in_zone] = full_pixels_count( utm_polygons, pixel_size )
+    
+    return pd.DataFrame({'Area' : area,
+                         'Perimeter' : perimeter,
+                         'Shape index' : si,
+                         'Side ratio': side_ratios( rec_polygons ),
+                         'S2 pixels' : npixels }, index = index)
+
 def get_geometric_properties( polygon ) -> dict :
     """
     Summary :
@@ -260,32 +402,81 @@ def get_geometric_properties( polygon ) -> dict :
     """
     
     # Perform a preliminary check on the polygon
-    if polygon is None :
-        
-        out_dict = {'Area' : np.nan,
-                    'Perimeter' : np.nan,
-                    'Shape index' : np.nan,
-                    'Side ratio': np.nan,
-                    'S2 pixels' : np.nan }
-        
-        return out_dict
-    
-    area = get_area( polygon )
-    perimeter = get_perimeter( polygon )
-    si = get_shape_index( polygon )
+    if polygon is None or len(polygon) == 0 :
+        return dict(MISSING_PROPERTIES)
     
-    # determine the minimum area oriented rectangle and determine the side ratio
-    mar_poly = min_area_rect( polygon )
-    side_ratio = extreme_side_ratio(mar_poly, False)
+    table = get_geometric_properties_table( polygon.iloc[:1] )
     
-    # and finally the number of sull Sentinel-2 pixels
-    # NEED TO BE UPDATED - Check with Csaba 
-    npixels = number_of_full_s2_pixels( polygon, False )
-    
-    out_dict = {'Area' : area,
-                'Perimeter' : perimeter,
-                'Shape index' : si,
-                'Side ratio': side_ratio,
-                'S2 pixels' : npixels }
-    
-    return out_dict
+    return table.iloc[0].to_dict()
+
+class geometric_properties_cache :
+    """
+    Summary :
+        Geometric properties of the parcels of a parcel data source, computed
+        in batches (get_geometric_properties_table) and cached by fid.
+    """
+    def __init__(self, parcel_ds) :
+        """
+        Summary :
+            Object constructor.
+
+        Arguments :
+            parcel_ds - the parcel data source. The sources with a parcel
+                        table (df and fid_col) are processed in batches, the
+                        other ones parcel by parcel.
+        Returns :
+            Nothing.
+        """
+        self.parcel_ds = parcel_ds
+        self.properties = {}
+        self.loaded = False
+
+    def has_table(self) -> bool :
+        return hasattr(self.parcel_ds, 'df') and hasattr(self.parcel_ds, 'fid_col')
+
+    def load(self, fids = None) :
+        """
+        Summary :
+            Compute the properties of a list of parcels (all the parcels of
+            the data source if None).
+        """
+        if not self.has_table() :
+            return
+
+        df = self.parcel_ds.df
+        fid_col = self.parcel_ds.fid_col
+        if fids is None :
+            self.loaded = True
+        else :
+            df = df[df[fid_col].isin(fids)]
+
+        table = get_geometric_properties_table(df, fid_col)
+        table = table[~table.index.duplicated()]
+        self.properties.update(table.to_dict('index'))
+
+        # parcels without geometry
+        for fid in (fids if fids is not None else []) :
+            if fid not in self.properties :
+                self.properties[fid] = dict(MISSING_PROPERTIES)
+
+    def get(self, fid, parcel_geometry = None) -> dict :
+        """
+        Summary :
+            Return the geometric properties of a parcel.
+
+        Arguments :
+            fid - the parcel identifier
+            parcel_geometry - the parcel geometry, used by the data sources
+                              without a parcel table
+
+        Returns :
+            A dictionary with the geometric properties of the parcel.
+        """
+        if fid not in self.properties :
+            if self.has_table() and not self.loaded :
+                self.load()
+
+            if fid not in self.properties :
+                self.properties[fid] = get_geometric_properties(parcel_geometry)
+
+        return self.properties[fid]
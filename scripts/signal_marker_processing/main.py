@@ -35,152 +35,320 @@ import json
 
 # The following code block has been added to support input from command line/notebook
 import sys
+import multiprocessing
 
+# Number of parcels sent at once to a worker process (parallel mode)
+PARCELS_PER_TASK = 50
 
-# Load additional inputs from coomand line
-# Code from 
-# https://stackoverflow.com/questions/39390418/python-how-can-i-enable-use-of-kwargs-when-calling-from-command-line-perhaps
-if len(sys.argv) > 1 :
-    # There is at least one argument after the file name
-    kwargs = { kw[0]:kw[1] for kw in [ar.split('=') for ar in sys.argv if ar.find('=')>0]}
-    args = [arg for arg in sys.argv if arg.find('=')<0]
-else :
-    kwargs = {}
-    args = []
-
-if ("notebook" in kwargs) and (kwargs["notebook"]=="True"):
-    from tqdm.notebook import tqdm
-    
-    ##################### Option File #############################################
-    optionFilePath = "./config/main.json"
-else:
-    from tqdm import tqdm    
-
-    ##################### Option File #############################################
-    optionFilePath = "./notebook/config/main.json"
-
-
-optionFile = open(optionFilePath)
-options = json.load(optionFile)
-optionFile.close()
-
-##################### Get the parcel files ####################################
-# Create the parcel data factory and the parcel data
-parcel_df = pds.parcel_data_factory()
-parcel_ds = parcel_df.get_parcel_data_source(options)
-print("Parcel data loaded \n")
-fid_list = parcel_ds.get_fid_list()
-
-# Get the length of the parcels to process
-if "parcel_num" in kwargs :
-    parcel_num = int(kwargs["parcel_num"])
-else :
-    parcel_num = len(fid_list)
-
-##################### Get the signal files ####################################
-# Create the signal factory and retrieve the signal files
-ts_source_factory = tss.time_serie_source_factory()
-ts_sources = ts_source_factory.get_time_series_sources(options)
-print("Time series loaded")
-
-##################### Build the pre-processing stage ##########################
-pp_factory = pps.processor_factory()
-pre_processors = pp_factory.get_pre_processors(options)
-
-##################### Build the marker detectors ##############################
-md_factory = mp.marker_detector_factory()
-marker_detectors = md_factory.get_marker_detectors(options)
-
-##################### Build the marker aggregator #############################
-marker_agg = ma.marker_aggregator(options)
-
-##################### Build the marker data sink ##############################
-if "marker-sink" in options :
-    ms_option_list = options["marker-sink"]
-    
-    mk_sink = ds.marker_sink(ms_option_list[0])
-    
-    if len(ms_option_list) > 1 :
-        agmk_sink = ds.marker_sink(ms_option_list[1])
-    else:
-        agmk_sink = None
-else :
-    mk_sink = None
-    agmk_sink = None
-
-##################### Build the data displayer ################################
-data_disp_factory = dd.data_displayer_factory()
-data_disps = data_disp_factory.get_data_displayers(options)
-    
-############################ Scenario evidence writer #########################
-if 	"scenario-evidence" in options :
-    scenario_ev = se.scenario_evidence(options["scenario-evidence"])
-else :
-    scenario_ev = None
-    
-###############################################################################
-
-# Main processing loop
-for fid in tqdm(fid_list[:parcel_num]) :
-    
+# Chunks of the streamed time series in each range of parcels sent to a
+# worker process (parallel mode, each range is a separate db query)
+CHUNKS_PER_TASK = 10
+
+
+def build_pipeline(options : dict, ts_sources : bool = True) -> dict :
+    """
+    Summary :
+        Build the processing stages defined in the option file (parcel data,
+        time series sources, pre-processors, marker detectors, marker
+        aggregator and data displayers).
+
+    Arguments :
+        ts_sources - if False, the time series sources are not built (they
+                     are built by the worker processes, see process_range)
+
+    Returns :
+        A dictionary with the processing stages.
+    """
+    pipeline = {}
+
+    # Create the parcel data factory and the parcel data
+    pipeline["parcel_ds"] = pds.parcel_data_factory().get_parcel_data_source(options)
+
+    # Geometric properties of the parcels, computed in batches
+    pipeline["geom_props"] = gu.geometric_properties_cache(pipeline["parcel_ds"])
+
+    # Create the signal factory and retrieve the signal files
+    if ts_sources :
+        pipeline["ts_sources"] = tss.time_serie_source_factory().get_time_series_sources(options)
+    else :
+        pipeline["ts_sources"] = []
+
+    # Build the pre-processing stage
+    pipeline["pre_processors"] = pps.processor_factory().get_pre_processors(options)
+
+    # Build the marker detectors
+    pipeline["marker_detectors"] = mp.marker_detector_factory().get_marker_detectors(options)
+
+    # Build the marker aggregator
+    pipeline["marker_agg"] = ma.marker_aggregator(options)
+
+    # Build the data displayer
+    pipeline["data_disps"] = dd.data_displayer_factory().get_data_displayers(options)
+
+    return pipeline
+
+
+def process_parcel(pipeline : dict, fid) :
+    """
+    Summary :
+        Process a single parcel: time series retrieval, pre-processing, marker
+        detection and aggregation. The summary graphs are saved to file.
+
+    Returns :
+        The markers, the aggregated markers and the geometric properties of
+        the parcel.
+    """
     # get the parcel geometry
-    parcel_geometry = parcel_ds.get_parcel( fid )
-    
+    parcel_geometry = pipeline["parcel_ds"].get_parcel( fid )
+
     # get the data related to the specific parcel
     parcel_data = {}
-    
-    for ts_source in ts_sources :
+
+    for ts_source in pipeline["ts_sources"] :
         data = ts_source.get_ts(fid)
         if len(data) > 0 :
             parcel_data[ts_source.get_signal_type()] = data
-    
+
     # parcel_data is a dictionary with different pandas dataframes. Each
     # dataframe is indexed by a signal/TS key
 
     # Get the properties
-    geom_prop = gu.get_geometric_properties( parcel_geometry )
-    
+    geom_prop = pipeline["geom_props"].get( fid, parcel_geometry )
+
     # eventually skip the parcel
     # ADD HERE LOGIC TO EVENTUALLY SKIP THE PARCEL
     # A similar approach can be adopted to check signal properties
-    
+
     # Pre-process the data
     markers = {}
     if len(parcel_data) > 0 :
-        for pre_pro in pre_processors :
+        for pre_pro in pipeline["pre_processors"] :
             parcel_data = {**parcel_data, **(pre_pro.process(parcel_data))}
-            
+
         # # Extract the markers
 
-        for marker_det in marker_detectors :
+        for marker_det in pipeline["marker_detectors"] :
             markers = {**markers, **(marker_det.get_markers(parcel_data))}
 
-    if mk_sink is not None :
-        # Output the marker information
-        mk_sink.dump_marker_info(fid, markers)    
-
     # Create the summary graphs and save it to file
-    for data_disp in data_disps :
-        data_disp.dump_to_file(parcel_data, markers, fid)    
+    for data_disp in pipeline["data_disps"] :
+        data_disp.dump_to_file(parcel_data, markers, fid)
 
     # Aggregate the markers
-    aggregated_markers = marker_agg.aggregate_markers(markers)
+    aggregated_markers = pipeline["marker_agg"].aggregate_markers(markers)
     # print([x.type for x in aggregated_markers])
-    
+
+    return markers, aggregated_markers, geom_prop
+
+
+# Options, processing stages and scenario evidence of the worker processes
+# (parallel mode). They are set in the main process before the workers are
+# forked, the workers share them copy-on-write.
+worker_options = None
+worker_pipeline = None
+worker_evidence = None
+
+
+def process_parcels(fids : list) -> tuple :
+    """
+    Summary :
+        Process a shard of parcels in a worker process.
+
+    Returns :
+        The number of processed parcels and the buffers of the markers, of
+        the aggregated markers and of the scenario evidence, to be merged in
+        the sinks of the main process.
+    """
+    mk_buffer = ds.column_buffer(ds.MARKER_COLUMNS)
+    agmk_buffer = ds.column_buffer(ds.MARKER_COLUMNS)
+    ev_buffer = worker_evidence.new_buffer() if worker_evidence is not None else None
+
+    # Geometric properties of the whole shard
+    worker_pipeline["geom_props"].load(fids)
+
+    for fid in fids :
+        markers, aggregated_markers, geom_prop = process_parcel(worker_pipeline, fid)
+        ds.marker_sink.add(mk_buffer, fid, markers)
+        ds.marker_sink.add(agmk_buffer, fid, aggregated_markers)
+        if ev_buffer is not None :
+            worker_evidence.add(ev_buffer, fid, aggregated_markers, geom_prop)
+
+    return len(fids), mk_buffer, agmk_buffer, ev_buffer
+
+
+def range_options(options : dict, first, last) -> dict :
+    """
+    Summary :
+        Restrict the streamed time series sources to a range of parcel ids.
+    """
+    options = dict(options)
+    options['dataReaders'] = [{**option, 'fid_range' : [str(first), str(last)]} \
+                              if int(option.get('chunk_size', 0)) > 0 else option \
+                              for option in options.get('dataReaders', [])]
+    return options
+
+
+def process_range(fids : list) -> tuple :
+    """
+    Summary :
+        Process a contiguous range of parcels (sorted with sort_fids) in a
+        worker process. The time series sources are built for the range, so
+        that the streamed queries only return the rows of its parcels.
+
+    Returns :
+        See process_parcels.
+    """
+    worker_pipeline["ts_sources"] = tss.time_serie_source_factory().get_time_series_sources( \
+        range_options(worker_options, fids[0], fids[-1]))
+    try :
+        return process_parcels(fids)
+    finally :
+        worker_pipeline["ts_sources"] = []
+
+
+def streamed_sources(options : dict) -> int :
+    """
+    Summary :
+        Check if the time series of a db source are streamed (chunk_size).
+
+    Returns :
+        The largest chunk size of the streamed sources, 0 if none.
+    """
+    return max([int(option.get('chunk_size', 0)) \
+                for option in options.get('dataReaders', [])] + [0])
+
+
+if __name__ == "__main__" :
+
+    # Load additional inputs from coomand line
+    # Code from
+    # https://stackoverflow.com/questions/39390418/python-how-can-i-enable-use-of-kwargs-when-calling-from-command-line-perhaps
+    if len(sys.argv) > 1 :
+        # There is at least one argument after the file name
+        kwargs = { kw[0]:kw[1] for kw in [ar.split('=') for ar in sys.argv if ar.find('=')>0]}
+        args = [arg for arg in sys.argv if arg.find('=')<0]
+    else :
+        kwargs = {}
+        args = []
+
+    if ("notebook" in kwargs) and (kwargs["notebook"]=="True"):
+        from tqdm.notebook import tqdm
+
+        ##################### Option File #############################################
+        optionFilePath = "./config/main.json"
+    else:
+        from tqdm import tqdm
+
+        ##################### Option File #############################################
+        optionFilePath = "./notebook/config/main.json"
+
+
+    optionFile = open(optionFilePath)
+    options = json.load(optionFile)
+    optionFile.close()
+
+    # Number of worker processes (workers=N in the command line or "workers"
+    # in the option file), the parcels are processed in parallel if > 1
+    workers = int(kwargs.get("workers", options.get("workers", 1)))
+
+    # Streamed time series (chunk_size option) are read in the order of the
+    # parcel ids, in parallel mode each worker streams its range of parcels
+    streamed = streamed_sources(options)
+
+    ##################### Get the processing stages ###############################
+    pipeline = build_pipeline(options, not (streamed and workers > 1))
+    parcel_ds = pipeline["parcel_ds"]
+    print("Parcel data loaded \n")
+    fid_list = parcel_ds.get_fid_list()
+
+    # Get the length of the parcels to process
+    if "parcel_num" in kwargs :
+        parcel_num = int(kwargs["parcel_num"])
+    else :
+        parcel_num = len(fid_list)
+
+    if streamed :
+        fid_list = tss.sort_fids(fid_list)
+
+    ##################### Build the marker data sink ##############################
+    if "marker-sink" in options :
+        ms_option_list = options["marker-sink"]
+
+        mk_sink = ds.marker_sink(ms_option_list[0])
+
+        if len(ms_option_list) > 1 :
+            agmk_sink = ds.marker_sink(ms_option_list[1])
+        else:
+            agmk_sink = None
+    else :
+        mk_sink = None
+        agmk_sink = None
+
+    ############################ Scenario evidence writer #########################
+    if 	"scenario-evidence" in options :
+        scenario_ev = se.scenario_evidence(options["scenario-evidence"])
+    else :
+        scenario_ev = None
+
+    ###############################################################################
+
+    def write_results(fid, markers, aggregated_markers, geom_prop) :
+        if mk_sink is not None :
+            # Output the marker information
+            mk_sink.dump_marker_info(fid, markers)
+
+        if agmk_sink is not None :
+            agmk_sink.dump_marker_info(fid, aggregated_markers)
+
+        # Write information at the parcel level
+        if scenario_ev is not None :
+            scenario_ev.dump(fid, aggregated_markers, geom_prop)
+
+    fids = fid_list[:parcel_num]
+
+    # Main processing loop
+    if workers > 1 :
+        # The processing stages are built once and shared copy-on-write by the
+        # forked worker processes
+        worker_options = options
+        worker_pipeline = pipeline
+        worker_evidence = scenario_ev
+
+        # Shards of parcels are processed by the worker processes, the buffers
+        # of the results are merged in the order of the parcel list. With
+        # streamed time series, the shards are contiguous ranges of parcels
+        # of a few chunks, so that the results reach the sinks as they are
+        # ready and the ranges are balanced between the workers.
+        if streamed :
+            size = max(PARCELS_PER_TASK, min(streamed * CHUNKS_PER_TASK, \
+                                             -(-len(fids) // workers)))
+            task = process_range
+        else :
+            size = PARCELS_PER_TASK
+            task = process_parcels
+        shards = [fids[i:i + size] for i in range(0, len(fids), size)]
+        with multiprocessing.get_context("fork").Pool(workers) as pool :
+            with tqdm(total = len(fids)) as progress :
+                for count, mk_buffer, agmk_buffer, ev_buffer in pool.imap(task, shards) :
+                    if mk_sink is not None :
+                        mk_sink.write_buffer(mk_buffer)
+
+                    if agmk_sink is not None :
+                        agmk_sink.write_buffer(agmk_buffer)
+
+                    if scenario_ev is not None :
+                        scenario_ev.write_buffer(ev_buffer)
+                    progress.update(count)
+    else :
+        for fid in tqdm(fids) :
+            write_results(fid, *process_parcel(pipeline, fid))
+
+    # Write the buffered results and close the outputs
+    if mk_sink is not None :
+        mk_sink.close()
+
     if agmk_sink is not None :
-        agmk_sink.dump_marker_info(fid, aggregated_markers)
+        agmk_sink.close()
 
-    # Write information at the parcel level
     if scenario_ev is not None :
-        scenario_ev.dump(fid, aggregated_markers, geom_prop)
-
-if mk_sink is not None :    
-    mk_sink.out_file.close()
-
-if agmk_sink is not None :
-    agmk_sink.out_file.close()
-    
-optionFile.close()        
-    
-if scenario_ev is not None :
-    scenario_ev.out_file.close()
+        scenario_ev.close()
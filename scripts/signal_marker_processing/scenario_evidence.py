@@ -8,11 +8,21 @@
 # License   : 3-Clause BSD
 
 
+import data_sink as ds
+
+# Parcel properties reported in the scenario evidence
+PROPERTY_COLUMNS = ["Area", "Perimeter", "Shape index", "Side ratio", "S2 pixels"]
+
+EVIDENCE_COLUMNS = ["FID"] + PROPERTY_COLUMNS + \
+                   ["Nb primary markers", "Nb data gaps", "Nb other markers"]
+
+
 class scenario_evidence :
     """
     Summary:
         Object responsible for creating the scenario evidence from the 
-        aggregated markers and the parcel properties.
+        aggregated markers and the parcel properties. The evidence is
+        buffered by column and written in batches (see data_sink.table_writer).
     """
     
     def __init__(self, options : dict) :
@@ -22,29 +32,15 @@ class scenario_evidence :
             
         Arguments:
             options - dictionary defining the properties of the scenario
-                      evidence
+                      evidence (primary-marker, gap-marker and the output
+                      options of data_sink.table_writer)
         Returns:
             Nothing.
         """
 
-        # Check if the output file has been specified
-        if "output_file" in options :
-            filename = options["output_file"]
-        else :
-            filename = "./scenario_evidence_output.csv"
-        
-        # Open the output file
-        self.out_file = open(filename, 'w')
-        
-        # Now check if the header should be printed
-        include_header = False
-        if "include_header" in options :
-            include_header = options["include_header"]
-        
-        if include_header :
-            self.out_file.write("FID,Area,Perimeter,S2_pixels,Shape index," \
-                                "Side ratio,Nb primary markers,Nb data gaps,"\
-                                "Nb other markers\n")
+        self.writer = ds.table_writer(options, "./scenario_evidence_output.csv")
+        self.buffer_size = options.get("buffer_size", ds.BUFFER_SIZE)
+        self.buffer = self.new_buffer()
         
         self.primary_marker = options["primary-marker"]
         
@@ -54,12 +50,21 @@ class scenario_evidence :
             self.data_gap = None
         return
 
-    def dump(self, fid, aggregated_markers, properties) :
+    def new_buffer(self) -> ds.column_buffer :
+        """
+        Summary :
+            Get an empty evidence buffer (e.g. to fill in a worker process and
+            merge with write_buffer).
+        """
+        return ds.column_buffer(EVIDENCE_COLUMNS)
+
+    def add(self, buffer : ds.column_buffer, fid, aggregated_markers, properties) :
         """
         Summary:
-            Function dumping the scenario evidence to file.
+            Add the scenario evidence of a parcel to a buffer.
             
         Arguments:
+            buffer - an evidence buffer (see new_buffer)
             fid - the parcel ID
             aggregated_markers - list of aggregated markers
             properties - parcel properties.
@@ -70,45 +75,68 @@ class scenario_evidence :
         marker_types = [x.type for x in aggregated_markers]
         
         # count the number of primary markers
-        primary_nb = len([p for p in marker_types if p == self.primary_marker])
+        primary_nb = marker_types.count(self.primary_marker)
         
         # count the number of data gaps
         if self.data_gap is not None :
-            gap_nb = len([p for p in marker_types if p == self.data_gap])
+            gap_nb = marker_types.count(self.data_gap)
         else :
             gap_nb = 0
             
         # number of other markers
         other_nb = len(aggregated_markers) - primary_nb - gap_nb
         
-        # Now print the results
-        out_str = str(fid) + ", "
-        
-        for key in properties :
-            out_str = out_str + str(properties[key]) + ','
-            
-        out_str = out_str + str(primary_nb) + ','
-        out_str = out_str + str(gap_nb) + ','
-        out_str = out_str + str(other_nb) + '\n'
-        
-        self.out_file.write(out_str)
+        buffer.append((str(fid), *[float(properties[key]) for key in PROPERTY_COLUMNS], \
+                       primary_nb, gap_nb, other_nb))
 
         return
 
-    def __del__(self) :
+    def dump(self, fid, aggregated_markers, properties) :
         """
-        Summary :
-            Object destructur.
-        
+        Summary:
+            Function dumping the scenario evidence to file.
+            
         Arguments:
-            None.
+            fid - the parcel ID
+            aggregated_markers - list of aggregated markers
+            properties - parcel properties.
             
         Returns:
             Nothing.
-        """        
-        
-        # Do not forget to close the output file
-        self.out_file.close()            
-        
-        
-    
+        """
+        self.add(self.buffer, fid, aggregated_markers, properties)
+        if len(self.buffer) >= self.buffer_size :
+            self.flush()
+
+        return
+
+    def write_buffer(self, buffer : ds.column_buffer) :
+        """
+        Summary :
+            Merge the evidence of another buffer (e.g. filled by a worker process).
+        """
+        self.buffer.extend(buffer)
+        if len(self.buffer) >= self.buffer_size :
+            self.flush()
+
+    def flush(self) :
+        """
+        Summary :
+            Write the buffered evidence to the output.
+        """
+        self.writer.write(self.buffer.to_frame())
+        self.buffer.clear()
+
+    def close(self) :
+        """
+        Summary :
+            Write the buffered evidence and close the output.
+        """
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *args) :
+        self.close()
@@ -14,6 +14,9 @@ import numpy as np
 import os
 import gc
 import json
+import queue
+import threading
+import psycopg2
 
 import get_time_series as gts
 
@@ -679,6 +682,192 @@ class dir_csv_time_serie_source(base_time_series_source) :
         return data
 
 
+def index_by_parcel(ts_db : pd.DataFrame) :
+    """
+    Summary :
+        Sort the time series retrieved from the db by parcel id (the order of
+        the rows of each parcel is kept) and get the rows of each parcel.
+
+    Arguments:
+        ts_db - data frame with a parcel_id column
+
+    Returns:
+        The sorted data frame and a dictionary {parcel id : (first row, last row + 1)}
+    """
+    ts_db = ts_db.iloc[np.argsort(ts_db["parcel_id"].to_numpy(), kind = "stable")]
+    ids = ts_db["parcel_id"].to_numpy()
+    if len(ids) == 0 :
+        return ts_db, {}
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    stops = np.r_[starts[1:], len(ids)]
+    return ts_db, dict(zip(ids[starts], zip(starts, stops)))
+
+
+def cloud_percentage(hists : pd.Series, cloud_cat : list) -> pd.Series :
+    """
+    Summary :
+        Cloud percentage of all the rows (see gts.get_cloudyness), from the
+        hist json text of the scene classes counts.
+
+    Returns:
+        A pandas series with the cloud percentage (NaN if there are no pixels)
+    """
+    counts = pd.DataFrame.from_records([json.loads(h) for h in hists],
+                                       index = hists.index).fillna(0)
+    cloudy = [c for c in counts.columns if int(c) in cloud_cat]
+    total = counts.sum(axis = 1)
+    pct = counts[cloudy].sum(axis = 1) / total.where(total > 0) * 100
+    return pct.round(4)
+
+
+def parcel_ts(ts_db : pd.DataFrame, ts_index : dict, fid, \
+              start_date : datetime.datetime = None, end_date : datetime.datetime = None) -> pd.DataFrame :
+    """
+    Summary :
+        Get the rows of a parcel from a table sorted with index_by_parcel,
+        with the obstime index and the time range constraints.
+    """
+    start, stop = ts_index.get(fid, (0, 0))
+
+    # Now reset the date index
+    ts_final = ts_db.iloc[start:stop].reset_index()
+
+    if start_date is not None :
+        ts_final = ts_final[ts_final['obstime'] >= start_date]
+
+    if end_date is not None :
+        ts_final = ts_final[ts_final['obstime'] <= end_date]
+
+    ts_final.set_index('obstime',inplace=True)
+
+    return ts_final
+
+
+class db_ts_stream :
+    """
+    Summary :
+        Streaming of the time series of a db query in chunks of parcels.
+        The rows are ordered by parcel id (as text) and read with a server
+        side (named) cursor, the next chunk is read in a background thread
+        while the current chunk is processed. The memory used is bounded by
+        the chunk size (a chunk is kept, one is prefetched).
+        The parcels must be requested in the same order, sorted as text
+        (see sort_fids). The stream can be restricted to a range of parcel
+        ids, e.g. the range of parcels of a worker process.
+    """
+    FETCH_ROWS = 10000  # Rows of each round trip to the server
+
+    def __init__(self, host : str, port : str, dbname : str, user : str, password : str, \
+                 sql_select : str, chunk_size : int, prepare = None, fid_range = None) :
+        """
+        Summary :
+            Object constructor, the query starts in a background thread.
+
+        Arguments:
+            sql_select - the query of the time series (with a parcel_id column)
+            chunk_size - number of parcels of each chunk
+            prepare - function applied to the data frame of each chunk
+            fid_range - (first, last) parcel ids of the stream, as text (all
+                        the parcels if None)
+        """
+        self.conn_opt = dict(host = host, port = port, dbname = dbname, \
+                             user = user, password = password)
+        where = ""
+        if fid_range is not None :
+            first, last = [psycopg2.extensions.QuotedString(str(x)).getquoted().decode() \
+                           for x in fid_range]
+            where = """ WHERE parcel_id::text COLLATE "C" BETWEEN %s AND %s""" % (first, last)
+        self.sql_select = "SELECT * FROM (" + sql_select.strip().rstrip(';') + \
+            ") ts" + where + """ ORDER BY parcel_id::text COLLATE "C", obstime;"""
+        self.chunk_size = chunk_size
+        self.prepare = prepare
+        self.queue = queue.Queue(maxsize = 1)
+        self.chunk = None
+        self.done = False
+        self.thread = threading.Thread(target = self.read_chunks, daemon = True)
+        self.thread.start()
+        self.next_chunk()
+
+    def to_frame(self, rows : list, columns : list) :
+        ts_db = pd.DataFrame(data = rows, columns = columns)
+        ts_db.set_index(['db_id', 'obstime'], inplace = True)
+        if self.prepare is not None :
+            ts_db = self.prepare(ts_db)
+        ts_db, ts_index = index_by_parcel(ts_db)
+        ts_index = {str(k) : v for k, v in ts_index.items()}
+        keys = sorted(ts_index)
+        return ts_db, ts_index, (keys[-1] if keys else None)
+
+    def read_chunks(self) :
+        """
+        Summary :
+            Read the query results and put the chunks of parcels in the queue
+            (run in the background thread).
+        """
+        conn = None
+        try :
+            conn = psycopg2.connect(**self.conn_opt)
+            with conn.cursor(name = 'ts_stream') as cur :
+                cur.itersize = self.FETCH_ROWS
+                cur.execute(self.sql_select)
+                rows = cur.fetchmany(self.FETCH_ROWS)
+                columns = [x[0] for x in cur.description]
+                pidx = columns.index('parcel_id')
+                pending, nparcels, last_key, chunks = [], 0, None, 0
+                while rows :
+                    for row in rows :
+                        key = str(row[pidx])
+                        if key != last_key :
+                            if nparcels == self.chunk_size :
+                                self.queue.put(self.to_frame(pending, columns))
+                                chunks += 1
+                                pending, nparcels = [], 0
+                            nparcels += 1
+                            last_key = key
+                        pending.append(row)
+                    rows = cur.fetchmany(self.FETCH_ROWS)
+                if pending or chunks == 0 :
+                    self.queue.put(self.to_frame(pending, columns))
+        except Exception as err :
+            self.queue.put(err)
+        finally :
+            if conn is not None :
+                conn.close()
+            self.queue.put(None)
+
+    def next_chunk(self) :
+        chunk = self.queue.get()
+        if isinstance(chunk, Exception) :
+            raise chunk
+        if chunk is None :
+            self.done = True
+        else :
+            self.chunk = chunk
+
+    def get_components(self) -> list :
+        return list(self.chunk[0].columns)
+
+    def get_ts(self, fid, start_date : datetime.datetime = None, end_date : datetime.datetime = None) -> pd.DataFrame :
+        """
+        Summary :
+            Return the time series of a parcel, the chunks of the parcels
+            before it are dropped.
+        """
+        key = str(fid)
+        while not self.done and self.chunk[2] is not None and key > self.chunk[2] :
+            self.next_chunk()
+        ts_db, ts_index, last_key = self.chunk
+        return parcel_ts(ts_db, ts_index, key, start_date, end_date)
+
+
+def sort_fids(fid_list : list) -> list :
+    """
+    Summary :
+        Sort the parcel ids in the order of the streamed time series (as text).
+    """
+    return sorted(fid_list, key = str)
+
+
 class db_s2_time_series_source(base_time_series_source) :
     """
     Summary :
@@ -701,7 +890,7 @@ class db_s2_time_series_source(base_time_series_source) :
                  parcels_table : str, sigs_table : str, hists_table : str, \
                  sentinel_metadata_table : str, start_time : datetime.datetime, \
                  end_time : datetime.datetime, sql_additional_conditions : str, cloud_free: str,\
-                 cloud_cat : list = [3,8,9,10,11]) :
+                 cloud_cat : list = [3,8,9,10,11], chunk_size : int = 0, fid_range = None) :
         """
         Summary :
             Object constructor.
@@ -732,6 +921,11 @@ class db_s2_time_series_source(base_time_series_source) :
             QUERY PARAMETERS
             sql_additional_conditions - string with SQL with the additional conditions that restrict the returned rows (this parameter can be empty)
             cloud_free - True or False, if true only images completely cloud free are returned (hist is included so it is possible to subselect later on)
+
+            STREAMING PARAMETERS
+            chunk_size - if greater than 0, the time series are streamed in chunks of chunk_size parcels (see db_ts_stream)
+                         instead of being loaded at once, the parcels must be processed in the order of sort_fids
+            fid_range - (first, last) parcel ids of the streamed time series, as text (all the parcels if None)
         Notes:
             The parameters related to table names could be reduced to 1 (and the code simplified/generalized a lot) if a view is created in the DB.
             Using views, db_s2_time_series_source db_c6_time_series_source and db_bs_time_series_source can be easily reduced to 1 (db_time_series_source)
@@ -751,12 +945,31 @@ class db_s2_time_series_source(base_time_series_source) :
 
         # Variable that stores the SQL to be executed on the DB and that is initialize when the object is created
         self.sql_select = self.sql_statement(db_schema, fid_col, parcels_table, sigs_table, hists_table , sentinel_metadata_table, sql_additional_conditions, cloud_free)
+        self.cloud_cat = cloud_cat
+
+        if chunk_size > 0 :
+            # The ts are streamed from the DB in chunks of parcels
+            self.ts_db = None
+            self.ts_stream = db_ts_stream(host, port, dbname, user, password, self.sql_select, \
+                                          chunk_size, self.add_cloud_pct, fid_range)
+            self.components = [c for c in self.ts_stream.get_components() if c != 'cloud_pct']
+            return
+
+        self.ts_stream = None
         # Variable that stores the complete ts retrieved from the DB and that is initialize when the object is created
         self.ts_db = self.get_ts_db(host, port, dbname, user, password, self.sql_select)
         # Variable that stores the list of components retrieved from the dataframe imported from the db
         self.components = list(self.ts_db.columns)
-        
-        self.cloud_cat = cloud_cat
+
+        # Cloud percentage of all the rows, computed once
+        self.ts_db = self.add_cloud_pct(self.ts_db)
+
+        # Rows of each parcel (ts_db is sorted by parcel id)
+        self.ts_db, self.ts_index = index_by_parcel(self.ts_db)
+
+    def add_cloud_pct(self, ts_db : pd.DataFrame) -> pd.DataFrame :
+        ts_db['cloud_pct'] = cloud_percentage(ts_db['hist'], self.cloud_cat)
+        return ts_db
 
     def sql_statement(self, db_schema : str, fid_col : str, parcels_table : str, sigs_table : str, hists_table : str, sentinel_metadata_table : str, sql_additional_conditions : str, cloud_free : str) -> str :
         """
@@ -867,27 +1080,11 @@ class db_s2_time_series_source(base_time_series_source) :
             A pandas data frame
         """
 
-        # First keep only the database values corresponding to the right FOI ID
-        ts_final = self.ts_db[self.ts_db["parcel_id"] == fid].copy()
-        
-        	# Now reset the date index
-        ts_final = ts_final.reset_index()
-        
-        if start_date is not None :
-            ts_final = ts_final[ts_final['obstime'] >= start_date]
-        
-        if end_date is not None :
-            ts_final = ts_final[ts_final['obstime'] <= end_date]
-        
-        ts_final.set_index('obstime',inplace=True)
-
-        # Add the cloud percentage
-        ts_final['cloud_pct'] = ts_final['hist'].apply(lambda s: gts.get_cloudyness(json.loads(s), self.cloud_cat)[1])
-            
-        # Force garbage collection
-        gc.collect()
+        if self.ts_stream is not None :
+            return self.ts_stream.get_ts(fid, start_date, end_date)
 
-        return ts_final
+        # Only the rows of the right FOI ID (the cloud percentage is already computed)
+        return parcel_ts(self.ts_db, self.ts_index, fid, start_date, end_date)
 
     def get_ts_full(self) -> pd.DataFrame :
         """
@@ -898,10 +1095,10 @@ class db_s2_time_series_source(base_time_series_source) :
             A pandas data frame
         """
         # It stores the dataframe initialized in the self.ts_db into a data frame called ts_final
-        ts_final = self.ts_db
+        if self.ts_stream is not None :
+            raise Exception("db_s2_time_series_source.get_ts_full() - not available when streaming (chunk_size)")
 
-        # Force garbage collection
-        gc.collect()
+        ts_final = self.ts_db
 
         return ts_final
 
@@ -913,7 +1110,8 @@ class db_c6_time_series_source(base_time_series_source) :
     def __init__(self, signal_type : str, host : str, port : str, dbname : str, user : str, \
                  password : str, db_schema : str, fid_col : str, parcels_table : str, \
                  sigs_table : str, sentinel_metadata_table : str, start_time : datetime.datetime, \
-                 end_time : datetime.datetime, sql_additional_conditions : str) :
+                 end_time : datetime.datetime, sql_additional_conditions : str, chunk_size : int = 0, \
+                 fid_range = None) :
         """
         Summary :
             See summary in db_s2_time_series_source
@@ -928,12 +1126,25 @@ class db_c6_time_series_source(base_time_series_source) :
 
         # Variable that stores the SQL to be executed on the DB and that is initialize when the object is created
         self.sql_select = self.sql_statement(db_schema, fid_col, parcels_table, sigs_table, sentinel_metadata_table, sql_additional_conditions)
+
+        if chunk_size > 0 :
+            # The ts are streamed from the DB in chunks of parcels
+            self.ts_db = None
+            self.ts_stream = db_ts_stream(host, port, dbname, user, password, self.sql_select, \
+                                          chunk_size, fid_range = fid_range)
+            self.components = self.ts_stream.get_components()
+            return
+
+        self.ts_stream = None
         # Variable that stores the complete ts retrieved from the DB and that is initialize when the object is created
         self.ts_db = self.get_ts_db(host, port, dbname, user, password, self.sql_select)
         # Variable that stores the list of components retrieved from the dataframe imported from the db
         self.components = list(self.ts_db.columns)
         #self.connection_opt = connection_opt
 
+        # Rows of each parcel (ts_db is sorted by parcel id)
+        self.ts_db, self.ts_index = index_by_parcel(self.ts_db)
+
     def sql_statement(self, db_schema : str, fid_col : str, parcels_table : str, sigs_table : str, sentinel_metadata_table : str, sql_additional_conditions : str) -> str :
 
         parcels = db_schema + "." + parcels_table
@@ -1013,24 +1224,11 @@ class db_c6_time_series_source(base_time_series_source) :
         # Here selection on dates makes little sense as i already selected it when i imported from the database
         # Maybe I should remove the condition on the query and keep it here?
 
-        # First keep only the database values corresponding to the right FOI ID
-        ts_final = self.ts_db[self.ts_db["parcel_id"] == fid].copy()
-        
-        	# Now reset the date index
-        ts_final = ts_final.reset_index()
-        
-        if start_date is not None :
-            ts_final = ts_final[ts_final['obstime'] >= start_date]
-        
-        if end_date is not None :
-            ts_final = ts_final[ts_final['obstime'] <= end_date]
-        
-        ts_final.set_index('obstime',inplace=True)
-        
-        # Force garbage collection
-        gc.collect()
+        if self.ts_stream is not None :
+            return self.ts_stream.get_ts(fid, start_date, end_date)
 
-        return ts_final
+        # Only the rows of the right FOI ID
+        return parcel_ts(self.ts_db, self.ts_index, fid, start_date, end_date)
 
     def get_ts_full(self) -> pd.DataFrame :
         """
@@ -1041,10 +1239,10 @@ class db_c6_time_series_source(base_time_series_source) :
             A pandas data frame
         """
 
-        ts_final = self.ts_db
+        if self.ts_stream is not None :
+            raise Exception("db_c6_time_series_source.get_ts_full() - not available when streaming (chunk_size)")
 
-        # Force garbage collection
-        gc.collect()
+        ts_final = self.ts_db
 
         return ts_final
 
@@ -1053,7 +1251,7 @@ class db_bs_time_series_source(base_time_series_source) :
     Summary :
          See summary in db_s2_time_series_source
     """
-    def __init__(self, signal_type : str, host : str, port : str, dbname : str, user : str, password : str, db_schema : str, fid_col : str, parcels_table : str, sigs_table : str, sentinel_metadata_table : str, start_time : datetime.datetime, end_time : datetime.datetime, sql_additional_conditions : str) :
+    def __init__(self, signal_type : str, host : str, port : str, dbname : str, user : str, password : str, db_schema : str, fid_col : str, parcels_table : str, sigs_table : str, sentinel_metadata_table : str, start_time : datetime.datetime, end_time : datetime.datetime, sql_additional_conditions : str, chunk_size : int = 0, fid_range = None) :
         """
         Summary :
             See summary in db_s2_time_series_source
@@ -1068,12 +1266,25 @@ class db_bs_time_series_source(base_time_series_source) :
 
         # Variable that stores the SQL to be executed on the DB and that is initialize when the object is created
         self.sql_select = self.sql_statement(db_schema, fid_col, parcels_table, sigs_table, sentinel_metadata_table, sql_additional_conditions)
+
+        if chunk_size > 0 :
+            # The ts are streamed from the DB in chunks of parcels
+            self.ts_db = None
+            self.ts_stream = db_ts_stream(host, port, dbname, user, password, self.sql_select, \
+                                          chunk_size, fid_range = fid_range)
+            self.components = self.ts_stream.get_components()
+            return
+
+        self.ts_stream = None
         # Variable that stores the complete ts retrieved from the DB and that is initialize when the object is created
         self.ts_db = self.get_ts_db(host, port, dbname, user, password, self.sql_select)
         # Variable that stores the list of components retrieved from the dataframe imported from the db
         self.components = list(self.ts_db.columns)
         #self.connection_opt = connection_opt
 
+        # Rows of each parcel (ts_db is sorted by parcel id)
+        self.ts_db, self.ts_index = index_by_parcel(self.ts_db)
+
     def sql_statement(self, db_schema : str, fid_col : str, parcels_table : str, sigs_table : str, sentinel_metadata_table : str, sql_additional_conditions : str) -> str :
 
         parcels = db_schema + "." + parcels_table
@@ -1162,24 +1373,11 @@ class db_bs_time_series_source(base_time_series_source) :
         #start_date = pd.to_datetime(start_date).to_pydatetime()
         #end_date = pd.to_datetime(end_date).to_pydatetime()
 	
-        # First keep only the database values corresponding to the right FOI ID
-        ts_final = self.ts_db[self.ts_db["parcel_id"] == fid].copy()
-        
-        	# Now reset the date index
-        ts_final = ts_final.reset_index()
-        
-        if start_date is not None :
-            ts_final = ts_final[ts_final['obstime'] >= start_date]
-        
-        if end_date is not None :
-            ts_final = ts_final[ts_final['obstime'] <= end_date]
-        
-        ts_final.set_index('obstime',inplace=True)
-        
-        # Force garbage collection
-        gc.collect()
+        if self.ts_stream is not None :
+            return self.ts_stream.get_ts(fid, start_date, end_date)
 
-        return ts_final
+        # Only the rows of the right FOI ID
+        return parcel_ts(self.ts_db, self.ts_index, fid, start_date, end_date)
 
     def get_ts_full(self) -> pd.DataFrame :
         """
@@ -1190,10 +1388,10 @@ class db_bs_time_series_source(base_time_series_source) :
             A pandas data frame
         """
 
-        ts_final = self.ts_db
+        if self.ts_stream is not None :
+            raise Exception("db_bs_time_series_source.get_ts_full() - not available when streaming (chunk_size)")
 
-        # Force garbage collection
-        gc.collect()
+        ts_final = self.ts_db
 
         return ts_final
 
@@ -1326,11 +1524,14 @@ class time_serie_source_factory :
             else :
                 cloud_cat = [3,8,9,10,11]
 
+            chunk_size = int(option.get('chunk_size', 0))
+            fid_range = option.get('fid_range')
+
             source = db_s2_time_series_source(signal_type, host, port, dbname, user, password, \
                                               db_schema, fid_col, parcels_table, sigs_table, \
                                               hists_table, sentinel_metadata_table, start_time,\
                                               end_time, sql_additional_conditions, cloud_free, \
-                                              cloud_cat)
+                                              cloud_cat, chunk_size, fid_range)
 
         elif source_type == "db_c6" :
             host =option['db_host']
@@ -1347,7 +1548,10 @@ class time_serie_source_factory :
             end_time = option['end_time']
             sql_additional_conditions = option['sql_additional_conditions']
 
-            source = db_c6_time_series_source(signal_type, host, port, dbname, user, password, db_schema, fid_col, parcels_table, sigs_table, sentinel_metadata_table, start_time, end_time, sql_additional_conditions)
+            chunk_size = int(option.get('chunk_size', 0))
+            fid_range = option.get('fid_range')
+
+            source = db_c6_time_series_source(signal_type, host, port, dbname, user, password, db_schema, fid_col, parcels_table, sigs_table, sentinel_metadata_table, start_time, end_time, sql_additional_conditions, chunk_size, fid_range)
 
         elif source_type == "db_bs" :
             host =option['db_host']
@@ -1364,7 +1568,10 @@ class time_serie_source_factory :
             end_time = option['end_time']
             sql_additional_conditions = option['sql_additional_conditions']
 
-            source = db_bs_time_series_source(signal_type, host, port, dbname, user, password, db_schema, fid_col, parcels_table, sigs_table, sentinel_metadata_table, start_time, end_time, sql_additional_conditions)
+            chunk_size = int(option.get('chunk_size', 0))
+            fid_range = option.get('fid_range')
+
+            source = db_bs_time_series_source(signal_type, host, port, dbname, user, password, db_schema, fid_col, parcels_table, sigs_table, sentinel_metadata_table, start_time, end_time, sql_additional_conditions, chunk_size, fid_range)
 
         # elif source_type == '' :
         # add here additional source types
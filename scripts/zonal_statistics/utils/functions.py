@@ -1,5 +1,9 @@
 from osgeo import gdal
 import numpy as np
+import rasterio.enums
+import rasterio.features
+import rasterio.windows
+import shapely
 
 
 # slope WITH DEMProcessing
@@ -67,6 +71,129 @@ def getCircularMean(angles):
     return np.degrees(vectorMean)
 
 
+def circularMeans(angles, groups, n):
+    """Vectorised getCircularMean of the angles of each group (0..n-1)."""
+    radians = np.radians(angles)
+    sines = np.bincount(groups, weights=np.sin(radians), minlength=n)
+    cosines = np.bincount(groups, weights=np.cos(radians), minlength=n)
+    return np.degrees(np.arctan2(sines, cosines))
+
+
+def readWindow(src, bounds, margin=1):
+    """This function reads the pixels of a bounding box (plus a margin of pixels)
+    from a raster dataset (e.g. a WarpedVRT), the pixels outside the dataset and
+    the nodata pixels are NaN. It returns the array and its affine transform"""
+    win = rasterio.windows.from_bounds(*bounds, transform=src.transform)
+    row0 = int(np.floor(win.row_off)) - margin
+    col0 = int(np.floor(win.col_off)) - margin
+    row1 = int(np.ceil(win.row_off + win.height)) + margin
+    col1 = int(np.ceil(win.col_off + win.width)) + margin
+
+    data = np.full((row1 - row0, col1 - col0), np.nan, dtype='float32')
+    r0, c0 = max(row0, 0), max(col0, 0)
+    r1, c1 = min(row1, src.height), min(col1, src.width)
+    if r1 > r0 and c1 > c0:
+        part = src.read(1, window=rasterio.windows.Window(c0, r0, c1 - c0, r1 - r0), masked=True)
+        data[r0 - row0:r1 - row0, c0 - col0:c1 - col0] = part.astype('float32').filled(np.nan)
+
+    window = rasterio.windows.Window(col0, row0, col1 - col0, row1 - row0)
+    return data, rasterio.windows.transform(window, src.transform)
+
+
+def slopeAspect(dem, xres, yres):
+    """Slope and aspect in degrees (same as gdaldem slope/aspect, Horn's method).
+    The pixels on the edge of the array, next to NaN pixels and the flat pixels
+    (aspect) are NaN"""
+    win = [dem[r:r + dem.shape[0] - 2, c:c + dem.shape[1] - 2] for r in range(3) for c in range(3)]
+    dx = (win[2] + 2 * win[5] + win[8]) - (win[0] + 2 * win[3] + win[6])
+    dy = (win[6] + 2 * win[7] + win[8]) - (win[0] + 2 * win[1] + win[2])
+
+    slope = np.full(dem.shape, np.nan, dtype='float32')
+    slope[1:-1, 1:-1] = np.degrees(np.arctan(np.hypot(dx / (8 * xres), dy / (8 * yres))))
+
+    aspect = np.full(dem.shape, np.nan, dtype='float32')
+    with np.errstate(invalid='ignore'):
+        angle = np.degrees(np.arctan2(dy, -dx))
+        angle = np.where(angle > 90, 450 - angle, 90 - angle)
+        angle[angle == 360] = 0
+        angle[(dx == 0) & (dy == 0)] = np.nan
+    aspect[1:-1, 1:-1] = angle
+    return slope, aspect
+
+
+def parcelPixels(geometries, shape, transform):
+    """This function rasterises the parcels of a chunk once and returns the
+    (pixel, parcel) pairs of the pixels touched by each parcel (all_touched).
+    The pixels not crossed by a parcel boundary belong to the parcel covering
+    their centre, the pixels crossed by the boundaries or covered by more than
+    one parcel (overlapping parcels) are intersected with the parcels, so they
+    belong to all the parcels they touch."""
+    geometries = np.asarray(geometries, dtype=object)
+    labels = rasterio.features.rasterize(
+        ((g, i + 1) for i, g in enumerate(geometries) if g is not None),
+        out_shape=shape, transform=transform, fill=0, dtype='int32')
+    covers = rasterio.features.rasterize(
+        ((g, 1) for g in geometries if g is not None), out_shape=shape, transform=transform,
+        fill=0, merge_alg=rasterio.enums.MergeAlg.add, dtype='int32')
+    edges = rasterio.features.rasterize(
+        ((shapely.boundary(g), 1) for g in geometries if g is not None),
+        out_shape=shape, transform=transform, fill=0, all_touched=True, dtype='uint8').astype(bool)
+    edges |= covers > 1
+
+    inner = np.flatnonzero((labels > 0) & ~edges)
+    pixels, parcels = [inner], [labels.ravel()[inner] - 1]
+
+    edge = np.flatnonzero(edges)
+    rows, cols = np.divmod(edge, shape[1])
+    x0, y0 = transform * (cols, rows)
+    x1, y1 = transform * (cols + 1, rows + 1)
+    boxes = shapely.box(np.minimum(x0, x1), np.minimum(y0, y1), np.maximum(x0, x1), np.maximum(y0, y1))
+    box_index, parcel_index = shapely.STRtree(geometries).query(boxes, predicate='intersects')
+    # pixels that only share a side or a corner with the parcel are not touched
+    inside = ~shapely.touches(boxes[box_index], geometries[parcel_index])
+    box_index, parcel_index = box_index[inside], parcel_index[inside]
+    pixels.append(edge[box_index])
+    parcels.append(parcel_index)
+
+    return np.concatenate(pixels), np.concatenate(parcels)
+
+
+def zonalStats(pids, geometries, elev, slope, aspect, transform):
+    """This function computes the elevation (mean, range, count), slope (mean)
+    and aspect (circular mean, count) statistics of all the parcels of a chunk
+    in one pass, the rasters are arrays of the same window (NaN is nodata)"""
+    n = len(pids)
+    pixels, parcels = parcelPixels(geometries, elev.shape, transform)
+
+    stats = {'pid': pids}
+    values = elev.ravel()[pixels]
+    valid = ~np.isnan(values)
+    count = np.bincount(parcels[valid], minlength=n)
+    total = np.bincount(parcels[valid], weights=values[valid], minlength=n)
+    high = np.full(n, -np.inf)
+    low = np.full(n, np.inf)
+    np.maximum.at(high, parcels[valid], values[valid])
+    np.minimum.at(low, parcels[valid], values[valid])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats['elevmean'] = np.round(total / count)
+        stats['elevrange'] = np.where(count > 0, high - low, np.nan).round()
+    stats['elevcount'] = count
+
+    values = slope.ravel()[pixels]
+    valid = ~np.isnan(values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats['slopemean'] = (np.bincount(parcels[valid], weights=values[valid], minlength=n)
+                              / np.bincount(parcels[valid], minlength=n))
+
+    values = aspect.ravel()[pixels]
+    valid = ~np.isnan(values)
+    count = np.bincount(parcels[valid], minlength=n)
+    stats['aspectmean'] = np.where(count > 0, circularMeans(values[valid], parcels[valid], n), np.nan)
+    stats['aspectcount'] = count
+
+    return stats
+
+
 def dsmListParser(x_range, y_range):
     dsmList = []
     path = '/eodata/auxdata/CopDEM/COP-DEM_GLO-30-DTED/DEM1_SAR_DTE_30_20{}_20{}_ADS_000000_{}.DEM/Copernicus_DSM_10_{}_00_{}_00'
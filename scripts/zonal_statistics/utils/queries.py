@@ -1,3 +1,5 @@
+import io
+
 query1 = """CREATE TABLE IF NOT EXISTS hu.env_2020
 (
     pid integer NOT NULL,
@@ -34,4 +36,26 @@ query4 = """SELECT * FROM public.geometry_columns
 where
 f_table_name like 'parcels_%' and
 f_table_name not like '%\_%\_%'
-order by f_table_schema;"""
\ No newline at end of file
+order by f_table_schema;"""
+
+def copyEnv(cursor, df, table='public.env', pkey='env_pkey'):
+    """Bulk load the zonal statistics: COPY to a temporary table and upsert
+    (the statistics of the existing parcels are updated)."""
+    cols = ','.join(df.columns)
+    data = io.StringIO()
+    df.to_csv(data, index=False, header=False)
+    data.seek(0)
+    cursor.execute(f"""CREATE TEMP TABLE env_load
+                    (LIKE {table} INCLUDING DEFAULTS)
+                    ON COMMIT DROP;""")
+    cursor.copy_expert(f"COPY env_load ({cols}) FROM STDIN WITH (FORMAT csv)", data)
+    cursor.execute(f"""INSERT INTO {table} ({cols})
+                    SELECT {cols} FROM env_load
+                    ON CONFLICT ON CONSTRAINT {pkey}
+                    DO UPDATE SET
+                    elevmean = excluded.elevmean,
+                    elevrange = excluded.elevrange,
+                    elevcount = excluded.elevcount,
+                    slopemean = excluded.slopemean,
+                    aspectmean = excluded.aspectmean,
+                    aspectcount = excluded.aspectcount;""")
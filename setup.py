@@ -33,7 +33,8 @@ setup(
         'requests>=2.24.0',
         'descartes>=1.1.0',
         'scikit-image>=0.19.0',
-        'psycopg2-binary'
+        'psycopg2-binary',
+        'shapely>=1.7'
     ],
     classifiers=[
         'Development Status :: 3 - Alpha',
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This file is part of CbM (https://github.com/ec-jrc/cbm).
+# Author    : Guido Lemoine, Konstantinos Anastasakis
+# Credits   : GTCAP Team
+# Copyright : 2021 European Commission, Joint Research Centre
+# License   : 3-Clause BSD
+
+import numpy as np
+import pytest
+
+zonal = pytest.importorskip("cbm.extract.zonal")
+from rasterio.transform import from_origin
+
+
+def test_label_stats():
+    labels = np.array([[1, 1], [1, 2]])
+    values = np.array([[1, 2], [3, 0]])
+    stats = zonal.label_stats(labels, values, 2)
+    assert list(stats['index']) == [0]
+    assert list(stats['count']) == [3]
+    assert stats['mean'][0] == 2.0
+    assert stats['p50'][0] == np.percentile([1, 2, 3], 50)
+
+
+def test_label_stats_all_nodata():
+    labels = np.ones((4, 4), dtype='int32')
+    values = np.zeros((4, 4), dtype='uint16')
+    stats = zonal.label_stats(labels, values, 1)
+    for key in ('index', 'count', 'mean', 'std', 'min', 'max',
+                'p25', 'p50', 'p75'):
+        assert len(stats[key]) == 0
+
+
+def test_block_stats_all_nodata_window():
+    geometries = [{'type': 'Polygon', 'coordinates': [
+        [(0, 0), (40, 0), (40, -40), (0, -40), (0, 0)]]}]
+    rasters = {'B4': (np.zeros((10, 10), dtype='uint16'),
+                      from_origin(0, 0, 10, 10))}
+    stats = zonal.block_stats(geometries, [7], rasters)
+    assert len(stats['B4']['pid']) == 0
+    assert len(stats['B4']['mean']) == 0
+
+
+def test_block_stats_overlapping_parcels():
+    rasterstats = pytest.importorskip("rasterstats")
+    geometries = [
+        {'type': 'Polygon', 'coordinates': [
+            [(0, 0), (60, 0), (60, -60), (0, -60), (0, 0)]]},
+        {'type': 'Polygon', 'coordinates': [
+            [(25, -25), (95, -25), (95, -95), (25, -95), (25, -25)]]},
+        {'type': 'Polygon', 'coordinates': [
+            [(10, -10), (30, -10), (30, -30), (10, -30), (10, -10)]]}]
+    values = np.arange(1, 101, dtype='uint16').reshape(10, 10)
+    transform = from_origin(0, 0, 10, 10)
+    stats = zonal.block_stats(geometries, [1, 2, 3],
+                              {'B4': (values, transform)})['B4']
+    reference = rasterstats.zonal_stats(
+        geometries, values, affine=transform, nodata=0,
+        stats=['count', 'mean', 'min', 'max', 'percentile_50'])
+    assert list(stats['pid']) == [1, 2, 3]
+    for i, ref in enumerate(reference):
+        assert stats['count'][i] == ref['count']
+        assert stats['mean'][i] == pytest.approx(ref['mean'])
+        assert stats['min'][i] == ref['min']
+        assert stats['max'][i] == ref['max']
+        assert stats['p50'][i] == pytest.approx(ref['percentile_50'])